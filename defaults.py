@@ -22,16 +22,53 @@ config_file = '/etc/ulg/config.py'
 # HTML presentation settings
 header = 'Universal looking glass'
 refresh_interval = 5                             # interval of html refresh
-usage_limit = 1                                  # maximum concurrently processed requests
+stream_interval = 1                              # interval of output checks in the streamed display
+stream_max_duration = 600                        # the browser reconnects to the stream after this time
+raw_block_size = 64*1024                         # block size of the output read by the raw output download
+usage_limit = 8                                  # maximum concurrently processed requests
+router_usage_limit = 1                           # maximum concurrently processed requests per router
+transport_usage_limits = {'ssh':1,               # ... per router by the transport (overrides router_usage_limit)
+                          'telnet':1,
+                          'socket':4,
+                          'local':4,}
+router_usage_limits = {}                         # ... per router name (overrides the above), e.g. {'bird1':8}
 range_step = 100                                 # number of table lines in the decorated output per page
+follow_lines = 100                               # number of the last output lines shown while the command is running
+coalesce_commands = True                         # identical commands on a router running concurrently share one output
+result_cache_dir = '/tmp/ulg-cache'
+result_cache_size = 50*1024*1024                 # disk budget of the result cache in bytes
+result_cache_ttl = 0                             # seconds a command result is served from the cache, 0 disables
+result_cache_ttls = {'BirdShowProtocolsCommand':30, # ... per command class (or its base class) name
+                     'CiscoCommandBgpIPv46Sum':30,
+                     'JuniperShowBgpSum':30,}
+page_cache_dir = '/tmp/ulg-pages'
+page_cache_size = 50*1024*1024                   # disk budget of the decorated pages of finished sessions in bytes
 
 # Default settings
 always_start_thread = True # True is highly recommended
 debug = True
+production = False # True disables template modification checks, restart application server after template change
 rescan_on_display = False
 persistent_storage_file = '/tmp/ulg.data'
+catalog_file = '/tmp/ulg-catalog.json'
 session_dir = '/tmp'
-usage_counter_file = '/tmp/ulg.lock'
+session_backend = 'file'                         # 'file' or 'compressed' (session_dir) or 'sqlite' (session_db_file)
+session_db_file = '/tmp/ulg-sessions.db'
+session_db_timeout = 30                          # seconds to wait for a locked database
+session_max_age = 3600                           # seconds after the last change the session is removed by ulg-cron.py
+session_ttls = {}                                # ... per command class (or its base class) name, e.g. {'BirdShowRouteExportCommand':600}
+session_quota = 512*1024*1024                    # disk budget of the session outputs in bytes, oldest finished sessions are evicted, 0 disables
+session_index_file = '/tmp/ulg-session-index.db' # expiry index of the 'file' and 'compressed' backends
+session_output_frame_size = 256*1024             # bytes of whole output lines compressed to one frame by the 'compressed' backend
+session_output_compress_level = 6                # zlib compression level of the 'compressed' backend
+output_buffer_size = 64*1024                     # bytes of command output buffered before it is written to the session store
+output_flush_interval = 1                        # maximum seconds the buffered output is not visible to the display
+usage_slot_dir = '/tmp/ulg-slots'
+inflight_dir = '/tmp/ulg-inflight'
+cli_session_pool = True                          # keep CLI sessions (Cisco ssh, BIRD control socket) open for the next commands of the process
+cli_session_max = 2                              # maximum pooled CLI sessions per router over all processes
+cli_session_idle_timeout = 300                   # seconds an unused pooled CLI session is kept open
+cli_session_check_timeout = 5                    # seconds to wait for the prompt in the health check of a pooled session
 log_file = '/tmp/ulg.log'
 default_bird_sock = '/var/run/bird.ctl'
 default_bird_sock_timeout = 30
@@ -39,6 +76,20 @@ default_bin_birdc = '/usr/sbin/birdc'
 bin_whois = '/usr/bin/whois'
 timeout = 180
 
+# Application server mode (ulgwsgi.py)
+wsgi_host = '127.0.0.1'
+wsgi_port = 8080
+wsgi_workers = 4                                 # number of pre-forked server processes
+
+# Command worker pool (ulg-worker.py)
+worker_mode = False                              # True queues commands for ulg-worker.py instead of forking
+worker_pool_size = 4                             # number of worker processes (concurrently running commands)
+worker_poll_interval = 0.2                       # interval of queue checks in idle workers
+worker_report_interval = 60                      # interval of queue depth reports in the log
+queue_dir = '/tmp/ulg-queue'
+queue_limit = 100                                # maximum number of commands waiting for one router
+queue_timeout = 300                              # maximum time a command waits for its router
+
 # Template dir relative to the index.py script
 template_dir = 'templates'
 index_template_file = 'index.html'
@@ -47,6 +98,8 @@ table_decorator_template_file = 'tabledecorator.html'
 
 # Paths to external programs
 bin_ssh = '/usr/bin/ssh'
+ssh_multiplexing = True                          # share one ssh connection per router (OpenSSH ControlMaster, control sockets in session_dir)
+ssh_control_persist = 600                        # seconds an idle master connection is kept open
 bin_telnet = '/usr/bin/telnet'
 
 # Output (localized) strings
@@ -58,6 +111,9 @@ STRING_BAD_PARAMS='Verification of command or parameters failed.'
 STRING_SESSION_OVERLIMIT = "<em>Limit of maximum concurrently running sessions and/or queries has been reached. The command can not be executed now. Please try again later.</em>"
 STRING_SESSION_ACCESSDENIED = "<em>Access denied. The command can not be executed. Please contact the administrator.</em>"
 STRING_ARBITRARY_ERROR = "Error encountered. Operation aborted. See log for further details."
+STRING_SESSION_NOT_FOUND = "Session not found."
+STRING_QUEUE_POSITION = "The router is busy. Your command is waiting in the queue at position %d."
+STRING_RAW_OUTPUT = "Raw output"
 STRING_IPADDRESS = "IP address"
 STRING_IPSUBNET = "IP subnet"
 STRING_MACADDRESS = "MAC address"
@@ -20,12 +20,22 @@
 # Imports
 import os, sys
 import random
+import StringIO
+import socket
+import threading
 
 import defaults
 
 import ulgmodel
 import ulg
+import ulgqueue
+import ulgcache
+import ulgstore
+import ulgcli
+import ulglinux
+import ulgbird
 import ulgcisco
+import ulgjuniper
 
 import sys
 import re
@@ -111,6 +121,144 @@ def testULGSessions(sessionid=None):
         print "FAIL: Test sessions.\n  Exception="+str(e)
         return False
 
+def testULGSessionTransaction():
+    s = ulg.Session(routerid=0,commandid=0,parameters=[])
+    with s.transaction():
+        s.addParameter('p1')
+        s.setError('e1')
+        ls = ulg.loadSession(s.getSessionId())
+        if(ls.getParameters() or ls.getError()):
+            print "FAIL: Test session transaction. Session saved before the end of transaction."
+            return False
+
+    ls = ulg.loadSession(s.getSessionId())
+    if(ls.getParameters() != ['p1'] or ls.getError() != 'e1' or ls.transaction_level != 0):
+        print "FAIL: Test session transaction. Session not saved at the end of transaction."
+        return False
+
+    print "OK: Test session transaction."
+    return True
+
+def testULGOutputBuffer():
+    s = ulg.Session(routerid=0,commandid=0,parameters=[])
+    s.setResult('')
+    size,interval = defaults.output_buffer_size,defaults.output_flush_interval
+    defaults.output_buffer_size,defaults.output_flush_interval = 10,0.2
+    try:
+        f = ulg.FakeSessionFile(s)
+        f.write('line1\n')
+        if(s.getResult() != ''):
+            print "FAIL: Test output buffer. Output written before a flush threshold."
+            return False
+
+        f.write('line2\n')
+        if(s.getResult() != 'line1\nline2\n'):
+            print "FAIL: Test output buffer. Output not written after the buffer size threshold."
+            return False
+
+        f.write('line3\n')
+        time.sleep(0.5)
+        if(s.getResult() != 'line1\nline2\nline3\n'):
+            print "FAIL: Test output buffer. Output not written after the flush interval."
+            return False
+
+        f.write('line4\n')
+        f.close()
+        if(s.getResult() != 'line1\nline2\nline3\nline4\n'):
+            print "FAIL: Test output buffer. Output not written by close()."
+            return False
+    finally:
+        defaults.output_buffer_size,defaults.output_flush_interval = size,interval
+
+    print "OK: Test output buffer."
+    return True
+
+def testULGDisplayReadOnly(routerid=0,commandid=0):
+    try:
+        s = ulg.Session(routerid=routerid,commandid=commandid,parameters=[])
+        s.setResult('test output\n')
+        s.setFinished()
+
+        # count writes to the session store
+        store = ulgstore.getSessionStore()
+        writes = []
+        def countWrite(*args):
+            writes.append(args)
+        store.saveSession = store.setOutput = store.appendOutput = countWrite
+
+        try:
+            c = ulg.ULGCgi()
+            c.renderULGResult(s.getSessionId(),resrange=0)
+            c.decorator_helper.copy_session(s).setResult('copy output')
+        finally:
+            del store.saveSession, store.setOutput, store.appendOutput
+
+        if(writes or s.getResult() != 'test output\n'):
+            print "FAIL: Test display read-only. Session changed by the display."
+            return False
+
+        print "OK: Test display read-only."
+        return True
+    except Exception as e:
+        print "FAIL: Test display read-only.\n  Exception="+str(e)
+        print traceback.format_exc()
+        return False
+
+def removeSessionFiles(sid):
+    for f in os.listdir(defaults.session_dir):
+        if(f.startswith('ulg-'+sid+'.')):
+            os.unlink(os.path.join(defaults.session_dir,f))
+
+def testULGSessionStore():
+    dbfile = '/tmp/ulg-test-sessions-'+str(os.getpid())+'.db'
+    sid = 'teststore'+str(os.getpid())
+    try:
+        for store in [ulgstore.FileSessionStore(),ulgstore.CompressedFileSessionStore(),ulgstore.SQLiteSessionStore(filename=dbfile)]:
+            name = store.__class__.__name__
+            store.saveSession(sid,'session data')
+            if(store.loadSession(sid) != 'session data' or store.loadSession(sid+'x') != None):
+                print "FAIL: Test session store "+name+". Wrong session data."
+                return False
+
+            if(store.getOutput(sid) != None):
+                print "FAIL: Test session store "+name+". Output exists before it has been written."
+                return False
+
+            store.setOutput(sid,'line1\n')
+            store.appendOutput(sid,'line2\n')
+            store.appendOutput(sid,'line3\n')
+            if(store.getOutput(sid) != 'line1\nline2\nline3\n' or store.getOutputSize(sid) != 18 or
+               store.readOutput(sid,4,6) != '1\nline' or store.readOutput(sid,12) != 'line3\n'):
+                print "FAIL: Test session store "+name+". Wrong output."
+                return False
+
+            store.clearOutput(sid)
+            if(store.getOutput(sid) != '' or store.getOutputSize(sid) != 0):
+                print "FAIL: Test session store "+name+". Output not cleared."
+                return False
+
+            store.saveSession(sid,'session data',time.time()-1,True)
+            if(isinstance(store,ulgstore.FileSessionStore)):
+                # temp files left by a process that died while saving
+                for fn in [ulgstore.getSessionFileName(sid)+'.1.tmp',ulgstore.getSessionOutputPartFileName(sid,'tail')+'.1.tmp']:
+                    open(fn,'w').close()
+                    os.utime(fn,(time.time()-defaults.session_max_age-1,time.time()-defaults.session_max_age-1))
+            if(store.expire() < 1 or store.loadSession(sid) != None or store.getOutput(sid) != None or
+               [f for f in os.listdir(defaults.session_dir) if f.startswith('ulg-'+sid+'.')]):
+                print "FAIL: Test session store "+name+". Session not expired."
+                return False
+
+        print "OK: Test session store."
+        return True
+    except Exception as e:
+        print "FAIL: Test session store.\n  Exception="+str(e)
+        print traceback.format_exc()
+        return False
+    finally:
+        for f in [dbfile,dbfile+'-wal',dbfile+'-shm']:
+            if(os.path.exists(f)):
+                os.unlink(f)
+
 def testULGLock():
     c = ulg.ULGCgi()
 
@@ -140,6 +288,167 @@ def testULGLock():
     print "OK: Test lock."
     return True
 
+def testULGUsageSlots():
+    slots = ulgmodel.UsageSlots(prefix='ulg-test-'+str(os.getpid()),limit=1)
+
+    # child takes the slot and dies without releasing it
+    pid = os.fork()
+    if(pid == 0):
+        slots.acquire()
+        os._exit(1)
+    os.waitpid(pid,0)
+
+    if(slots.getOccupancy() != 0 or (not slots.acquire())):
+        print "FAIL: Test usage slots. Slot of a dead process has not been freed."
+        return False
+
+    if(slots.getOccupancy() != 1):
+        print "FAIL: Test usage slots. Wrong occupancy."
+        slots.release()
+        return False
+
+    slots.release()
+    os.unlink(slots._getSlotFileName(0))
+    print "OK: Test usage slots."
+    return True
+
+def testULGCLISessionPool():
+    # a local shell stands in for the router CLI
+    def newSession():
+        return ulgcli.CLISession('/usr/bin/env PS1=testrouter# /bin/sh','','[a-zA-Z0-9\._-]+#',['stty -onlcr'],'exit')
+
+    key = 'test-'+str(os.getpid())
+    pool = ulgcli.CLISessionPool(pooling=True)
+    try:
+        out = StringIO.StringIO()
+        pool.runCommand(key,newSession,'seq 1 3',out)
+        first = pool.idle[key][0]
+        pool.runCommand(key,newSession,'echo 4',out)
+        if(out.getvalue() != "1\n2\n3\n4\n" or pool.idle[key][0] != first):
+            print "FAIL: Test CLI session pool. Session has not been reused: "+repr(out.getvalue())
+            return False
+
+        # a dead session fails the health check and is replaced
+        first.s.kill(9)
+        first.s.wait()
+        out = StringIO.StringIO()
+        pool.runCommand(key,newSession,'echo 5',out)
+        if(out.getvalue() != "5\n" or pool.idle[key][0] == first):
+            print "FAIL: Test CLI session pool. Dead session has not been replaced."
+            return False
+
+        outputs = pool.runBatch(key,newSession,['echo 6','seq 7 8'])
+        if(outputs != ["6\n","7\n8\n"]):
+            print "FAIL: Test CLI session pool. Batch outputs have not been split at the prompt: "+repr(outputs)
+            return False
+
+        pool.idle[key][0].last_use -= defaults.cli_session_idle_timeout+1
+        pool.expireIdle()
+        if(pool.idle[key]):
+            print "FAIL: Test CLI session pool. Idle session has not been closed."
+            return False
+    finally:
+        pool.closeAll()
+        for i in range(0,defaults.cli_session_max):
+            fn = os.path.join(defaults.usage_slot_dir,'ulg-cli-'+key+'-'+str(i)+'.slot')
+            if(os.path.exists(fn)):
+                os.unlink(fn)
+
+    print "OK: Test CLI session pool."
+    return True
+
+def testULGBirdCLIBatch():
+    # a local shell with the birdc prompt stands in for birdc over ssh
+    def newSession():
+        return ulgcli.CLISession('/usr/bin/env PS1="bird> " /bin/sh','',ulgbird.bird_cli_prompt_regexp,['stty -onlcr'],'exit')
+
+    try:
+        outputs = ulgcli.runBatch(newSession,['printf "name proto\\nbgp1 BGP\\n"','echo master'])
+        if(outputs != ["name proto\nbgp1 BGP\n","master\n"]):
+            print "FAIL: Test BIRD CLI batch. Outputs have not been split at the bird> prompt: "+repr(outputs)
+            return False
+    except Exception as e:
+        print "FAIL: Test BIRD CLI batch.\n  Exception="+str(e)
+        return False
+
+    print "OK: Test BIRD CLI batch."
+    return True
+
+def testULGBirdSocketPool():
+    # fake BIRD control socket, the first connection is closed on the third command
+    path = '/tmp/ulg-test-bird-'+str(os.getpid())+'.ctl'
+    server = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(1)
+    connections = []
+
+    def serve():
+        for c in range(0,2):
+            conn,addr = server.accept()
+            connections.append(conn)
+            f = conn.makefile()
+            f.write("0001 BIRD 1.6.0 ready.\n")
+            f.flush()
+            n = 0
+            while True:
+                l = f.readline()
+                n += 1
+                if((not l) or (c == 0 and n == 3)):
+                    break
+                f.write("1000-"+l.strip()+"\n 2\n0000 \n")
+                f.flush()
+            f.close()
+            conn.close()
+
+    t = threading.Thread(target=serve)
+    t.daemon = True
+    t.start()
+
+    key = 'test-bird-'+str(os.getpid())
+    pool = ulgcli.CLISessionPool(pooling=True)
+    try:
+        out = StringIO.StringIO()
+        for c in ['show status','show protocols','show memory']:
+            pool.runCommand(key,lambda: ulgbird.BirdSocketConnection(path),c,out)
+    finally:
+        pool.closeAll()
+        t.join(5)
+        server.close()
+        os.unlink(path)
+        for i in range(0,defaults.cli_session_max):
+            fn = os.path.join(defaults.usage_slot_dir,'ulg-cli-'+key+'-'+str(i)+'.slot')
+            if(os.path.exists(fn)):
+                os.unlink(fn)
+
+    if(out.getvalue() != "show status\n2\nshow protocols\n2\nshow memory\n2\n" or len(connections) != 2):
+        print "FAIL: Test BIRD socket pool. Connection has not been reused or reconnected: "+repr(out.getvalue())+" connections="+str(len(connections))
+        return False
+
+    print "OK: Test BIRD socket pool."
+    return True
+
+def testULGSSHCommand():
+    r1 = ulglinux.LinuxRouterRemote('192.0.2.1','ulg',name='r1',commands=[])
+    r2 = ulglinux.LinuxRouterRemote('192.0.2.1','ulg',name='r2',commands=[])
+    r3 = ulglinux.LinuxRouterRemote('192.0.2.1','ulg',port=2222,name='r3',commands=[])
+
+    if(r1.getSSHControlPath() != r2.getSSHControlPath() or r1.getSSHControlPath() == r3.getSSHControlPath()):
+        print "FAIL: Test SSH command. Routers do not share the master connection by user, host and port."
+        return False
+
+    if(not re.match(ulgmodel.SSH_CONTROL_FILE_REGEXP,os.path.basename(r1.getSSHControlPath()))):
+        print "FAIL: Test SSH command. Control socket does not match SSH_CONTROL_FILE_REGEXP."
+        return False
+
+    c = r3.getSSHCommand()
+    if((not c.startswith(defaults.bin_ssh+' -p2222')) or (not c.endswith(' ulg@192.0.2.1')) or
+       (defaults.ssh_multiplexing and (not 'ControlPath='+r3.getSSHControlPath() in c))):
+        print "FAIL: Test SSH command. Wrong command line: "+c
+        return False
+
+    print "OK: Test SSH command."
+    return True
+
 def testULGRunParameter(router=0,command=4,params=['91.210.16.1']):
     r = config.routers[router]
     try:
@@ -200,6 +509,445 @@ def testULGPersistentStorage():
         print traceback.format_exc()
         return False  
 
+def testULGLazyRouter():
+    class TestRouter(ulgmodel.LocalRouter):
+        def __init__(self,name,acl=None):
+            ulgmodel.LocalRouter.__init__(self,acl=acl)
+            self.setName(name)
+            self.setCommands([ulgmodel.TextCommand('show version')])
+
+    class DefaultNameRouter(TestRouter):
+        def __init__(self,host,name='localhost'):
+            TestRouter.__init__(self,name)
+            self.host = host
+
+    try:
+        r = ulgmodel.LazyRouter(TestRouter,name='lazy',acl=['user1'])
+        if(r.getName() != 'lazy' or (not r.checkACL('user1')) or r.checkACL('user2') or r.isConstructed()):
+            print "FAIL: Test lazy router: Specification lookup constructed the router or returned wrong values."
+            return False
+
+        if(len(r.listCommands()) != 1 or (not r.isConstructed())):
+            print "FAIL: Test lazy router: Router has not been constructed on use."
+            return False
+
+        # without the name the router reports its own (default) name
+        r = ulgmodel.LazyRouter(TestRouter,'positional')
+        if(r.getName() != 'positional' or r.isConstructed()):
+            print "FAIL: Test lazy router: Positional name has not been used."
+            return False
+        r = ulgmodel.LazyRouter(DefaultNameRouter,host='testhost')
+        if(r.getName() != 'localhost' or (not r.isConstructed())):
+            print "FAIL: Test lazy router: Name differs from the name of the constructed router."
+            return False
+
+        print "OK: Test lazy router."
+        return True
+    except Exception as e:
+        print "FAIL: Test lazy router.\n  Exception="+str(e)
+        print traceback.format_exc()
+        return False
+
+def testULGSessionEviction():
+    dbfile = '/tmp/ulg-test-eviction-'+str(os.getpid())+'.db'
+    try:
+        store = ulgstore.SQLiteSessionStore(filename=dbfile)
+        sids = ['testevict'+str(i)+str(os.getpid()) for i in range(0,4)]
+        for i,sid in enumerate(sids):
+            store.setOutput(sid,'x'*100)
+            # the last session is still running
+            store.saveSession(sid,'session data',time.time()+60,i < 3)
+            time.sleep(0.01)
+
+        if(store.evict(1000) != 0 or store.evict(250) != 2 or
+           [sid for sid in sids if store.loadSession(sid) != None] != sids[2:] or store.getOutput(sids[0]) != None):
+            print "FAIL: Test session eviction: Oldest finished sessions not evicted."
+            return False
+
+        if(store.evict(0) != 1 or [sid for sid in sids if store.loadSession(sid) != None] != sids[3:]):
+            print "FAIL: Test session eviction: Running session evicted."
+            return False
+
+        # the output of a removed session stays while a coalesced session shows it
+        leader = sids[3]
+        follower = 'testfollow'+str(os.getpid())
+        store.saveSession(leader,'session data',time.time()+60,True)
+        store.saveSession(follower,'session data',time.time()+60,True,leader)
+        size = store.getOutputDiskSize(leader)
+        store.removeSessions([leader])
+        if(store.getOutput(leader) != 'x'*100 or
+           store.getExpiryIndex().execute('SELECT SUM(size) FROM expiry').fetchone()[0] != size):
+            print "FAIL: Test session eviction: Shared output removed or not counted."
+            return False
+
+        store.removeSessions([follower])
+        if(store.getOutput(leader) != None):
+            print "FAIL: Test session eviction: Shared output not removed with the last session."
+            return False
+
+        class TestTTLCommand(ulgmodel.TextCommand):
+            pass
+        ttls = defaults.session_ttls
+        defaults.session_ttls = {'TextCommand':10,'AnyCommand':20}
+        try:
+            if(TestTTLCommand('test').getSessionTTL() != 10 or ulgmodel.AnyCommand().getSessionTTL() != 20):
+                print "FAIL: Test session eviction: Wrong session TTL of the command class."
+                return False
+        finally:
+            defaults.session_ttls = ttls
+
+        print "OK: Test session eviction."
+        return True
+    except Exception as e:
+        print "FAIL: Test session eviction.\n  Exception="+str(e)
+        print traceback.format_exc()
+        return False
+    finally:
+        for f in [dbfile,dbfile+'-wal',dbfile+'-shm']:
+            if(os.path.exists(f)):
+                os.unlink(f)
+
+def testULGOutputLines():
+    dbfile = '/tmp/ulg-test-lines-'+str(os.getpid())+'.db'
+    sid = 'testlines'+str(os.getpid())
+    frame_size = defaults.session_output_frame_size
+    defaults.session_output_frame_size = 100
+    try:
+        for store in [ulgstore.FileSessionStore(),ulgstore.CompressedFileSessionStore(),ulgstore.SQLiteSessionStore(filename=dbfile)]:
+            name = store.__class__.__name__
+            store.appendOutput(sid,'line0\r\n')
+            store.appendOutput(sid,'line1\n')
+            for i in range(2,1000):
+                store.appendOutput(sid,'line%d\nline' % i if(i % 2) else '%d\n' % i)
+            store.appendOutput(sid,'last')
+
+            lines = store.getOutput(sid).splitlines()
+            if(store.getOutputLineCount(sid) != len(lines) or store.readOutputLines(sid) != lines):
+                print "FAIL: Test output lines "+name+". Wrong line count or lines."
+                return False
+
+            if(store.readOutputLines(sid,500,15) != lines[500:515] or store.readOutputLines(sid,len(lines)-2,5) != lines[-2:] or
+               store.readOutputLines(sid,len(lines)+1,5) != []):
+                print "FAIL: Test output lines "+name+". Wrong page."
+                return False
+
+            if(store.readOutputTail(sid,3) != (lines[-4:-1],store.getOutputSize(sid)-len(lines[-1])) or
+               store.readOutputTail(sid,len(lines)+10) != (lines[:-1],store.getOutputSize(sid)-len(lines[-1]))):
+                print "FAIL: Test output lines "+name+". Wrong tail."
+                return False
+
+            store.clearOutput(sid)
+            if(store.getOutputLineCount(sid) != 0 or store.readOutputLines(sid) != []):
+                print "FAIL: Test output lines "+name+". Line index not cleared."
+                return False
+
+            if(isinstance(store,ulgstore.FileSessionStore)):
+                removeSessionFiles(sid)
+
+        print "OK: Test output lines."
+        return True
+    except Exception as e:
+        print "FAIL: Test output lines.\n  Exception="+str(e)
+        print traceback.format_exc()
+        return False
+    finally:
+        defaults.session_output_frame_size = frame_size
+        for f in [dbfile,dbfile+'-wal',dbfile+'-shm']:
+            if(os.path.exists(f)):
+                os.unlink(f)
+
+def testULGOutputConcurrency():
+    sid = 'testconc'+str(os.getpid())
+    frame_size = defaults.session_output_frame_size
+    defaults.session_output_frame_size = 1000
+    expected = ''.join(['line %d\n' % i for i in range(0,20000)])
+    expected_lines = expected.split('\n')
+    pid = None
+    try:
+        for store in [ulgstore.FileSessionStore(),ulgstore.CompressedFileSessionStore()]:
+            name = store.__class__.__name__
+            store.setOutput(sid,'')
+            pid = os.fork()
+            if(pid == 0):
+                try:
+                    for i in range(0,len(expected),70):
+                        store.appendOutput(sid,expected[i:i+70])
+                finally:
+                    os._exit(0)
+
+            # read while the child appends the output (and moves the tail to frames)
+            size = 0
+            while(size < len(expected)):
+                size = store.getOutputSize(sid)
+                if(store.readOutput(sid,0,size) != expected[:size]):
+                    print "FAIL: Test output concurrency "+name+". Inconsistent output read at size "+str(size)+"."
+                    os.waitpid(pid,0)
+                    return False
+                start = max(0,store.getOutputLineCount(sid)-3)
+                lines = store.readOutputLines(sid,start)
+                if(lines and (lines[:-1] != expected_lines[start:start+len(lines)-1] or
+                              not expected_lines[start+len(lines)-1].startswith(lines[-1]))):
+                    print "FAIL: Test output concurrency "+name+". Inconsistent lines read at size "+str(size)+"."
+                    os.waitpid(pid,0)
+                    return False
+            os.waitpid(pid,0)
+            pid = None
+            removeSessionFiles(sid)
+
+        print "OK: Test output concurrency."
+        return True
+    except Exception as e:
+        print "FAIL: Test output concurrency.\n  Exception="+str(e)
+        print traceback.format_exc()
+        if(pid):
+            os.waitpid(pid,0)
+        return False
+    finally:
+        defaults.session_output_frame_size = frame_size
+        removeSessionFiles(sid)
+
+def testULGJobQueue():
+    qd = '/tmp/ulg-test-queue-'+str(os.getpid())
+    try:
+        q = ulgqueue.JobQueue(queue_dir=qd,limit=2)
+        if((not q.enqueue('a1')) or (not q.enqueue('b2')) or q.enqueue('c3') or q.getDepth() != 2):
+            print "FAIL: Test job queue: Queue limit not enforced."
+            return False
+
+        j = q.claim()
+        if((not j) or j[1] != 'a1' or q.getDepth() != 1 or q.getRunning() != 1):
+            print "FAIL: Test job queue: Wrong job claimed."
+            return False
+
+        if(q.releaseClaimed(os.getpid()) != ['a1'] or q.getRunning() != 0):
+            print "FAIL: Test job queue: Claimed job not released."
+            return False
+
+        j = q.claim()
+        q.done(j[0])
+        if(q.claim() != None or q.getDepth() != 0):
+            print "FAIL: Test job queue: Queue not empty."
+            return False
+
+        print "OK: Test job queue."
+        return True
+    except Exception as e:
+        print "FAIL: Test job queue.\n  Exception="+str(e)
+        print traceback.format_exc()
+        return False
+    finally:
+        for f in os.listdir(qd):
+            os.unlink(os.path.join(qd,f))
+        os.rmdir(qd)
+
+def testULGWaitQueue():
+    qd = '/tmp/ulg-test-queue-'+str(os.getpid())
+    try:
+        q = ulgqueue.WaitQueue('r1',queue_dir=qd,limit=2)
+        t1 = q.enter('a1')
+        time.sleep(0.01)
+        t2 = q.enter('b2')
+        if((not q.isFirst(t1)) or q.isFirst(t2) or q.getPosition('b2') != 2 or (not q.isFull())):
+            print "FAIL: Test wait queue: Wrong order of waiting sessions."
+            return False
+
+        # ticket of a dead process is dropped
+        t1[1].close()
+        if((not q.isFirst(t2)) or q.getPosition('b2') != 1 or q.getDepth() != 1):
+            print "FAIL: Test wait queue: Stale ticket not removed."
+            return False
+
+        q.leave(t2)
+        if(q.getDepth() != 0):
+            print "FAIL: Test wait queue: Queue not empty."
+            return False
+
+        print "OK: Test wait queue."
+        return True
+    except Exception as e:
+        print "FAIL: Test wait queue.\n  Exception="+str(e)
+        print traceback.format_exc()
+        return False
+    finally:
+        wd = os.path.join(qd,'wait-r1')
+        for f in os.listdir(wd):
+            os.unlink(os.path.join(wd,f))
+        os.rmdir(wd)
+        os.rmdir(qd)
+
+def testULGCoalesce(routerid=0,commandid=0):
+    try:
+        params = [ps.getDefault() for ps in config.routers[routerid].listCommands()[commandid].getParamSpecs()]
+        leader = ulg.Session(routerid=routerid,commandid=commandid,parameters=params)
+        follower = ulg.Session(routerid=routerid,commandid=commandid,parameters=params)
+
+        if(ulg.coalesceSession(leader) or (not ulg.coalesceSession(follower)) or
+           follower.getOutputId() != leader.getSessionId()):
+            print "FAIL: Test coalesce: Identical session has not been attached."
+            leader.setFinished()
+            return False
+
+        leader.setResult('test output')
+
+        # identical session arriving after the leader has been saved finished
+        # and before it finished its followers (Session.setFinished())
+        leader.finished = True
+        leader.save()
+        late = ulg.Session(routerid=routerid,commandid=commandid,parameters=params)
+        ulg.coalesceSession(late)
+        ulg.finishFollowers(leader)
+
+        for s in [follower,late]:
+            s = ulg.loadSession(s.getSessionId())
+            if((not s.isFinished()) or s.getResult() != 'test output'):
+                print "FAIL: Test coalesce: Attached session has not been finished with the shared output."
+                return False
+
+        print "OK: Test coalesce."
+        return True
+    except Exception as e:
+        print "FAIL: Test coalesce.\n  Exception="+str(e)
+        print traceback.format_exc()
+        return False
+
+def testULGResultCache():
+    cd = '/tmp/ulg-test-cache-'+str(os.getpid())
+    try:
+        c = ulgcache.ResultCache(cache_dir=cd,size=1000)
+        c.put('k1','a'*400,data=['d1'])
+        if(c.get('k1',60) != ('a'*400,['d1']) or c.get('k1',-1) != None or c.get('k2',60) != None):
+            print "FAIL: Test result cache: Wrong entry returned."
+            return False
+
+        # k1 is used recently, k2 is the least recently used entry
+        c.put('k2','b'*400)
+        os.utime(os.path.join(cd,'k2'+ulgcache.CACHE_FILE_SUFFIX),(time.time()-100,time.time()-100))
+        c.put('k3','c'*400)
+        if(c.get('k2',60) != None or c.get('k1',60) == None or c.get('k3',60) == None):
+            print "FAIL: Test result cache: Least recently used entry has not been evicted."
+            return False
+
+        print "OK: Test result cache."
+        return True
+    except Exception as e:
+        print "FAIL: Test result cache.\n  Exception="+str(e)
+        print traceback.format_exc()
+        return False
+    finally:
+        for f in os.listdir(cd):
+            os.unlink(os.path.join(cd,f))
+        os.rmdir(cd)
+
+def testULGPageCache():
+    s = ulg.Session(routerid=0,commandid=0,parameters=[])
+    s.setResult('test output\n')
+    s.setFinished()
+
+    command = s.getCommand()
+    decorations = []
+    def countDecorate(session,decorator_helper=None):
+        decorations.append(session.getResultSize())
+        return ('page %d' % session.getResultSize(),1)
+    command.decorateResult = countDecorate
+
+    try:
+        helper = ulg.DecoratorHelper()
+        if(s.getDecoratedResult(helper,0,False) != ('page 12',1) or s.getDecoratedResult(helper,0,False) != ('page 12',1) or
+           len(decorations) != 2):
+            print "FAIL: Test page cache: Page of an unfinished session cached."
+            return False
+
+        if(s.getDecoratedResult(helper,0,True) != ('page 12',1) or s.getDecoratedResult(helper,0,True) != ('page 12',1) or
+           len(decorations) != 3):
+            print "FAIL: Test page cache: Page of a finished session not cached."
+            return False
+
+        s.appendResult('more output\n')
+        if(s.getDecoratedResult(helper,0,True) != ('page 24',1) or len(decorations) != 4):
+            print "FAIL: Test page cache: Cached page not invalidated by the output change."
+            return False
+    finally:
+        del command.decorateResult
+
+    print "OK: Test page cache."
+    return True
+
+def testULGFollowResult():
+    s = ulg.Session(routerid=0,commandid=0,parameters=[])
+    s.setResult(''.join(['line%d\n' % i for i in range(0,250)])+'partial')
+
+    c = ulg.ULGCgi()
+    page = c.renderULGResult(s.getSessionId(),resrange=0)
+    if(('line249' not in page) or ('line%d\n' % (249-defaults.follow_lines) in page) or ('partial' in page) or
+       ('offset=%d' % (s.getResultSize()-len('partial')) not in page)):
+        print "FAIL: Test follow result: Tail of the running session not shown."
+        return False
+
+    s.setFinished()
+    page = c.renderULGResult(s.getSessionId(),resrange=0)
+    if(('line0\n' not in page) or ('line249' in page)):
+        print "FAIL: Test follow result: First page of the finished session not shown."
+        return False
+
+    print "OK: Test follow result."
+    return True
+
+def testULGRawResult():
+    s = ulg.Session(routerid=0,commandid=0,parameters=[])
+    s.setResult('line1\nline2\nline3\n')
+    s.setFinished()
+
+    block_size = defaults.raw_block_size
+    defaults.raw_block_size = 4
+    try:
+        c = ulg.ULGCgi()
+        status,headers,body = c.rawULGResult(s.getSessionId())
+        if(status != '200 OK' or dict(headers)['Content-Length'] != '18' or list(body) != ['line','1\nli','ne2\n','line','3\n']):
+            print "FAIL: Test raw result: Wrong whole output."
+            return False
+
+        for (byterange,content_range,data) in [('bytes=6-10','bytes 6-10/18','line2'),('bytes=-3','bytes 15-17/18','e3\n'),
+                                               ('bytes=12-100','bytes 12-17/18','line3\n')]:
+            status,headers,body = c.rawULGResult(s.getSessionId(),byterange)
+            if(status != '206 Partial Content' or dict(headers)['Content-Range'] != content_range or ''.join(body) != data):
+                print "FAIL: Test raw result: Wrong output range "+byterange+"."
+                return False
+
+        if(c.rawULGResult(s.getSessionId(),'bytes=18-')[0] != '416 Requested Range Not Satisfiable' or
+           c.rawULGResult(s.getSessionId(),'bytes=5-2')[0] != '200 OK' or
+           c.rawULGResult(s.getSessionId()+'x')[0] != '404 Not Found'):
+            print "FAIL: Test raw result: Wrong status of an invalid request."
+            return False
+    finally:
+        defaults.raw_block_size = block_size
+
+    print "OK: Test raw result."
+    return True
+
+def testULGParseResult():
+    sum_output = """Groups: 2 Peers: 2 Down peers: 0
+Peer                     AS      InPkt     OutPkt    OutQ   Flaps Last Up/Dwn State|#Active/Received/Accepted/Damped...
+91.210.16.1           25192      12345      12346       0       0  1w2d3h Establ
+2001:7f8:14::1        25192      12345      12346       0       0  1w2d3h Establ
+"""
+    try:
+        s = ulg.Session(routerid=0,commandid=0)
+        s.setResult(sum_output)
+        if(ulgmodel.TextCommand('show bgp summary').parseResult(s) != {'lines':str.splitlines(sum_output)}):
+            print "FAIL: Test parse result: Wrong text command result."
+            return False
+
+        if(ulgjuniper.JuniperShowBgpSum().parseResult(s) != {'peers':['91.210.16.1','2001:7f8:14::1']}):
+            print "FAIL: Test parse result: Wrong Juniper BGP summary result."
+            return False
+
+        print "OK: Test parse result."
+        return True
+    except Exception as e:
+        print "FAIL: Test parse result.\n  Exception="+str(e)
+        print traceback.format_exc()
+        return False
+
 def testULGCiscoParser(header,cisco_input,expect):
     try:
         res = ulgcisco.matchCiscoBGPLines(header,cisco_input)
@@ -288,10 +1036,31 @@ if __name__=="__main__":
     runTest(testULGIndex(routerid=0,commandid=0,sessionid=None))
     runTest(testULGAction(routerid=0,commandid=0,sessionid=None,maxtimes=10,interval=5,**{}))
     runTest(testULGSessions())
+    runTest(testULGSessionTransaction())
+    runTest(testULGOutputBuffer())
+    runTest(testULGDisplayReadOnly())
+    runTest(testULGSessionStore())
+    runTest(testULGOutputLines())
+    runTest(testULGOutputConcurrency())
+    runTest(testULGSessionEviction())
     runTest(testULGLock())
+    runTest(testULGUsageSlots())
+    runTest(testULGCLISessionPool())
+    runTest(testULGBirdSocketPool())
+    runTest(testULGBirdCLIBatch())
+    runTest(testULGSSHCommand())
     runTest(testULGLog())
     runTest(testULGRescan())
     runTest(testULGPersistentStorage())
+    runTest(testULGLazyRouter())
+    runTest(testULGJobQueue())
+    runTest(testULGWaitQueue())
+    runTest(testULGCoalesce())
+    runTest(testULGResultCache())
+    runTest(testULGPageCache())
+    runTest(testULGFollowResult())
+    runTest(testULGRawResult())
+    runTest(testULGParseResult())
     runTest(testULGCiscoParser1())
     runTest(testULGCiscoParser2())
     runTest(testULGCiscoParser3())
@@ -23,16 +23,18 @@ import random
 import time, datetime
 import pickle
 import re
+import subprocess
 
 import defaults
 
 import ulgmodel
+import ulgstore
 
 config = ulgmodel.import_config()
 
 ### ULG cron script
 
-SESSION_FILE_REGEX='^ulg-.*\.session$'
+INFLIGHT_FILE_REGEX='^ulg-.*\.inflight$'
 LOGFILE_LIMIT=1048576
 
 class ULGCron:
@@ -43,21 +45,50 @@ class ULGCron:
         for r in config.routers:
             r.rescanHook()
 
+    def rebuildCatalog(self):
+        ulgmodel.saveCatalog(config.routers)
+
     def clearSessions(self):
-        sre = re.compile(SESSION_FILE_REGEX)
+        ulgstore.getSessionStore().expire()
+
+    def evictSessions(self):
+        if(defaults.session_quota):
+            ulgstore.getSessionStore().evict(defaults.session_quota)
+
+    def clearInflight(self):
+        if(not os.path.isdir(defaults.inflight_dir)):
+            return
+
+        ire = re.compile(INFLIGHT_FILE_REGEX)
+        limit = time.time() - defaults.session_max_age
+        for file in os.listdir(defaults.inflight_dir):
+            if ire.match(file):
+                fp = defaults.inflight_dir+'/'+file
+                try:
+                    if(os.path.getmtime(fp) < limit):
+                        ulgmodel.log('Removing file '+fp)
+                        os.unlink(fp)
+                except OSError as e:
+                    ulgmodel.log('Error while removing file '+fp+' '+str(e))
+
+    def clearSSHMasters(self):
+        """ Remove control sockets of the OpenSSH master connections that are gone
+        (ssh -O check fails), the living masters exit after defaults.ssh_control_persist. """
+        if(not os.path.isdir(defaults.session_dir)):
+            return
+
+        sre = re.compile(ulgmodel.SSH_CONTROL_FILE_REGEXP)
+        devnull = open(os.devnull,'w')
         for file in os.listdir(defaults.session_dir):
             if sre.match(file):
                 fp = defaults.session_dir+'/'+file
-
-                now = datetime.datetime.now()
-                if(datetime.datetime.fromtimestamp(os.path.getmtime(fp)) < now+datetime.timedelta(hours=-1)):
-                    ulgmodel.log('Removing file '+fp)
-                    try:
+                try:
+                    if(subprocess.call([defaults.bin_ssh,'-O','check','-o','ControlPath='+fp,'ulg'],stdout=devnull,stderr=devnull) != 0):
+                        ulgmodel.log('Removing stale SSH control socket '+fp)
                         os.unlink(fp)
-                    except OSError as e:
-                        ulgmodel.log('Error while removing file '+fp+' '+str(e))
-                else:
-                    ulgmodel.log('Not removing file '+fp+' because it is not at least 1 hour old.')
+                except OSError as e:
+                    ulgmodel.log('Error while checking/removing SSH control socket '+fp+' '+str(e))
+        devnull.close()
 
     def clearLog(self):
         try:
@@ -71,7 +102,11 @@ class ULGCron:
         ulgmodel.log('ULG cron run.')
         self.clearLog()
         self.rescanRouters()
+        self.rebuildCatalog()
         self.clearSessions()
+        self.evictSessions()
+        self.clearInflight()
+        self.clearSSHMasters()
         ulgmodel.log('ULG cron finished.')
 
 
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+#
+# ULG - Universal Looking Glass
+# (C) 2012 CZ.NIC, z.s.p.o.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# Imports
+import os, sys
+import signal
+import time
+import traceback
+
+import defaults
+
+import ulgmodel
+import ulgqueue
+import ulgcli
+import ulg
+
+### ULG command worker pool
+
+class ULGWorker:
+    """ Pool of worker processes executing commands queued by the front-end
+    (defaults.worker_mode). Configuration and routers are loaded once by the
+    parent and inherited by the forked workers, each worker keeps them
+    for all the commands it executes. """
+
+    def __init__(self,workers=defaults.worker_pool_size):
+        self.workers = workers
+        self.children = []
+        self.queue = ulgqueue.JobQueue()
+        self.routers = dict([(r.getUsageKey(),r) for r in ulg.config.routers])
+
+    def failSession(self,sessionid):
+        session = ulg.loadSession(sessionid)
+        if(session and not session.isFinished()):
+            session.appendResult(defaults.STRING_ARBITRARY_ERROR)
+            with session.transaction():
+                session.setError(defaults.STRING_ARBITRARY_ERROR)
+                session.setFinished()
+
+    def admitRouter(self,key):
+        """ Take a usage slot of the router, jobs for busy routers stay queued
+        and do not block jobs for the other routers. """
+        router = self.routers.get(key,None)
+        if(router == None):
+            # unknown router (config changed), let the job fail in executeSession
+            return ulgmodel.UsageSlots(limit=0)
+
+        slots = router.getUsageSlots()
+        if(slots.acquire()):
+            return slots
+        return None
+
+    def workerLoop(self):
+        # keep the router sessions for the following commands of this worker
+        ulgcli.pool.setPooling(True)
+
+        while True:
+            job = self.queue.claim(self.admitRouter)
+            if(not job):
+                # do not keep router sessions that are not used anymore
+                ulgcli.pool.expireIdle()
+                time.sleep(defaults.worker_poll_interval)
+                continue
+
+            jobfile,sessionid,slots = job
+            try:
+                session = ulg.loadSession(sessionid)
+                if(session):
+                    ulg.executeSession(session)
+                else:
+                    ulgmodel.log('ERROR: Session '+sessionid+' of a queued job not found.')
+            finally:
+                slots.release()
+                self.queue.done(jobfile)
+
+    def spawnWorker(self):
+        pid = os.fork()
+        if(pid == 0):
+            signal.signal(signal.SIGTERM,signal.SIG_DFL)
+            signal.signal(signal.SIGINT,signal.SIG_DFL)
+            try:
+                self.workerLoop()
+            except Exception as e:
+                ulgmodel.log("ERROR in command worker: "+traceback.format_exc())
+            os._exit(0)
+
+        self.children.append(pid)
+        ulgmodel.debug("Command worker started PID: "+str(pid))
+
+    def reapWorkers(self):
+        while True:
+            try:
+                pid,status = os.waitpid(-1,os.WNOHANG)
+            except OSError:
+                return
+            if(pid == 0):
+                return
+
+            if(pid in self.children):
+                self.children.remove(pid)
+                ulgmodel.log('Command worker PID '+str(pid)+' exited with status '+str(status)+', respawning.')
+                for sessionid in self.queue.releaseClaimed(pid):
+                    self.failSession(sessionid)
+                self.spawnWorker()
+
+    def reportQueue(self):
+        ulgmodel.log('ULG worker queue depth: '+str(self.queue.getDepth())+' waiting, '+
+                     str(self.queue.getRunning())+' running, '+str(len(self.children))+' workers.')
+
+    def stop(self,signum=None,frame=None):
+        for pid in self.children:
+            try:
+                os.kill(pid,signal.SIGTERM)
+            except OSError:
+                pass
+        ulgmodel.log('ULG worker pool stopped.')
+        os._exit(0)
+
+    def run(self):
+        ulgmodel.log('ULG worker pool starting with '+str(self.workers)+' workers.')
+
+        # jobs left claimed by a previous run will never finish
+        for sessionid in self.queue.releaseClaimed():
+            self.failSession(sessionid)
+
+        signal.signal(signal.SIGTERM,self.stop)
+        signal.signal(signal.SIGINT,self.stop)
+
+        # sessions opened by the rescans while constructing the routers,
+        # the parent does not run commands and would hold their slots
+        ulgcli.pool.closeAll()
+
+        for i in range(0,self.workers):
+            self.spawnWorker()
+
+        last_report = time.time()
+        while True:
+            time.sleep(1)
+            self.reapWorkers()
+
+            if(time.time() - last_report >= defaults.worker_report_interval):
+                self.reportQueue()
+                last_report = time.time()
+
+
+# main
+
+if __name__=="__main__":
+    sys.exit(ULGWorker().run())
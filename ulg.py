@@ -19,22 +19,30 @@
 
 # Imports
 import os, sys
-from genshi.template import TemplateLoader
 from genshi.core import Markup
 import cgi
 import cgitb; cgitb.enable()
 import pickle
 import re
 import fcntl
+import errno
 import traceback
+import contextlib
+import threading
 import urllib
 import hashlib
 import time
 import random
+import json
+import email.utils
 
 import defaults
 
 import ulgmodel
+import ulgqueue
+import ulgcache
+import ulgstore
+from ulgstore import getSessionFileName, getSessionOutputFileName
 import whois
 
 config = ulgmodel.import_config()
@@ -45,23 +53,28 @@ ipv4_annotate_regexp = re.compile(IPV4_ANNOTATE_REGEXP)
 IPV6_ANNOTATE_REGEXP = '(([0-9a-fA-F]{1,4}:|:){2,7}([0-9a-fA-F]{1,4}|:)(/[0-9]{1,2})?)'
 ipv6_annotate_regexp = re.compile(IPV6_ANNOTATE_REGEXP)
 
-### CGI output handler
+# single byte range only, requests for multiple ranges get the whole output
+BYTE_RANGE_REGEXP = '^\s*bytes\s*=\s*([0-9]*)\s*-\s*([0-9]*)\s*$'
+byte_range_regexp = re.compile(BYTE_RANGE_REGEXP)
 
-def getSessionFileName(sessionid):
-    if(re.compile('^[a-zA-Z0-9]{10,128}$').match(sessionid)):
-        return defaults.session_dir+'/'+'ulg-'+sessionid+'.session'
-    else:
-        raise Exception('Invalid session id passed. Value was: '+sessionid)
+### CGI output handler
 
-def getSessionOutputFileName(sessionid):
-    if(re.compile('^[a-zA-Z0-9]{10,128}$').match(sessionid)):
-        return defaults.session_dir+'/'+'ulg-'+sessionid+'.out.session'
-    else:
-        raise Exception('Invalid session id passed. Value was: '+sessionid)
+def getInflightFileName(key):
+    return defaults.inflight_dir+'/'+'ulg-'+key+'.inflight'
 
 class Session(object):
-    def __init__(self,sessionid=None,routerid=None,commandid=None,parameters=[],result=None,finished=False,error=None,resrange=None,copy=None):
+    # attributes valid only in the process (or the request), they are not saved
+    TRANSIENT_ATTRIBUTES = ['transaction_level','dirty','range','detached','detached_result']
+
+    def __init__(self,sessionid=None,routerid=None,commandid=None,parameters=[],result=None,finished=False,error=None,resrange=None,copy=None,autosave=True):
+        self.transaction_level = 0
+        self.dirty = False
+        self.detached = False
+        self.detached_result = None
+
         if(copy):
+            # detached copy for decorators, it is never saved and its result
+            # is kept in memory
             self.sessionid=copy.sessionid
             self.routerid=copy.routerid
             self.commandid=copy.commandid
@@ -71,6 +84,9 @@ class Session(object):
             self.range=copy.range
             self.resultlen=copy.resultlen
             self.data=copy.data
+            self.outputid=copy.outputid
+            self.coalesce_key=None
+            self.detached=True
 
         else:
             if(sessionid == None):
@@ -86,28 +102,78 @@ class Session(object):
             self.range=resrange
             self.resultlen=0
             self.data=None
+            self.outputid=None
+            self.coalesce_key=None
 
-        self.save()
+        if(self.detached):
+            pass
+        elif(autosave):
+            self.save()
+        else:
+            # saved by the first save() or at the end of transaction
+            self.dirty = True
 
     def __genSessionId__(self):
         return hashlib.md5(str(time.time())+str(random.randint(1,1000000))).hexdigest()
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for a in self.TRANSIENT_ATTRIBUTES:
+            state.pop(a,None)
+        return state
+
+    def __setstate__(self,state):
+        self.__dict__.update(state)
+        self.transaction_level = 0
+        self.dirty = False
+        self.range = None
+        self.detached = False
+        self.detached_result = None
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """ Batch modifications of the session, the session is saved only once
+        at the end of the (outermost) transaction. """
+        self.transaction_level += 1
+        try:
+            yield self
+        finally:
+            self.transaction_level -= 1
+            if(self.transaction_level == 0 and self.dirty):
+                self.save()
+
     def save(self):
+        if(self.detached):
+            return
+
+        if(self.transaction_level > 0):
+            self.dirty = True
+            return
+
         try:
-            fn = getSessionFileName(self.getSessionId())
-            f = open(fn,'wb')
-            pickle.dump(self, f)
-            f.close()
+            ulgstore.getSessionStore().saveSession(self.getSessionId(),pickle.dumps(self,pickle.HIGHEST_PROTOCOL),
+                                                   time.time()+self.getTTL(),self.isFinished(),self.getOutputId())
+            self.dirty = False
         except:
             ulgmodel.log("Saving session failed: " + traceback.format_exc())
 
     def getSessionId(self):
         return self.sessionid
 
+    def getTTL(self):
+        """ Seconds after the last change the session expires. """
+        try:
+            return self.getCommand().getSessionTTL()
+        except:
+            return defaults.session_max_age
+
     def setFinished(self):
         self.finished=True
         self.save()
 
+        if(self.coalesce_key):
+            finishFollowers(self)
+
     def isFinished(self):
         return self.finished
 
@@ -138,57 +204,118 @@ class Session(object):
     def getParameters(self):
         return self.parameters
 
+    def getOutputId(self):
+        """ ID of the session that produces the output, differs for sessions
+        attached to an identical running command. """
+        if(self.outputid):
+            return self.outputid
+        return self.sessionid
+
+    def setOutputId(self,outputid):
+        self.outputid = outputid
+        self.save()
+
+    def setCoalesceKey(self,key):
+        self.coalesce_key = key
+        self.save()
+
     def setResult(self,result):
-        fn = getSessionOutputFileName(self.sessionid)
+        if(self.detached):
+            self.detached_result = result
+            return
 
-        f = open(fn, 'w')
-        f.write(result)
-        f.close()
+        ulgstore.getSessionStore().setOutput(self.getOutputId(),result)
 
     def getResult(self):
-        try:
-            fn = getSessionOutputFileName(self.sessionid)
+        if(self.detached_result != None):
+            return self.detached_result
 
-            if(os.path.isfile(fn)):
-                f = open(fn, 'r')
-                result = f.read()
-                f.close()
-                return result
-            else:
-                return None
+        try:
+            return ulgstore.getSessionStore().getOutput(self.getOutputId())
         except:
             return None
 
     def getDecoratedResult(self,decorator_helper,resrange=0,finished=False):
+        """ Return (decorated result,number of result lines or table rows). """
         if(self.getError()):
             # TODO
-            return decorator_helper.pre(self.getResult())
+            return (decorator_helper.pre(self.getResult()),0)
+
+        # the result of a finished session does not change, serve its pages from the cache
+        key = None
+        if(finished and not self.detached):
+            key = ulgcache.getPageKey(self.getSessionId(),self.getOutputId(),self.getResultSize(),resrange)
+            page = ulgcache.PageCache().get(key)
+            if(page):
+                return page
+
+        dr = self.getCommand().decorateResult(self,decorator_helper)
+
+        if(isinstance(dr,tuple)):
+            page = dr
+        elif(dr):
+            page = (dr,0)
         else:
-            dr = self.getCommand().decorateResult(self,decorator_helper)
+            page = ('',0)
 
-            if(dr):
-                self.resultlines = dr[1]
-                return dr[0]
-            else:
-                self.resultlines = 0
-                return ''
+        if(key):
+            ulgcache.PageCache().put(key,page[0],page[1])
+        return page
 
-    def appendResult(self,result_fragment):
-        fn = getSessionOutputFileName(self.sessionid)
+    def getResultSize(self):
+        return ulgstore.getSessionStore().getOutputSize(self.getOutputId())
 
-        f = open(fn, 'a')
-        f.write(result_fragment)
-        f.close()
+    def readResult(self,offset=0,length=-1):
+        return ulgstore.getSessionStore().readOutput(self.getOutputId(),offset,length)
+
+    def hasResult(self):
+        if(self.detached_result != None):
+            return True
 
-    def clearResult(self):
         try:
-            fn = getSessionOutputFileName(self.sessionid)
+            return ulgstore.getSessionStore().hasOutput(self.getOutputId())
+        except:
+            return False
 
-            if(os.path.isfile(fn)):
-                f=open(fn,'w')
-                f.close()
+    def getResultLineCount(self):
+        """ Number of result lines, answered from the line index of the output. """
+        if(self.detached_result != None):
+            return len(ulgstore.splitOutputLines(self.detached_result))
 
-            self.resultlines = 0
+        try:
+            return ulgstore.getSessionStore().getOutputLineCount(self.getOutputId())
+        except:
+            return 0
+
+    def getResultLines(self,start=0,count=-1):
+        """ Read count result lines (all when negative) starting by the line start
+        without reading the rest of the output. """
+        if(self.detached_result != None):
+            lines = ulgstore.splitOutputLines(self.detached_result)
+            return lines[start:] if(count < 0) else lines[start:start+count]
+
+        try:
+            return ulgstore.getSessionStore().readOutputLines(self.getOutputId(),start,count)
+        except:
+            return []
+
+    def getResultTail(self,count):
+        """ Return (the last count complete result lines,offset of their end in the output). """
+        if(self.detached_result != None):
+            end = self.detached_result.rfind('\n')+1
+            return (ulgstore.splitOutputLines(self.detached_result[:end])[-count:],end)
+
+        try:
+            return ulgstore.getSessionStore().readOutputTail(self.getOutputId(),count)
+        except:
+            return ([],0)
+
+    def appendResult(self,result_fragment):
+        ulgstore.getSessionStore().appendOutput(self.getOutputId(),result_fragment)
+
+    def clearResult(self):
+        try:
+            ulgstore.getSessionStore().clearOutput(self.sessionid)
         except:
             pass
 
@@ -215,15 +342,12 @@ class Session(object):
         return self.range
 
     def setRange(self,resrange):
+        """ Set range of the displayed result for the current request, the range is not saved. """
         self.range=resrange
-        self.save()
 
     def showRange(self):
         return self.getCommand().showRange()
 
-    def getMaxRange(self):
-        return self.resultlines
-
     def getData(self):
         return self.data
 
@@ -236,13 +360,9 @@ def loadSession(sessionid):
         return None
 
     try:
-        fn = getSessionFileName(sessionid)
-
-        if(os.path.isfile(fn)):
-            f = open(fn, 'rb')
-            s = pickle.load(f)
-            f.close()
-            return s
+        data = ulgstore.getSessionStore().loadSession(sessionid)
+        if(data):
+            return pickle.loads(data)
         else:
             return None
             
@@ -250,12 +370,198 @@ def loadSession(sessionid):
         return None
 
 
+def getCommandKey(session):
+    """ Key of the command run by the session: router and normalized command text. """
+    text = session.getCommand().getCommandText(session.getParameters())
+    if(text == None):
+        return None
+    return ulgcache.getCacheKey(session.getRouter(),text)
+
+def closeInheritedFiles():
+    """ Close all file descriptors but stdin, stdout and stderr in a forked
+    command process, the (WSGI) server sockets must not be kept open by the
+    command. The log and the session store are opened again when used. """
+    try:
+        fds = [int(fd) for fd in os.listdir('/proc/self/fd')]
+    except OSError:
+        fds = range(0,os.sysconf('SC_OPEN_MAX'))
+
+    for fd in fds:
+        if(fd > 2):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+def removeInflightFile(fn):
+    try:
+        os.unlink(fn)
+    except OSError as e:
+        if(e.errno != errno.ENOENT):
+            raise
+
+def coalesceSession(session):
+    """ Attach the session to a running session with identical command on the same
+    router, both sessions then share one output. If there is no such session
+    register this one as the leader for the following identical sessions.
+    Returns True when the session has been attached. """
+    key = getCommandKey(session)
+    if(not key):
+        return False
+
+    if(not os.path.isdir(defaults.inflight_dir)):
+        try:
+            os.makedirs(defaults.inflight_dir)
+        except OSError:
+            # created by another process in the meantime
+            pass
+
+    fn = getInflightFileName(key)
+    while True:
+        try:
+            fd = os.open(fn,os.O_WRONLY|os.O_CREAT|os.O_EXCL,0644)
+            os.write(fd,session.getSessionId()+' '+str(time.time())+'\n')
+            os.close(fd)
+            session.setCoalesceKey(key)
+            return False
+        except OSError as e:
+            if(e.errno != errno.EEXIST):
+                ulgmodel.log("Registering running command failed: "+str(e))
+                return False
+
+        try:
+            f = open(fn,'r+')
+        except IOError:
+            # the leader finished in the meantime
+            continue
+
+        attached = False
+        try:
+            fcntl.flock(f,fcntl.LOCK_EX)
+            if(os.fstat(f.fileno()).st_nlink > 0):
+                leader = f.readline().split()
+                ls = loadSession(leader[0])
+                # a finished leader that still has its in-flight file finishes
+                # the attached sessions in finishFollowers() under the same lock
+                if(ls and (time.time() - float(leader[1])) < (defaults.timeout + defaults.queue_timeout)):
+                    f.seek(0,2)
+                    f.write(session.getSessionId()+'\n')
+                    session.setOutputId(ls.getOutputId())
+                    attached = True
+                else:
+                    # leader died without finishing
+                    removeInflightFile(fn)
+        finally:
+            f.close()
+
+        if(attached):
+            ulgmodel.debug("Session "+session.getSessionId()+" attached to running session "+session.getOutputId())
+            return True
+
+def finishFollowers(session):
+    """ Finish sessions attached to the (leader) session. """
+    fn = getInflightFileName(session.coalesce_key)
+    try:
+        f = open(fn,'r+')
+    except IOError:
+        return
+
+    followers = []
+    try:
+        fcntl.flock(f,fcntl.LOCK_EX)
+        lines = f.readlines()
+        if(lines and lines[0].split()[0] == session.getSessionId()):
+            followers = [l.strip() for l in lines[1:] if l.strip()]
+            removeInflightFile(fn)
+    finally:
+        f.close()
+
+    for fid in followers:
+        fs = loadSession(fid)
+        if(fs):
+            with fs.transaction():
+                fs.setData(session.getData())
+                fs.setError(session.getError())
+                fs.setFinished()
+
+
+class FakeSessionFile(object):
+    """ File-like object collecting the command output to the session. The output
+    is buffered and appended to the session store when the buffer exceeds
+    defaults.output_buffer_size bytes or when it is older than defaults.output_flush_interval
+    seconds (a timer flushes the buffer when the command does not write anything),
+    close() flushes the rest. """
+    def __init__(self,session):
+        self.session = session
+        self.buf = []
+        self.buflen = 0
+        self.lock = threading.Lock()
+        self.timer = None
+
+    def write(self,string):
+        with self.lock:
+            self.buf.append(string)
+            self.buflen += len(string)
+            if(self.buflen >= defaults.output_buffer_size):
+                self._flush()
+            elif(not self.timer):
+                self.timer = threading.Timer(defaults.output_flush_interval,self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def _flush(self):
+        if(self.timer):
+            self.timer.cancel()
+            self.timer = None
+        if(self.buf):
+            self.session.appendResult(''.join(self.buf))
+            self.buf = []
+            self.buflen = 0
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def close(self):
+        self.flush()
+
+
+def executeSession(session):
+    """ Run the command of the session in the current process and mark the session finished. """
+    ulgmodel.debug("Running command: "+session.getCommand().getName())
+    outfile = FakeSessionFile(session)
+    try:
+        session.getRouter().runAsyncCommand(session.getCommand(),session.getParameters(),outfile)
+        outfile.close()
+        session.getCommand().finishHook(session)
+
+        key = getCommandKey(session)
+        if(key and session.getCommand().getCacheTTL() > 0 and session.getResult() != None):
+            ulgcache.ResultCache().put(key,session.getResult(),session.getData())
+    except Exception as e:
+        ulgmodel.log("ERROR: Exception occured while running a command:" + traceback.format_exc())
+        outfile.close()
+        session.setResult("ERROR in commandThreadBody:\n"+traceback.format_exc())
+    finally:
+        ulgmodel.debug("Command finished: "+session.getCommand().getName())
+        outfile.close()
+        session.setFinished()
+
+    if(defaults.session_quota):
+        # do not let a burst of large outputs fill the disk before the next cron run
+        try:
+            ulgstore.getSessionStore().evict(defaults.session_quota)
+        except Exception as e:
+            ulgmodel.log("Evicting sessions failed: "+str(e))
+
+
 class DecoratorHelper:
     def __init__(self):
         pass
 
     def getScriptURL(self):
-        return os.path.basename(__file__)
+        # when loaded by the application server __file__ points to ulg.pyc
+        return os.path.splitext(os.path.basename(__file__))[0] + '.py'
 
     def getURL(self,action,parameters={}):
         url=self.getScriptURL() + ("?action=%s" % urllib.quote(action))
@@ -284,6 +590,15 @@ class DecoratorHelper:
     def getSpecialContentURL(self,sessionid,parameters={}):
         return self.getURL('getfile',dict({'sessionid':sessionid},**parameters))
 
+    def getStreamURL(self,sessionid,offset=0):
+        return self.getURL('stream',{'sessionid':sessionid,'offset':str(offset)})
+
+    def getRawURL(self,sessionid):
+        return self.getURL('raw',{'sessionid':sessionid})
+
+    def getCatalogURL(self,version):
+        return self.getURL('catalog',{'version':version})
+
     def getWhoisURL(self,key,objtype=None):
         if(objtype):
             return self.getURL('whois',dict({'key':key,'objtype':objtype}))
@@ -294,6 +609,8 @@ class DecoratorHelper:
         for ridx,r in enumerate(config.routers):
             if(r == router):
                 return ridx
+            if(isinstance(r,ulgmodel.LazyRouter) and r.isConstructed() and r.getRouter() == router):
+                return ridx
 
         return 0
 
@@ -311,7 +628,7 @@ class DecoratorHelper:
         return ('<a href=%s>%s</a>' % (str(url),str(text)))
 
     def copy_session(self,session):
-        return Session(copy=session)
+        return Session(copy=session,autosave=False)
 
     def img(self,url,alternative_text=None):
         if(alternative_text):
@@ -377,14 +694,13 @@ class DecoratorHelper:
 
 
 class ULGCgi:
-    def __init__(self,user=None):
-        self.loader=TemplateLoader(
-            os.path.join(os.path.dirname(__file__), defaults.template_dir),
-            auto_reload=True
-            )
+    def __init__(self,user=None,environ=None):
+        self.loader=ulgmodel.getTemplateLoader()
 
         self.decorator_helper = DecoratorHelper()
+        self.usage = ulgmodel.UsageSlots()
         self.user = user
+        self.environ = environ if(environ != None) else os.environ
 
 
     def print_text_html(self):
@@ -392,66 +708,13 @@ class ULGCgi:
 
 
     def increaseUsage(self):
-        u = 0
-        try:
-            # Open files
-            if(os.path.isfile(defaults.usage_counter_file)):
-                lf = open(defaults.usage_counter_file,'r+')
-                u = int(lf.readline())
-            else:
-                lf = open(defaults.usage_counter_file,'w')
-
-            # Acquire lock
-            fcntl.lockf(lf, fcntl.LOCK_EX)
-        except (IOError,ValueError) as e:
-            ulgmodel.log("Locking mechanism failure: "+str(e))
-            return False
-
-        try:
-            if(u < defaults.usage_limit):
-                # write a new value and release lock
-                lf.seek(0)
-                lf.write(str(u+1)+'\n')
-                lf.close()
-                return True
-            else:
-                # release lock
-                lf.close()
-                return False
-        except IOError as e:
-            ulgmodel.log("Locking mechanism update failure: "+str(e))
-            return False
+        return self.usage.acquire()
 
     def decreaseUsage(self):
-        u = 1
-        try:
-            # Open files
-            if(os.path.isfile(defaults.usage_counter_file)):
-                lf = open(defaults.usage_counter_file,'r+')
-                u = int(lf.readline())
-            else:
-                lf = open(defaults.usage_counter_file,'w')
+        self.usage.release()
 
-            # Acquire lock
-            fcntl.lockf(lf, fcntl.LOCK_EX)
-        except IOError,ValueError:
-            ulgmodel.log("Locking mechanism failure: "+str(e))
-            return False
-
-        try:
-            if(u>0):
-                # write a new value and release lock
-                lf.seek(0)
-                lf.write(str(u-1)+'\n')
-                lf.close()
-                return
-            else:
-                # release lock
-                lf.close()
-                return
-        except IOError as e:
-            ulgmodel.log("Locking mechanism update failure: "+str(e))
-            pass
+    def getUsage(self):
+        return (self.usage.getOccupancy(),self.usage.getLimit())
 
     def stopSessionOverlimit(self,session):
         session.setResult(defaults.STRING_SESSION_OVERLIMIT)
@@ -467,15 +730,13 @@ class ULGCgi:
         else:
             return defaults.refresh_interval
 
-    def getCommonParams(self):
-        res = {}
-        for r in config.routers:
-            for c in r.listCommands():
-                for ps in c.getParamSpecs():
-                    if(ps.getType() == 'commonselect'):
-                        res[ps.getID()] = ps            
+    def getCatalogURL(self):
+        return self.decorator_helper.getCatalogURL(ulgmodel.loadCatalog(config.routers)[1])
 
-        return res
+    def getFormDefaults(self,routerid=0,commandid=0,params=[]):
+        fd = json.dumps({'routerid':routerid,'commandid':commandid,'params':params})
+        # the JSON is placed inside a script element
+        return Markup(fd.replace('</','<\\/'))
 
     def HTTPRedirect(self,url):
         return """<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.0 Transitional//EN">
@@ -488,27 +749,65 @@ class ULGCgi:
 </body>
 </html>""" % url
 
-    def runCommand(self,session,user=None):
-        class FakeSessionFile(object):
-            def __init__(self,session):
-                self.session = session
+    def serveFromCache(self,session):
+        ttl = session.getCommand().getCacheTTL()
+        if(ttl <= 0):
+            return False
+
+        key = getCommandKey(session)
+        if(not key):
+            return False
+
+        cached = ulgcache.ResultCache().get(key,ttl)
+        if(not cached):
+            return False
+
+        ulgmodel.debug("Serving session "+session.getSessionId()+" from the result cache.")
+        session.setResult(cached[0])
+        with session.transaction():
+            session.setData(cached[1])
+            session.setFinished()
+        return True
+
+    def waitForUsage(self,session):
+        """ Wait in the FIFO of the session router for a router usage slot
+        and a global usage slot. Returns the router slots or None on timeout. """
+        router = session.getRouter()
+        router_slots = router.getUsageSlots()
+        wq = ulgqueue.WaitQueue(router.getUsageKey())
+        ticket = wq.enter(session.getSessionId())
+        try:
+            start = time.time()
+            while((time.time() - start) < defaults.queue_timeout):
+                if(wq.isFirst(ticket) and router_slots.acquire()):
+                    if(self.increaseUsage()):
+                        return router_slots
+                    router_slots.release()
+                time.sleep(defaults.worker_poll_interval)
+            return None
+        finally:
+            wq.leave(ticket)
 
-            def write(self,string):
-                self.session.appendResult(string)
+    def getQueuePosition(self,session):
+        """ Position of the session waiting for its router, None if not waiting. """
+        if(defaults.worker_mode):
+            return ulgqueue.JobQueue().getPosition(session.getOutputId())
+        else:
+            return ulgqueue.WaitQueue(session.getRouter().getUsageKey()).getPosition(session.getOutputId())
 
+    def runCommand(self,session,user=None):
         # define trivial thread function
-        def commandThreadBody(session,decreaseUsageMethod):
-            ulgmodel.debug("Running command: "+session.getCommand().getName())
+        def commandThreadBody(session):
+            router_slots = self.waitForUsage(session)
+            if(not router_slots):
+                self.stopSessionOverlimit(session)
+                return
+
             try:
-                session.getRouter().runAsyncCommand(session.getCommand(),session.getParameters(),FakeSessionFile(session))
-                session.getCommand().finishHook(session)
-            except Exception as e:
-                ulgmodel.log("ERROR: Exception occured while running a command:" + traceback.format_exc())
-                session.setResult("ERROR in commandThreadBody:\n"+traceback.format_exc())
+                executeSession(session)
             finally:
-                ulgmodel.debug("Command finished: "+session.getCommand().getName())
-                session.setFinished()
-                decreaseUsageMethod()
+                router_slots.release()
+                self.decreaseUsage()
 
         # check router ACL
         if user:
@@ -516,44 +815,72 @@ class ULGCgi:
                 self.stopSessionAccessDenied(session)
                 return
 
-        # try to increase usage counter
-        if(self.increaseUsage()):
-            # start new thread if needed
-            if(defaults.always_start_thread or session.getRouter().getForkNeeded()):
-                # fork a daemon process (fork two times to decouple with parent)
-                sys.stdout.flush()
-                child_pid = os.fork()
-                if(child_pid == 0):
-                    # detach process
-                    devnull = open(os.devnull,'w')
-                    os.dup2(devnull.fileno(),sys.stdout.fileno())
-                    os.dup2(devnull.fileno(),sys.stderr.fileno())
+        # serve a fresh result of an identical command from the cache
+        if(self.serveFromCache(session)):
+            return
 
-                    # run the command
-                    ulgmodel.debug("Running in a forked process...")
-                    commandThreadBody(session,self.decreaseUsage)
-                    ulgmodel.debug("Forked process finished...")
+        # share the output of an identical running command
+        if(defaults.coalesce_commands and coalesceSession(session)):
+            return
 
-                    # exit the child
-                    sys.exit(0)
-                else:
-                    ulgmodel.debug("Forked a new process PID: "+str(child_pid))
+        # hand the command over to the worker pool (ulg-worker.py)
+        if(defaults.worker_mode):
+            if(not ulgqueue.JobQueue().enqueue(session.getSessionId(),session.getRouter().getUsageKey())):
+                self.stopSessionOverlimit(session)
+            return
 
-            else:
-                # directly run the selected action, DEPRECATED
-                commandThreadBody(session,self.decreaseUsage)
-        else:
-            # stop and report no-op
+        # reject only when the wait queue of the router is full
+        if(ulgqueue.WaitQueue(session.getRouter().getUsageKey()).isFull()):
             self.stopSessionOverlimit(session)
             return
 
+        # start new thread if needed
+        if(defaults.always_start_thread or session.getRouter().getForkNeeded()):
+            # fork a daemon process (fork two times to decouple with parent)
+            sys.stdout.flush()
+            child_pid = os.fork()
+            if(child_pid == 0):
+                # exit the children even on exception, never return to the
+                # (possibly long-running) caller
+                try:
+                    # detach process
+                    devnull = open(os.devnull,'w')
+                    os.dup2(devnull.fileno(),1)
+                    os.dup2(devnull.fileno(),2)
+                    devnull.close()
+                    sys.stdout = sys.__stdout__
+                    sys.stderr = sys.__stderr__
+                    closeInheritedFiles()
+
+                    if(os.fork() == 0):
+                        try:
+                            # wait for the router and run the command
+                            ulgmodel.debug("Running in a forked process...")
+                            commandThreadBody(session)
+                            ulgmodel.debug("Forked process finished...")
+                        except Exception:
+                            ulgmodel.log("ERROR in the forked command process: "+traceback.format_exc())
+                        finally:
+                            os._exit(0)
+                finally:
+                    os._exit(0)
+            else:
+                # reap the intermediate child, the command runs in the grandchild
+                os.waitpid(child_pid,0)
+                ulgmodel.debug("Forked a new process PID: "+str(child_pid))
+
+        else:
+            # directly run the selected action, DEPRECATED
+            commandThreadBody(session)
+
 
     def renderULGIndex(self,routerid=0,commandid=0,sessionid=None):
         template = self.loader.load(defaults.index_template_file)
 
         return template.generate(defaults=defaults,
                                  routers=config.routers,
-                                 commonparams=self.getCommonParams(),
+                                 catalog_url=self.getCatalogURL(),
+                                 form_defaults=self.getFormDefaults(routerid,commandid),
                                  default_routerid=routerid,
                                  default_commandid=commandid,
                                  default_sessionid=sessionid,
@@ -562,36 +889,42 @@ class ULGCgi:
                                  ).render('html', doctype='html', encoding='utf-8')
 
 
-    def renderULGAction(self,routerid=0,commandid=0,sessionid=None,**moreparams):
+    def startSession(self,routerid=0,commandid=0,sessionid=None,**moreparams):
         routerid=int(routerid)
         commandid=int(commandid)
 
         # create and register session
-        session = Session(sessionid=sessionid,routerid=routerid,commandid=commandid)
-        session.clearResult()
-    
-        # extract parameters
-        session.cleanParameters()
-        for pidx,ps in enumerate(session.getCommand().getParamSpecs()):
-            if('param'+str(pidx) in moreparams.keys()):
-                session.addParameter(str(moreparams['param'+str(pidx)]))
-            else:
-                session.addParameter(ps.getDefault())
+        session = Session(sessionid=sessionid,routerid=routerid,commandid=commandid,autosave=False)
+        with session.transaction():
+            session.clearResult()
+
+            # extract parameters
+            session.cleanParameters()
+            for pidx,ps in enumerate(session.getCommand().getParamSpecs()):
+                if('param'+str(pidx) in moreparams.keys()):
+                    session.addParameter(str(moreparams['param'+str(pidx)]))
+                else:
+                    session.addParameter(ps.getDefault())
 
         # run the command (possibly in a separate process)
         self.runCommand(session)
 
+        return session
+
+
+    def renderULGAction(self,routerid=0,commandid=0,sessionid=None,**moreparams):
+        session = self.startSession(routerid,commandid,sessionid,**moreparams)
+
         # redirect to the session display
         return self.HTTPRedirect(self.decorator_helper.getDisplayURL(session.getSessionId()))
 
 
     def renderULGResult(self,sessionid=None,resrange=0):
-        def getRangeStepURLs(session,decorator_helper):
+        def getRangeStepURLs(session,max_range,decorator_helper):
             if(not session.showRange()):
                 return None
 
             cur_range = session.getRange()
-            max_range = session.getMaxRange()
 
             if(max_range < defaults.range_step):
                 return None
@@ -626,31 +959,49 @@ class ULGCgi:
         if(session == None):
             return self.HTTPRedirect(self.decorator_helper.getErrorURL())
 
+        # the display is read-only, the range lives only in the request
         session.setRange(int(resrange))
 
-        result_text = session.getDecoratedResult(self.decorator_helper,session.getRange(),session.isFinished())
+        if(session.isFinished()):
+            result_text,max_range = session.getDecoratedResult(self.decorator_helper,session.getRange(),session.isFinished())
+        else:
+            # follow the end of the output of the running command, the stream continues after it
+            max_range = 0
+            tail,tail_end = session.getResultTail(defaults.follow_lines)
+            result_text = self.decorator_helper.pre(cgi.escape('\n'.join(tail))) if(tail) else None
+
+            position = self.getQueuePosition(session)
+            if(position):
+                result_text = self.decorator_helper.pre(defaults.STRING_QUEUE_POSITION % position)
 
         if(session.isFinished()):
             refresh=None
+            stream_url=None
+            raw_url=self.decorator_helper.getRawURL(session.getSessionId())
         else:
+            raw_url=None
             if(result_text):
                 refresh = self.getRefreshInterval(len(result_text))
             else:
                 refresh = self.getRefreshInterval()
+            stream_url = self.decorator_helper.getStreamURL(session.getSessionId(),tail_end)
 
         template = self.loader.load(defaults.index_template_file)
         return template.generate(defaults=defaults,
                                  routers=config.routers,
-                                 commonparams=self.getCommonParams(),
+                                 catalog_url=self.getCatalogURL(),
+                                 form_defaults=self.getFormDefaults(session.getRouterId(),session.getCommandId(),session.getParameters()),
                                  default_routerid=session.getRouterId(),
                                  default_commandid=session.getCommandId(),
                                  default_params=session.getParameters(),
                                  default_sessionid=sessionid,
                                  result=Markup(result_text) if(result_text) else None,
                                  refresh=refresh,
+                                 stream_url=stream_url,
+                                 raw_url=raw_url,
                                  getFormURL=self.decorator_helper.getRuncommandURL,
                                  resrange=str(session.getRange()),
-                                 resrangeb=getRangeStepURLs(session,self.decorator_helper),
+                                 resrangeb=getRangeStepURLs(session,max_range,self.decorator_helper),
                                  user=self.user,
                                  ).render('html', doctype='html', encoding='utf-8')
 
@@ -665,7 +1016,8 @@ class ULGCgi:
 
         return template.generate(defaults=defaults,
                                  routers=config.routers,
-                                 commonparams=self.getCommonParams(),
+                                 catalog_url=self.getCatalogURL(),
+                                 form_defaults=self.getFormDefaults(),
                                  default_routerid=0,
                                  default_commandid=0,
                                  default_sessionid=None,
@@ -681,11 +1033,13 @@ class ULGCgi:
         result_text = "<h1>DEBUG</h1>\n<pre>\nPARAMS:\n"
         for k in params.keys():
             result_text = result_text + str(k) + "=" + str(params[k]) + "\n"
+        result_text = result_text + "\nUSAGE: %d/%d\n" % self.getUsage()
         result_test = result_text + "\n<pre>"
 
         return template.generate(defaults=defaults,
                                  routers=config.routers,
-                                 commonparams=self.getCommonParams(),
+                                 catalog_url=self.getCatalogURL(),
+                                 form_defaults=self.getFormDefaults(),
                                  default_routerid=0,
                                  default_commandid=0,
                                  default_sessionid=None,
@@ -696,6 +1050,185 @@ class ULGCgi:
                                  ).render('html', doctype='html', encoding='utf-8')
 
 
+    def printULGCatalog(self,version=None):
+        text,cversion,mtime = ulgmodel.loadCatalog(config.routers)
+        etag = '"'+cversion+'"'
+        lastmod = email.utils.formatdate(mtime,usegmt=True)
+
+        print "Content-Type: application/json"
+        print "ETag: "+etag
+        print "Last-Modified: "+lastmod
+        if(version == cversion):
+            # versioned URL never changes its content
+            print "Cache-Control: public, max-age=31536000"
+        else:
+            print "Cache-Control: no-cache"
+
+        inm = self.environ.get('HTTP_IF_NONE_MATCH',None)
+        ims = self.environ.get('HTTP_IF_MODIFIED_SINCE',None)
+        if((inm and (etag in inm or inm.strip() == '*')) or ((not inm) and ims == lastmod)):
+            print "Status: 304 Not Modified\n"
+            return
+
+        print ""
+        sys.stdout.write(text)
+
+    def getSessionState(self,session):
+        """ Return JSON serializable state of the session with the parsed result. """
+        result = None
+        position = None
+        if(session.isFinished()):
+            if(not session.getError()):
+                result = session.getCommand().parseResult(session)
+        else:
+            position = self.getQueuePosition(session)
+
+        return {'sessionid':session.getSessionId(),
+                'routerid':session.getRouterId(),
+                'commandid':session.getCommandId(),
+                'parameters':session.getParameters(),
+                'finished':session.isFinished(),
+                'queue_position':position,
+                'error':session.getError(),
+                'result':result,
+                'raw_url':self.decorator_helper.getRawURL(session.getSessionId()),
+                }
+
+    def printULGApi(self,routerid=None,commandid=None,sessionid=None,**moreparams):
+        """ Machine client interface: without parameters return the command catalog,
+        with routerid and commandid run the command, with sessionid return
+        the session state and the parsed result once the command finished. """
+        if(routerid != None and commandid != None):
+            session = self.startSession(routerid,commandid,None,**moreparams)
+        elif(sessionid != None):
+            session = loadSession(sessionid)
+            if(not session):
+                print "Status: 404 Not Found"
+                print "Content-Type: application/json\n"
+                print json.dumps({'error':defaults.STRING_SESSION_NOT_FOUND})
+                return
+        else:
+            print "Content-Type: application/json\n"
+            sys.stdout.write(ulgmodel.loadCatalog(config.routers)[0])
+            return
+
+        print "Content-Type: application/json"
+        print "Cache-Control: no-cache\n"
+        print json.dumps(self.getSessionState(session))
+
+    def streamULGResult(self,sessionid=None,offset=None):
+        """ Stream new output lines of a running session as Server-Sent Events.
+        Returns (status,headers,body iterator). Event IDs are byte offsets
+        in the session output, so a reconnecting client resumes where it stopped. """
+        def genEvents(sessionid,offset):
+            started = time.time()
+            keepalive = started
+            partial = ''
+            while(time.time() - started < defaults.stream_max_duration):
+                session = loadSession(sessionid)
+                if(session == None):
+                    return
+
+                # read the output only after checking state to not miss the tail
+                finished = session.isFinished()
+                data = session.readResult(offset+len(partial))
+                if(data):
+                    buf = partial + data
+                    # some drivers terminate lines by CR only
+                    eol = max(buf.rfind('\n'),buf.rfind('\r'))
+                    partial = buf[eol+1:]
+                    if(eol >= 0):
+                        offset = offset + eol + 1
+                        yield 'id: %d\n' % offset + ''.join(['data: '+l+'\n' for l in str.splitlines(buf[:eol+1])]) + '\n'
+                        keepalive = time.time()
+
+                if(finished):
+                    if(partial):
+                        yield 'id: %d\ndata: %s\n\n' % (offset+len(partial),partial)
+                    yield 'event: finished\ndata: \n\n'
+                    return
+
+                if(time.time() - keepalive > defaults.refresh_interval):
+                    yield ': keepalive\n\n'
+                    keepalive = time.time()
+
+                time.sleep(defaults.stream_interval)
+
+        try:
+            offset = int(offset) if offset else 0
+        except ValueError:
+            offset = 0
+
+        if((sessionid == None) or (loadSession(sessionid) == None)):
+            return ('404 Not Found',[('Content-Type','text/plain')],[defaults.STRING_ARBITRARY_ERROR])
+
+        return ('200 OK',[('Content-Type','text/event-stream'),('Cache-Control','no-cache')],genEvents(sessionid,offset))
+
+    def rawULGResult(self,sessionid=None,byterange=None):
+        """ Return (status,headers,body iterator) with the plain output of the session
+        read in blocks of defaults.raw_block_size bytes. A single byte range
+        (the HTTP Range header) is supported. Output of a running session is
+        returned up to its current size. """
+        def genBlocks(session,start,end):
+            while(start < end):
+                data = session.readResult(start,min(defaults.raw_block_size,end-start))
+                if(not data):
+                    return
+                start += len(data)
+                yield data
+
+        if(sessionid == None):
+            return ('404 Not Found',[('Content-Type','text/plain')],[defaults.STRING_SESSION_NOT_FOUND])
+        session = loadSession(sessionid)
+        if(session == None):
+            return ('404 Not Found',[('Content-Type','text/plain')],[defaults.STRING_SESSION_NOT_FOUND])
+
+        size = session.getResultSize()
+        headers = [('Content-Type','text/plain'),('Accept-Ranges','bytes')]
+        if(not session.isFinished()):
+            headers.append(('Cache-Control','no-cache'))
+
+        start,end = 0,size
+        m = byte_range_regexp.match(byterange) if(byterange) else None
+        if(m and (m.group(1) or m.group(2)) and
+           not (m.group(1) and m.group(2) and int(m.group(2)) < int(m.group(1)))):
+            if(not m.group(1)):
+                # suffix range: the last n bytes
+                start = max(0,size-int(m.group(2)))
+            else:
+                start = int(m.group(1))
+                if(m.group(2)):
+                    end = min(size,int(m.group(2))+1)
+
+            if(start >= end):
+                return ('416 Requested Range Not Satisfiable',headers+[('Content-Range','bytes */%d' % size)],[''])
+
+            return ('206 Partial Content',headers+[('Content-Range','bytes %d-%d/%d' % (start,end-1,size)),
+                                                   ('Content-Length',str(end-start))],
+                    genBlocks(session,start,end))
+
+        return ('200 OK',headers+[('Content-Length',str(size))],genBlocks(session,start,end))
+
+    def getStreamResponse(self,action,params,environ):
+        """ Return (status,headers,body iterator) for actions that stream their output
+        or None for all other actions. """
+        if(action == 'stream'):
+            return self.streamULGResult(params.get('sessionid',None),environ.get('HTTP_LAST_EVENT_ID',params.get('offset',None)))
+        elif(action == 'raw'):
+            return self.rawULGResult(params.get('sessionid',None),environ.get('HTTP_RANGE',None))
+        return None
+
+    def printStreamResponse(self,response):
+        print "Status: "+response[0]
+        for h in response[1]:
+            print h[0]+": "+h[1]
+        print ""
+        sys.stdout.flush()
+
+        for chunk in response[2]:
+            sys.stdout.write(chunk)
+            sys.stdout.flush()
+
     def getULGSpecialContent(self,sessionid,**params):
         if(sessionid==None):
             return self.HTTPRedirect(self.decorator_helper.getErrorURL())
@@ -748,6 +1281,18 @@ class ULGCgi:
     def getfile(self,sessionid=None,**params):
         self.getULGSpecialContent(sessionid,**params)
 
+    def stream(self,**params):
+        self.printStreamResponse(self.getStreamResponse('stream',params,self.environ))
+
+    def raw(self,**params):
+        self.printStreamResponse(self.getStreamResponse('raw',params,self.environ))
+
+    def catalog(self,version=None,**params):
+        self.printULGCatalog(version)
+
+    def api(self,**params):
+        self.printULGApi(**params)
+
     def whois(self,key,objtype=None):
         self.print_text_html()
         if(key):
@@ -763,6 +1308,37 @@ class ULGCgi:
         self.print_text_html()
         print self.renderULGDebug(**params)
 
+    def handleAction(self,action,params):
+        if(action):
+            if(action == 'index'):
+                self.index(**params)
+            elif(action == 'runcommand'):
+                self.runcommand(**params)
+            elif(action == 'display'):
+                self.display(**params)
+            elif(action == 'getfile'):
+                self.getfile(**params)
+            elif(action == 'whois'):
+                self.whois(**params)
+            elif(action == 'catalog'):
+                self.catalog(**params)
+            elif(action == 'stream'):
+                self.stream(**params)
+            elif(action == 'raw'):
+                self.raw(**params)
+            elif(action == 'api'):
+                self.api(**params)
+            elif(action == 'error'):
+                self.error(**params)
+            elif(action == 'debug'):
+                self.debug(**params)
+            else:
+                ulgmodel.log('ERROR: Unknown action called: '+action+'\n')
+                self.display(**params)
+
+        else:
+            self.index(**params)
+
 # main
 
 if __name__=="__main__":
@@ -780,27 +1356,7 @@ if __name__=="__main__":
             ulgmodel.log("Request from "+os.environ["REMOTE_ADDR"]+" with action="+str(action)+" params="+str(params)+'.')
         else:
             ulgmodel.log("Request from console with action="+str(action)+" params="+str(params)+'.')
-    
-        if(action):
-            if(action == 'index'):
-                handler.index(**params)
-            elif(action == 'runcommand'):
-                handler.runcommand(**params)
-            elif(action == 'display'):
-                handler.display(**params)
-            elif(action == 'getfile'):
-                handler.getfile(**params)
-            elif(action == 'whois'):
-                handler.whois(**params)
-            elif(action == 'error'):
-                handler.error(**params)
-            elif(action == 'debug'):
-                handler.debug(**params)
-            else:
-                ulgmodel.log('ERROR: Unknown action called: '+action+'\n')
-                handler.display(**params)
 
-        else:
-            handler.index(**params)
+        handler.handleAction(action,params)
     except Exception as e:
         ulgmodel.log("ERROR in CGI: "+traceback.format_exc())
@@ -20,6 +20,8 @@
 # Imports
 import os
 import socket
+import select
+import time
 import re
 import pexpect
 import hashlib
@@ -28,6 +30,7 @@ import defaults
 
 import ulgmodel
 import ulggraph
+import ulgcli
 
 IPV46_SUBNET_REGEXP = '^[0-9a-fA-F:\.]+(/[0-9]{1,2}){0,1}$'
 RTNAME_REGEXP = '^[a-zA-Z0-9]+$'
@@ -43,6 +46,9 @@ BIRD_SOCK_HEADER_REGEXP='^([0-9]+)[-\s](.+)$'
 BIRD_SOCK_REPLY_END_REGEXP='^([0-9]+)\s*(\s.*)?$'
 
 BIRD_CONSOLE_PROMPT_REGEXP='[^>]+>\s*'
+# prompt of interactive birdc at the beginning of a line (readline may prepend escape sequences)
+BIRD_CLI_PROMPT_REGEXP='(?m)^(\x1b\[[0-9;?]*[a-zA-Z])*bird>'
+bird_cli_prompt_regexp = re.compile(BIRD_CLI_PROMPT_REGEXP)
 
 
 BIRD_SHOW_PROTO_LINE_REGEXP='^\s*([^\s]+)\s+([^\s]+)\s+([^\s]+)\s+([^\s]+)\s+([^\s]+)(\s+([^\s].+)){0,1}\s*$'
@@ -209,6 +215,14 @@ class BirdShowProtocolsCommand(ulgmodel.TextCommand):
 
             return (ulgmodel.TableDecorator(table,table_header).decorate(),pr[2])
 
+    def parseResult(self,session):
+        if(session.getResult() == None):
+            return None
+
+        pr = parseBirdShowProtocols(session.getResult())
+        return {'header':list(pr[0]),
+                'table':[tl for tl in pr[1] if (not self.fltr) or re.match(self.fltr,tl[1])]}
+
 
 class AbstractBGPPeerSelectCommand(ulgmodel.TextCommand):
     """ Abstract class for all BIRD BGP peer-specific commands """
@@ -225,6 +239,13 @@ class BirdShowProtocolsAllCommand(AbstractBGPPeerSelectCommand):
 
 
 class AbstractRouteTableCommand(ulgmodel.TextCommand):
+    TABLE_HEADER = ['Prefix',
+                    'Next-hop',
+                    'Interface',
+                    'Since',
+                    'Status',
+                    'Metric',
+                    'Info',]
 
     def _decorateOriginAS(self,asfield,decorator_helper):
         # expected input is "[AS28171i]"
@@ -234,7 +255,7 @@ class AbstractRouteTableCommand(ulgmodel.TextCommand):
         else:
             return asfield
 
-    def _genTable(self,table_lines,decorator_helper,router):
+    def _parseTable(self,table_lines):
         def matchBIRDBGPRTLine(line):
             m = bird_rt_line_regexp.match(line)
             if(m):
@@ -243,9 +264,11 @@ class AbstractRouteTableCommand(ulgmodel.TextCommand):
                 ulgmodel.debug("BirdShowRouteProtocolCommand: Can not parse line: "+line)
                 return None
 
+        return [ml for ml in [matchBIRDBGPRTLine(tl) for tl in table_lines] if ml]
+
+    def _genTable(self,table_lines,decorator_helper,router):
         result = []
-        for tl in table_lines:
-            ml=matchBIRDBGPRTLine(tl)
+        for ml in self._parseTable(table_lines):
             if(ml):
                 # generate table content
                 result.append([
@@ -264,28 +287,28 @@ class AbstractRouteTableCommand(ulgmodel.TextCommand):
         if(not session):
             raise Exception("Can not decorate result without valid session.")
 
-	if(session.getResult() == None):
+	if(not session.hasResult()):
             return (decorator_helper.pre(defaults.STRING_EMPTY), 1)
 
         if((not session.getRouter()) or (not decorator_helper)):
             return "<pre>\n%s\n</pre>" % session.getResult()
 
         table=[]
-        table_header=['Prefix',
-                      'Next-hop',
-                      'Interface',
-                      'Since',
-                      'Status',
-                      'Metric',
-                      'Info',]
-
-        lines = str.splitlines(session.getResult())
-        result_len = len(lines)
-        lines = lines[session.getRange():session.getRange()+defaults.range_step]
+        table_header=self.TABLE_HEADER
+
+        result_len = session.getResultLineCount()
+        lines = session.getResultLines(session.getRange(),defaults.range_step)
         table = self._genTable(lines,decorator_helper,session.getRouter())
 
         return (ulgmodel.TableDecorator(table,table_header).decorate(),result_len)
 
+    def parseResult(self,session):
+        if(session.getResult() == None):
+            return None
+
+        return {'header':self.TABLE_HEADER,
+                'table':[list(ml) for ml in self._parseTable(str.splitlines(session.getResult()))]}
+
 
 
 
@@ -365,6 +388,9 @@ class BirdGraphShowRouteAll(ulgmodel.TextCommand):
         else:
             return ('',0)
 
+    def parseResult(self,session):
+        return {'paths':session.getData()}
+
     def getSpecialContent(self,session,**params):
         paths = session.getData()
         print "Content-type: image/png\n"
@@ -402,7 +428,9 @@ class BirdRouter(ulgmodel.Router):
                 ]
 
     def rescanPeers(self):
-        res = self.runRawSyncCommand(self.RESCAN_PEERS_COMMAND)
+        self.bgp_peers = self.parseBGPPeers(self.runRawSyncCommand(self.RESCAN_PEERS_COMMAND))
+
+    def parseBGPPeers(self,res):
         psp = parseBirdShowProtocols(res)
 
         peers = []
@@ -410,18 +438,30 @@ class BirdRouter(ulgmodel.Router):
             if(re.match(self.proto_fltr,pspl[1])):
                 peers.append(pspl[0])
 
-        self.bgp_peers = sorted(peers)
+        return sorted(peers)
 
     def rescanRoutingTables(self):
-        res = self.runRawSyncCommand(self.RESCAN_TABLES_COMMAND)
+        self.routing_tables = self.parseRoutingTables(self.runRawSyncCommand(self.RESCAN_TABLES_COMMAND))
 
+    def parseRoutingTables(self,res):
         tables = []
         for l in str.splitlines(res):
             m = bird_show_symbols_line_regexp.match(l)
             if(m and m.group(2).lstrip().rstrip() == STRING_SYMBOL_ROUTING_TABLE):
                 tables.append(m.group(1))
 
-        self.routing_tables = sorted(tables)
+        return sorted(tables)
+
+    def rescanPeersAndTables(self):
+        """ Rescan the peers and the routing tables in one session. """
+        self.setPeersAndTables(self.runRawBatch(self.getRescanCommands()))
+
+    def getRescanCommands(self):
+        return [self.RESCAN_PEERS_COMMAND,self.RESCAN_TABLES_COMMAND]
+
+    def setPeersAndTables(self,res):
+        self.bgp_peers = self.parseBGPPeers(res[0])
+        self.routing_tables = self.parseRoutingTables(res[1])
 
     def getBGPPeers(self):
         if(not self.bgp_peers):
@@ -459,7 +499,153 @@ class BirdRouter(ulgmodel.Router):
 
 
 
+def parseBirdSockLine(line):
+    hm = bird_sock_header_regexp.match(line)
+    if(hm):
+        # first line of the reply
+        return (int(hm.group(1)),hm.group(2))
+
+    em = bird_sock_reply_end_regexp.match(line)
+    if(em):
+        # most likely the last line of the reply
+        return (int(em.group(1)),None)
+
+    if(line[0] == '+'):
+        # ignore async reply
+        return (None,None)
+
+    if(line[0] == ' '):
+        # return reply line as it is (remove padding)
+        return (None,line[1:])
+
+    raise Exception("Can not parse BIRD output line: "+line)
+
+def isBirdSockReplyEnd(code):
+    if(code==None):
+        return False
+
+    if(code == 0):
+        # end of reply
+        return True
+    elif(code == 13):
+        # show status last line
+        return True
+    elif(code == 8001):
+        # network not in table end
+        return True
+    elif(code >= 9000):
+        # probably error
+        return True
+    else:
+        return False
+
+
+class BirdSocketConnection(object):
+    """ Connection to the BIRD control socket past the greeting, kept in
+    ulgcli.pool between commands. BIRD answers the commands on one
+    connection one by one, the reply ends by isBirdSockReplyEnd(). """
+
+    def __init__(self,sock):
+        self.sock = sock
+        self.s = None
+        self.sf = None
+        self.slots = None
+        self.last_use = time.time()
+        self.commands = 0
+        self.retry = False
+
+    def login(self):
+        # open socket to BIRD
+        self.s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.s.settimeout(defaults.default_bird_sock_timeout)
+        self.s.connect(self.sock)
+
+        # cretate FD for the socket
+        self.sf = self.s.makefile()
+
+        # wait for initial header
+        if(not self.sf.readline()):
+            raise Exception("BIRD closed the control socket "+self.sock+".")
+
+    def check(self):
+        """ An idle connection has nothing to read, a readable one has been
+        closed by BIRD (or carries unexpected data). """
+        if(not self.s):
+            return False
+
+        try:
+            return (not select.select([self.s],[],[],0)[0])
+        except (socket.error,select.error,ValueError):
+            return False
+
+    def runCommand(self,command,outfile):
+        """ Send command and write its reply to outfile. """
+        written = False
+        self.retry = False
+
+        try:
+            # send the command string
+            self.sf.write(command+"\n")
+            self.sf.flush()
+
+            # read and capture lines until the output delimiter string is hit
+            while(True):
+                l = self.sf.readline()
+                if(not l):
+                    raise Exception("BIRD closed the control socket "+self.sock+".")
+
+                ulgmodel.debug("Raw line read: " + l)
+
+                # process line according to rules take out from the C code
+                lp = parseBirdSockLine(l)
+                if(lp[1]):
+                    ulgmodel.debug("Read line after normalize: " + lp[1])
+                    outfile.write(lp[1].rstrip()+"\n")
+                    written = True
+
+                if(isBirdSockReplyEnd(lp[0])):
+                    # End of reply (0000 or similar code)
+                    ulgmodel.debug("End of reply. Code="+str(lp[0]))
+                    break
+        except socket.timeout:
+            raise
+        except Exception:
+            # a reused connection closed by BIRD before any output
+            self.retry = ((self.commands > 0) and (not written))
+            raise
+
+        self.commands += 1
+        self.last_use = time.time()
+
+    def canRetry(self):
+        return self.retry
+
+    def getLastUse(self):
+        return self.last_use
+
+    def setSlots(self,slots):
+        self.slots = slots
+
+    def isPooled(self):
+        return (self.slots != None)
+
+    def close(self):
+        if(self.s):
+            try:
+                self.s.close()
+            except socket.error:
+                pass
+            self.s = None
+            self.sf = None
+
+        if(self.slots):
+            self.slots.release()
+            self.slots = None
+
+
 class BirdRouterLocal(ulgmodel.LocalRouter,BirdRouter):
+    TRANSPORT = 'socket'
+
     def __init__(self,sock=defaults.default_bird_sock,commands=None,proto_fltr=None,asn='My ASN',name='localhost',acl=None):
         ulgmodel.LocalRouter.__init__(self,acl=acl)
         BirdRouter.__init__(self)
@@ -472,8 +658,9 @@ class BirdRouterLocal(ulgmodel.LocalRouter,BirdRouter):
         else:
             self.proto_fltr = self.DEFAULT_PROTOCOL_FLTR
 
-        self.rescanPeers()
-        self.rescanRoutingTables()
+        # the routers are constructed also by the processes that do not run
+        # commands, do not leave a pooled connection there
+        self.setPeersAndTables(ulgcli.runBatch(self.getCLISession,self.getRescanCommands()))
 
         # command autoconfiguration might run only after other parameters are set
         if(commands):
@@ -482,92 +669,15 @@ class BirdRouterLocal(ulgmodel.LocalRouter,BirdRouter):
             self.setCommands(self._getDefaultCommands())
 
 
-    def runRawCommand(self,command,outfile):
-        def parseBirdSockLine(line):
-            hm = bird_sock_header_regexp.match(line)
-            if(hm):
-                # first line of the reply
-                return (int(hm.group(1)),hm.group(2))
-
-            em = bird_sock_reply_end_regexp.match(line)
-            if(em):
-                # most likely the last line of the reply
-                return (int(em.group(1)),None)
-
-            if(line[0] == '+'):
-                # ignore async reply
-                return (None,None)
-
-            if(line[0] == ' '):
-                # return reply line as it is (remove padding)
-                return (None,line[1:])
-
-            raise Exception("Can not parse BIRD output line: "+line)
-
-        def isBirdSockReplyEnd(code):
-            if(code==None):
-                return False
-
-            if(code == 0):
-                # end of reply
-                return True
-            elif(code == 13):
-                # show status last line
-                return True
-            elif(code == 8001):
-                # network not in table end
-                return True
-            elif(code >= 9000):
-                # probably error
-                return True
-            else:
-                return False
-
-#        try:
-        # open socket to BIRD
-        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        s.settimeout(defaults.default_bird_sock_timeout)
-        s.connect(self.sock)
+    def getCLISession(self):
+        """ New (not yet connected) connection to the BIRD control socket. """
+        return BirdSocketConnection(self.sock)
 
-        # cretate FD for the socket
-        sf=s.makefile()
-
-        # wait for initial header
-        l = sf.readline()
-
-        # send the command string
-        sf.write(command+"\n")
-        sf.flush()
-
-        # read and capture lines until the output delimiter string is hit
-        while(True):
-            l = sf.readline()
-
-            ulgmodel.debug("Raw line read: " + l)
-
-            # process line according to rules take out from the C code
-            lp = parseBirdSockLine(l)
-            if(isBirdSockReplyEnd(lp[0])):
-                # End of reply (0000 or similar code)
-                ulgmodel.debug("End of reply. Code="+str(lp[0]))
-
-                if(lp[1]):
-                    ulgmodel.debug("Last read line after normalize: " + lp[1])
-                    outfile.write(lp[1].rstrip()+"\n")
-                break
-            else:
-                if(lp[1]):
-                    ulgmodel.debug("Read line after normalize: " + lp[1])
-                    outfile.write(lp[1].rstrip()+"\n")
-                else:
-                    ulgmodel.debug("Read line was empty after normalize.")
-
-        # close the socket and return captured result
-        s.close()
+    def runRawCommand(self,command,outfile):
+        ulgcli.pool.runCommand(self.getUsageKey(),self.getCLISession,command,outfile)
 
-#        except socket.timeout as e:
-#            # catch only timeout exception, while letting other exceptions pass
-#            outfile.result(defaults.STRING_SOCKET_TIMEOUT)
+    def runRawBatch(self,commands):
+        return ulgcli.pool.runBatch(self.getUsageKey(),self.getCLISession,commands)
 
     def getForkNeeded(self):
         return False
@@ -619,8 +729,17 @@ class BirdRouterRemote(ulgmodel.RemoteRouter,BirdRouter):
     def getForkNeeded(self):
         return True
 
+    def getCLISession(self):
+        """ New (not yet logged in) interactive birdc session over ssh with a tty. """
+        return ulgcli.CLISession(self.getSSHCommand(self.bin_ssh+' -t')+' '+self.bin_birdc,self.password,
+                                 bird_cli_prompt_regexp,[],STRING_LOGOUT_COMMAND)
+
+    def runRawBatch(self,commands):
+        """ Run commands in one birdc session, the outputs are split at the prompt. """
+        return [o.replace('\r','') for o in ulgcli.pool.runBatch(self.getUsageKey(),self.getCLISession,commands)]
+
     def runRawCommand(self,command,outfile):
-        c = '/bin/bash -c \'echo "'+command+'" | '+self.bin_ssh+' -p'+str(self.getPort())+' '+str(self.getUser())+'@'+self.getHost()+' '+self.bin_birdc+'\''
+        c = '/bin/bash -c \'echo "'+command+'" | '+self.getSSHCommand(self.bin_ssh)+' '+self.bin_birdc+'\''
         skiplines = 2
         s=pexpect.spawn(c,timeout=defaults.timeout)
 
@@ -683,6 +802,5 @@ class BirdRouterRemote(ulgmodel.RemoteRouter,BirdRouter):
 
 
     def rescanHook(self):
-        self.rescanPeers()
-        self.rescanRoutingTables()
+        self.rescanPeersAndTables()
         self.savePersistentInfo()
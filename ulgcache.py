@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+#
+# ULG - Universal Looking Glass
+# (C) 2012 CZ.NIC, z.s.p.o.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# Imports
+import os
+import time
+import pickle
+import hashlib
+
+import defaults
+
+import ulgmodel
+
+### Command result cache
+
+CACHE_FILE_SUFFIX = '.cache'
+PAGE_FILE_SUFFIX = '.page'
+
+def getCacheKey(router,command_text):
+    return hashlib.md5(router.getName()+'\n'+command_text).hexdigest()
+
+def getPageKey(sessionid,outputid,output_size,resrange):
+    """ The key changes whenever the output of the session changes. """
+    return hashlib.md5('\n'.join([sessionid,outputid,str(output_size),str(resrange),str(defaults.range_step)])).hexdigest()
+
+class ResultCache(object):
+    """ Results of finished commands keyed by the router and the normalized
+    command text. Entries expire after the TTL of the command, the least
+    recently used entries are evicted when the cache exceeds its size. """
+    SUFFIX = CACHE_FILE_SUFFIX
+
+    def __init__(self,cache_dir=defaults.result_cache_dir,size=defaults.result_cache_size):
+        self.cache_dir = cache_dir
+        self.size = size
+
+        if(not os.path.isdir(self.cache_dir)):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                # created by another process in the meantime
+                pass
+
+    def _getFileName(self,key):
+        return os.path.join(self.cache_dir,key+self.SUFFIX)
+
+    def get(self,key,ttl):
+        """ Return (result,data) of a fresh entry or None. """
+        entry = self._load(key)
+        if((not entry) or (time.time() - entry['created']) > ttl):
+            return None
+
+        self._touch(key)
+        return (entry['result'],entry['data'])
+
+    def _load(self,key):
+        fn = self._getFileName(key)
+        try:
+            f = open(fn,'rb')
+            entry = pickle.load(f)
+            f.close()
+        except (IOError,EOFError,pickle.UnpicklingError):
+            return None
+
+        return entry
+
+    def _touch(self,key):
+        """ Mark the entry as recently used. """
+        try:
+            os.utime(self._getFileName(key),None)
+        except OSError:
+            pass
+
+    def _store(self,key,entry):
+        fn = self._getFileName(key)
+        tmpname = fn+'.'+str(os.getpid())+'.tmp'
+        try:
+            f = open(tmpname,'wb')
+            pickle.dump(entry,f,pickle.HIGHEST_PROTOCOL)
+            f.close()
+            os.rename(tmpname,fn)
+        except (IOError,OSError,pickle.PicklingError) as e:
+            ulgmodel.log("Saving to cache failed: "+str(e))
+            return
+
+        self.evict()
+
+    def put(self,key,result,data=None):
+        self._store(key,{'created':time.time(),'result':result,'data':data})
+
+    def evict(self):
+        """ Remove the least recently used entries over the size of the cache. """
+        entries = []
+        total = 0
+        for f in os.listdir(self.cache_dir):
+            if(not f.endswith(self.SUFFIX)):
+                continue
+            try:
+                st = os.stat(os.path.join(self.cache_dir,f))
+            except OSError:
+                continue
+            entries.append((st.st_mtime,st.st_size,f))
+            total += st.st_size
+
+        for (mtime,size,f) in sorted(entries):
+            if(total <= self.size):
+                break
+            try:
+                os.unlink(os.path.join(self.cache_dir,f))
+            except OSError:
+                pass
+            total -= size
+
+
+class PageCache(ResultCache):
+    """ Decorated pages of finished sessions keyed by getPageKey(). The result
+    of a finished session does not change, so the entries do not expire, only
+    the least recently used entries are evicted. """
+    SUFFIX = PAGE_FILE_SUFFIX
+
+    def __init__(self,cache_dir=defaults.page_cache_dir,size=defaults.page_cache_size):
+        ResultCache.__init__(self,cache_dir,size)
+
+    def get(self,key):
+        """ Return (decorated result,number of result lines or table rows) or None. """
+        entry = self._load(key)
+        if(not entry):
+            return None
+
+        self._touch(key)
+        return (entry['text'],entry['max_range'])
+
+    def put(self,key,text,max_range):
+        self._store(key,{'text':text,'max_range':max_range})
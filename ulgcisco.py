@@ -19,7 +19,6 @@
 
 # Imports
 import os
-import pexpect
 import re
 import sys
 import string
@@ -29,10 +28,9 @@ import defaults
 
 import ulgmodel
 import ulggraph
+import ulgcli
 
 # module globals
-STRING_EXPECT_SSH_NEWKEY='Are you sure you want to continue connecting'
-STRING_EXPECT_PASSWORD='(P|p)assword:'
 STRING_EXPECT_SHELL_PROMPT_REGEXP = '\n[a-zA-Z0-9\._-]+(>|#)'
 BGP_IPV6_SUM_TABLE_SPLITLINE_REGEXP='^\s*[0-9a-fA-F:]+\s*$'
 IPV46_ADDR_REGEXP = '^[0-9a-fA-F:\.]+$'
@@ -48,6 +46,11 @@ BGP_PREFIX_TABLE_HEADER='^(\s)\s+(Network)\s+(Next Hop)\s+(Metric)\s+(LocPrf)\s+
 RESCAN_BGP_IPv4_COMMAND='show bgp ipv4 unicast summary'
 RESCAN_BGP_IPv6_COMMAND='show bgp ipv6 unicast summary'
 
+# table pages are read by lines, search for the header by this number of lines
+# and read this margin around the page for table entries wrapped to several lines
+TABLE_HEADER_SEARCH_STEP = 64
+TABLE_PAGE_MARGIN = 16
+
 MAC_ADDRESS_REGEXP = '^[0-9a-fA-F]{4}\.[0-9a-fA-F]{4}\.[0-9a-fA-F]{4}$'
 
 BGP_RED_STATES = ['Idle', 'Active', '(NoNeg)']
@@ -316,6 +319,30 @@ router splits on the header boundary."""
             
     return result
 
+def parseBGPSumResult(text,table_header_regexp,table_line_regexp):
+    """ Parse show bgp ... summary to the text before the table, the table header and the table. """
+    before=''
+    table=[]
+    table_header=[]
+
+    tb = False
+    header_regexp = re.compile(table_header_regexp)
+    line_regexp = re.compile(table_line_regexp)
+    for l in normalizeBGPIPv6SumSplitLines(str.splitlines(text)):
+        if(tb):
+            lrm = line_regexp.match(l)
+            if(lrm):
+                table.append([g for g in lrm.groups()])
+        else:
+            thrm = header_regexp.match(l)
+            if(thrm):
+                tb = True
+                table_header = [g for g in thrm.groups()]
+            else:
+                before = before + l + '\n'
+
+    return {'before':before,'header':table_header,'table':table}
+
 # classes
 
 class CiscoCommandBgpIPv46Sum(ulgmodel.TextCommand):
@@ -445,6 +472,12 @@ class CiscoCommandBgpIPv46Sum(ulgmodel.TextCommand):
 
         return (ulgmodel.TableDecorator(table,table_header,before=decorator_helper.pre(before)).decorate(),result_len)
 
+    def parseResult(self,session):
+        if(session.getResult() == None):
+            return None
+
+        return parseBGPSumResult(session.getResult(),self.TABLE_HEADER_REGEXP,self.TABLE_LINE_REGEXP)
+
 
 class CiscoCommandBgpIPv4Sum(CiscoCommandBgpIPv46Sum):
     COMMAND_TEXT='show bgp ipv4 unicast summary'
@@ -476,10 +509,101 @@ class CiscoCommandShowBgpIPv6Neigh(ulgmodel.TextCommand):
     def __init__(self,router,name=None):
         ulgmodel.TextCommand.__init__(self,self.COMMAND_TEXT,param_specs=[router.getBGPIPv6Select()],name=name)
 
-class CiscoCommandShowBgpIPv46Select(ulgmodel.TextCommand):
+class CiscoBGPPrefixTableCommand(ulgmodel.TextCommand):
+    """ Common base of the commands producing the BGP prefix table (IOS and IOS XR). """
     TABLE_HEADER_REGEXP=BGP_PREFIX_TABLE_HEADER
     LASTLINE_REGEXP='^\s*Total number of prefixes [0-9]+\s*$'
 
+    def _splitResult(self,lines):
+        """ Split result lines to the text before the table, the table header description,
+        the table lines and the last line after the table. """
+        before=''
+        after=None
+        table_header_descr=[]
+
+        tb = False
+        header_regexp = re.compile(self.TABLE_HEADER_REGEXP)
+        lastline_regexp = re.compile(self.LASTLINE_REGEXP)
+        table_lines = []
+        for l in lines:
+            if(tb):
+                # inside table body
+                if(lastline_regexp.match(l)):
+                    after = l
+                else:
+                    table_lines.append(l)
+
+            else:
+                # should we switch to table body?
+                thrm = header_regexp.match(l)
+                if(thrm):
+                    # set header accoring to the local router alignment
+                    # include (unnamed) states (=S)
+                    self.table_header = 'S'+(l[1:].replace('Next Hop','Next_Hop',1))
+                    tb = True
+                    table_header_descr = [g for g in thrm.groups()]
+                else:
+                    # not yet in the table body, append before-table section
+                    before = before + l + '\n'
+
+        return (before,table_header_descr,table_lines,after)
+
+    def _readTablePage(self,session,start,count):
+        """ Read the text before the table, the table header description, the table
+        lines from start-TABLE_PAGE_MARGIN to start+count+TABLE_PAGE_MARGIN, the position
+        of start in these lines, the last line after the table and the number of
+        the table lines. Only the lines needed are read using the line index. """
+        header_regexp = re.compile(self.TABLE_HEADER_REGEXP)
+        lastline_regexp = re.compile(self.LASTLINE_REGEXP)
+        total = session.getResultLineCount()
+
+        # the table header is expected near the beginning of the result
+        head = []
+        found = False
+        while((not found) and len(head) < total):
+            lines = session.getResultLines(len(head),TABLE_HEADER_SEARCH_STEP)
+            if(not lines):
+                break
+            for l in lines:
+                head.append(l)
+                if(header_regexp.match(l)):
+                    found = True
+                    break
+
+        before,table_header_descr,table_lines,after = self._splitResult(head)
+        if(not found):
+            return (before,table_header_descr,[],0,after,0)
+
+        table_start = len(head)
+        table_end = total
+        if(table_end > table_start):
+            last = session.getResultLines(total-1,1)
+            if(last and lastline_regexp.match(last[0])):
+                after = last[0]
+                table_end = total-1
+        table_len = table_end-table_start
+
+        # table entries can be wrapped to several lines, read a margin around the page
+        ps = max(0,start-TABLE_PAGE_MARGIN)
+        pe = min(table_len,start+count+TABLE_PAGE_MARGIN)
+        if(pe <= ps):
+            return (before,table_header_descr,[],0,after,table_len)
+
+        return (before,table_header_descr,session.getResultLines(table_start+ps,pe-ps),start-ps,after,table_len)
+
+    def parseResult(self,session):
+        if(session.getResult() == None):
+            return None
+
+        before,table_header_descr,table_lines,after = self._splitResult(str.splitlines(session.getResult()))
+        table = []
+        if(table_lines):
+            table = matchCiscoBGPLines(self.table_header,table_lines)
+
+        return {'before':before,'header':table_header_descr,'table':table,'after':after}
+
+
+class CiscoCommandShowBgpIPv46Select(CiscoBGPPrefixTableCommand):
     def __init__(self,peer_select_param,name=None):
         ulgmodel.TextCommand.__init__(self,self.COMMAND_TEXT,param_specs=[peer_select_param],name=name)
 
@@ -544,47 +668,19 @@ class CiscoCommandShowBgpIPv46Select(ulgmodel.TextCommand):
         if(not session):
             raise Exception("Can not decorate result without valid session passed.")
 
-	if(session.getResult() == None):
+	if(not session.hasResult()):
             return (decorator_helper.pre(defaults.STRING_EMPTY), 1)
 
         if((not session.getRouter()) or (not decorator_helper)):
             return "<pre>\n%s\n</pre>" % session.getResult()
 
-        lines = str.splitlines(session.getResult())
-
-        before=''
-        after=None
         table=[]
-        table_header_descr=[]
-
-        tb = False
-        header_regexp = re.compile(self.TABLE_HEADER_REGEXP)
-        lastline_regexp = re.compile(self.LASTLINE_REGEXP)
-        table_lines = []
-        for l in lines:
-            if(tb):
-                # inside table body
-                if(lastline_regexp.match(l)):
-                    after = l
-                else:
-                    table_lines.append(l)
+        before,table_header_descr,table_lines,page_start,after,result_len = self._readTablePage(session,
+                                                                                                session.getRange(),
+                                                                                                defaults.range_step)
 
-            else:
-                # should we switch to table body?
-                thrm = header_regexp.match(l)
-                if(thrm):
-                    # set header accoring to the local router alignment
-                    # include (unnamed) states (=S)
-                    self.table_header = 'S'+(l[1:].replace('Next Hop','Next_Hop',1))
-                    tb = True
-                    table_header_descr = [g for g in thrm.groups()]
-                else:
-                    # not yet in the table body, append before-table section
-                    before = before + l + '\n'
-
-        result_len = len(table_lines)
-        if(table_lines):
-            table = self._genTable(restrict(table_lines,session.getRange(),defaults.range_step),
+        if(page_start < len(table_lines)):
+            table = self._genTable(restrict(table_lines,page_start,defaults.range_step),
                                    decorator_helper,session.getRouter())
 
         if(after):
@@ -593,6 +689,7 @@ class CiscoCommandShowBgpIPv46Select(ulgmodel.TextCommand):
         return (ulgmodel.TableDecorator(table,table_header_descr,before=decorator_helper.pre(before),
                                        after=after).decorate(),result_len)
 
+
         
 class CiscoCommandShowBgpIPv4NeighAdv(CiscoCommandShowBgpIPv46Select):
     COMMAND_TEXT='show bgp ipv4 unicast neighbor %s advertised'
@@ -638,6 +735,9 @@ class CiscoCommandGraphShowBgpIPv46Uni(ulgmodel.TextCommand):
     def finishHook(self,session):
 	    session.setData(cisco_parse_sh_bgp_uni(session.getResult(),str(session.getRouter().getASN())))
 
+    def parseResult(self,session):
+        return {'paths':session.getData()}
+
     def getSpecialContent(self,session,**params):
         paths = session.getData()
         print "Content-type: image/png\n"
@@ -833,8 +933,9 @@ class CiscoRouter(ulgmodel.RemoteRouter):
         return True
 
     def rescanBGPPeers(self,command,regexp):
-        table = self.runRawSyncCommand(command)
+        return self.parseBGPPeers(self.runRawSyncCommand(command),regexp)
 
+    def parseBGPPeers(self,table,regexp):
         peers = []
         rlr = re.compile(regexp)
 	lines = normalizeBGPIPv6SumSplitLines(str.splitlines(table))
@@ -853,8 +954,10 @@ class CiscoRouter(ulgmodel.RemoteRouter):
         self.bgp_ipv6_peers = self.rescanBGPPeers(RESCAN_BGP_IPv6_COMMAND,BGP_IPV46_TABLE_LINE_REGEXP)
         
     def rescanHook(self):
-        self.rescanBGPIPv4Peers()
-        self.rescanBGPIPv6Peers()
+        # both summaries are read in one session
+        tables = self.runRawBatch([RESCAN_BGP_IPv4_COMMAND,RESCAN_BGP_IPv6_COMMAND])
+        self.bgp_ipv4_peers = self.parseBGPPeers(tables[0],BGP_IPV46_TABLE_LINE_REGEXP)
+        self.bgp_ipv6_peers = self.parseBGPPeers(tables[1],BGP_IPV46_TABLE_LINE_REGEXP)
         self.saveBGPPeers()
 
     def getBGPIPv4Peers(self):
@@ -889,65 +992,13 @@ class CiscoRouter(ulgmodel.RemoteRouter):
         if(not self.getBGPIPv4Peers()) or (not self.getBGPIPv6Peers()):
             self.rescanHook()
 
+    def getCLISession(self):
+        """ New (not yet logged in) CLI session to the router. """
+        return ulgcli.CLISession(self.getSSHCommand(),self.password,STRING_EXPECT_SHELL_PROMPT_REGEXP,
+                                 ['terminal length 0','terminal width 0'],STRING_COMMAND_LOGOUT)
+
     def runRawCommand(self,command,outfile):
-        skiplines=1
-
-	# connect
-        c=defaults.bin_ssh+' -p'+str(self.getPort())+' '+str(self.getUser())+'@'+self.getHost()
-        s=pexpect.spawn(c,timeout=defaults.timeout)
-
-##      Debug logging
-#	s.logfile = open('/tmp/ulgcisco.log', 'w')
-
-	y=0
-	p=0
-        # handle ssh
-	while True:
-		i=s.expect([STRING_EXPECT_SSH_NEWKEY,STRING_EXPECT_PASSWORD,
-			    STRING_EXPECT_SHELL_PROMPT_REGEXP,pexpect.EOF,pexpect.TIMEOUT])
-		if(i==0):
-			if(y>1):
-				raise Exception("pexpect session failed: Can not save SSH key.")
-
-			s.sendline('yes')
-			y+=1
-
-		elif(i==1):
-			if(p>1):
-				raise Exception("pexpect session failed: Password not accepted.")
-
-			s.sendline(self.password)
-			p+=1
-		elif(i==2): # prompt
-			break
-		elif(i==3):
-			raise Exception("pexpect session failed: Remote server disconnected.")
-		elif(i==4):
-			raise Exception("pexpect session failed: Connection timeout.")
-		else:
-			raise Exception("pexpect session failed: Unknown error. last output: "+s.before)
-
-	s.sendline('terminal length 0')
-	s.expect(['\n',pexpect.EOF,pexpect.TIMEOUT])
-
-	s.sendline('terminal width 0')
-	s.expect(['\n',pexpect.EOF,pexpect.TIMEOUT])
-
-	l=0
-	s.sendline(command)
-	while True:
-		i=s.expect([STRING_EXPECT_SHELL_PROMPT_REGEXP,'\n',pexpect.EOF,pexpect.TIMEOUT])
-		if(i==0): # prompt
-			s.sendline(STRING_COMMAND_LOGOUT)
-			s.expect(['\n',pexpect.EOF,pexpect.TIMEOUT])
-			break
-		elif(i==1): # anything to capture
-			if(l>=skiplines):
-				outfile.write(s.before + "\n")
-			l+=1
-		elif(i==2):
-			raise Exception("pexpect session failed: Remote server disconnected.")
-		elif(i==3):
-			raise Exception("pexpect session failed: Connection timeout.")
-		else:
-			raise Exception("pexpect session failed: Unknown error. last output: "+s.before)
+        ulgcli.pool.runCommand(self.getUsageKey(),self.getCLISession,command,outfile)
+
+    def runRawBatch(self,commands):
+        return ulgcli.pool.runBatch(self.getUsageKey(),self.getCLISession,commands)
@@ -21,7 +21,6 @@
 
 # Imports
 import os
-import pexpect
 import re
 import sys
 import string
@@ -31,10 +30,10 @@ import defaults
 
 import ulgmodel
 import ulggraph
+import ulgcli
+import ulgcisco
 
 # module globals
-STRING_EXPECT_SSH_NEWKEY='Are you sure you want to continue connecting'
-STRING_EXPECT_PASSWORD='(P|p)assword:'
 STRING_EXPECT_SHELL_PROMPT_REGEXP = '[a-zA-Z0-9:\/\._-]+#'
 BGP_IPV6_SUM_TABLE_SPLITLINE_REGEXP='^\s*[0-9a-fA-F:]+\s*$'
 IPV46_ADDR_REGEXP = '^[0-9a-fA-F:\.]+$'
@@ -446,6 +445,12 @@ class CiscoCommandBgpIPv46Sum(ulgmodel.TextCommand):
 
         return (ulgmodel.TableDecorator(table,table_header,before=decorator_helper.pre(before)).decorate(),result_len)
 
+    def parseResult(self,session):
+        if(session.getResult() == None):
+            return None
+
+        return ulgcisco.parseBGPSumResult(session.getResult(),self.TABLE_HEADER_REGEXP,self.TABLE_LINE_REGEXP)
+
 
 class CiscoCommandBgpIPv4Sum(CiscoCommandBgpIPv46Sum):
     COMMAND_TEXT='show bgp ipv4 unicast summary'
@@ -489,10 +494,7 @@ class CiscoCommandShowBgpIPv6Neigh(ulgmodel.TextCommand):
     def __init__(self,router,name=None):
         ulgmodel.TextCommand.__init__(self,self.COMMAND_TEXT,param_specs=[router.getBGPIPv6Select()],name=name)
 
-class CiscoCommandShowBgpIPv46Select(ulgmodel.TextCommand):
-    TABLE_HEADER_REGEXP=BGP_PREFIX_TABLE_HEADER
-    LASTLINE_REGEXP='^\s*Total number of prefixes [0-9]+\s*$'
-
+class CiscoCommandShowBgpIPv46Select(ulgcisco.CiscoBGPPrefixTableCommand):
     def __init__(self,peer_select_param,name=None):
         ulgmodel.TextCommand.__init__(self,self.COMMAND_TEXT,param_specs=[peer_select_param],name=name)
 
@@ -557,47 +559,19 @@ class CiscoCommandShowBgpIPv46Select(ulgmodel.TextCommand):
         if(not session):
             raise Exception("Can not decorate result without valid session passed.")
 
-	if(session.getResult() == None):
+	if(not session.hasResult()):
             return (decorator_helper.pre(defaults.STRING_EMPTY), 1)
 
         if((not session.getRouter()) or (not decorator_helper)):
             return "<pre>\n%s\n</pre>" % session.getResult()
 
-        lines = str.splitlines(session.getResult())
-
-        before=''
-        after=None
         table=[]
-        table_header_descr=[]
-
-        tb = False
-        header_regexp = re.compile(self.TABLE_HEADER_REGEXP)
-        lastline_regexp = re.compile(self.LASTLINE_REGEXP)
-        table_lines = []
-        for l in lines:
-            if(tb):
-                # inside table body
-                if(lastline_regexp.match(l)):
-                    after = l
-                else:
-                    table_lines.append(l)
+        before,table_header_descr,table_lines,page_start,after,result_len = self._readTablePage(session,
+                                                                                                session.getRange(),
+                                                                                                defaults.range_step)
 
-            else:
-                # should we switch to table body?
-                thrm = header_regexp.match(l)
-                if(thrm):
-                    # set header accoring to the local router alignment
-                    # include (unnamed) states (=S)
-                    self.table_header = 'S'+(l[1:].replace('Next Hop','Next_Hop',1))
-                    tb = True
-                    table_header_descr = [g for g in thrm.groups()]
-                else:
-                    # not yet in the table body, append before-table section
-                    before = before + l + '\n'
-
-        result_len = len(table_lines)
-        if(table_lines):
-            table = self._genTable(restrict(table_lines,session.getRange(),defaults.range_step),
+        if(page_start < len(table_lines)):
+            table = self._genTable(restrict(table_lines,page_start,defaults.range_step),
                                    decorator_helper,session.getRouter())
 
         if(after):
@@ -606,6 +580,7 @@ class CiscoCommandShowBgpIPv46Select(ulgmodel.TextCommand):
         return (ulgmodel.TableDecorator(table,table_header_descr,before=decorator_helper.pre(before),
                                        after=after).decorate(),result_len)
 
+
         
 class CiscoCommandShowBgpIPv4NeighAdv(CiscoCommandShowBgpIPv46Select):
     COMMAND_TEXT='show bgp ipv4 unicast neighbor %s advertised'
@@ -651,6 +626,9 @@ class CiscoCommandGraphShowBgpIPv46Uni(ulgmodel.TextCommand):
     def finishHook(self,session):
 	    session.setData(cisco_parse_sh_bgp_uni(session.getResult(),str(session.getRouter().getASN())))
 
+    def parseResult(self,session):
+        return {'paths':session.getData()}
+
     def getSpecialContent(self,session,**params):
         paths = session.getData()
         print "Content-type: image/png\n"
@@ -846,8 +824,9 @@ class CiscoXRRouter(ulgmodel.RemoteRouter):
         return True
 
     def rescanBGPPeers(self,command,regexp,ipv6=True):
-        table = self.runRawSyncCommand(command)
+        return self.parseBGPPeers(self.runRawSyncCommand(command),regexp,ipv6)
 
+    def parseBGPPeers(self,table,regexp,ipv6=True):
         peers = []
         rlr = re.compile(regexp)
         if ipv6:
@@ -868,8 +847,10 @@ class CiscoXRRouter(ulgmodel.RemoteRouter):
         self.bgp_ipv6_peers = self.rescanBGPPeers(RESCAN_BGP_IPv6_COMMAND,BGP_IPV46_TABLE_LINE_REGEXP,True)
         
     def rescanHook(self):
-        self.rescanBGPIPv4Peers()
-        self.rescanBGPIPv6Peers()
+        # both summaries are read in one session
+        tables = self.runRawBatch([RESCAN_BGP_IPv4_COMMAND,RESCAN_BGP_IPv6_COMMAND])
+        self.bgp_ipv4_peers = self.parseBGPPeers(tables[0],BGP_IPV46_TABLE_LINE_REGEXP,False)
+        self.bgp_ipv6_peers = self.parseBGPPeers(tables[1],BGP_IPV46_TABLE_LINE_REGEXP,True)
         self.saveBGPPeers()
 
     def getBGPIPv4Peers(self):
@@ -904,65 +885,14 @@ class CiscoXRRouter(ulgmodel.RemoteRouter):
         if(not self.getBGPIPv4Peers()) or (not self.getBGPIPv6Peers()):
             self.rescanHook()
 
+    def getCLISession(self):
+        """ New (not yet logged in) CLI session to the router. """
+        return ulgcli.CLISession(self.getSSHCommand(),self.password,STRING_EXPECT_SHELL_PROMPT_REGEXP,
+                                 ['terminal length 0','terminal width 0'],STRING_COMMAND_LOGOUT,
+                                 logfile='/tmp/ulgciscoxr.log')
+
     def runRawCommand(self,command,outfile):
-        skiplines=1
-
-	# connect
-        c=defaults.bin_ssh+' -p'+str(self.getPort())+' '+str(self.getUser())+'@'+self.getHost()
-        s=pexpect.spawn(c,timeout=defaults.timeout)
-
-##      Debug logging
-	s.logfile = open('/tmp/ulgciscoxr.log', 'w')
-
-	y=0
-	p=0
-        # handle ssh
-	while True:
-		i=s.expect([STRING_EXPECT_SSH_NEWKEY,STRING_EXPECT_PASSWORD,
-			    STRING_EXPECT_SHELL_PROMPT_REGEXP,pexpect.EOF,pexpect.TIMEOUT])
-		if(i==0):
-			if(y>1):
-				raise Exception("pexpect session failed: Can not save SSH key.")
-
-			s.sendline('yes')
-			y+=1
-
-		elif(i==1):
-			if(p>1):
-				raise Exception("pexpect session failed: Password not accepted.")
-
-			s.sendline(self.password)
-			p+=1
-		elif(i==2): # prompt
-			break
-		elif(i==3):
-			raise Exception("pexpect session failed: Remote server disconnected.")
-		elif(i==4):
-			raise Exception("pexpect session failed: Connection timeout.")
-		else:
-			raise Exception("pexpect session failed: Unknown error. last output: "+s.before)
-	
-	s.sendline('terminal length 0')
-	s.expect([STRING_EXPECT_SHELL_PROMPT_REGEXP,pexpect.EOF,pexpect.TIMEOUT])
-
-	s.sendline('terminal width 0')
-	s.expect([STRING_EXPECT_SHELL_PROMPT_REGEXP,pexpect.EOF,pexpect.TIMEOUT])
-
-	l=0
-	s.sendline(command)
-	while True:
-		i=s.expect([STRING_EXPECT_SHELL_PROMPT_REGEXP,'\n',pexpect.EOF,pexpect.TIMEOUT])
-		if(i==0): # prompt
-			s.sendline(STRING_COMMAND_LOGOUT)
-			s.expect(['\n',pexpect.EOF,pexpect.TIMEOUT])
-			break
-		elif(i==1): # anything to capture
-			if(l>=skiplines):
-				outfile.write(s.before + "\n")
-			l+=1
-		elif(i==2):
-			raise Exception("pexpect session failed: Remote server disconnected.")
-		elif(i==3):
-			raise Exception("pexpect session failed: Connection timeout.")
-		else:
-			raise Exception("pexpect session failed: Unknown error. last output: "+s.before)
+        ulgcli.pool.runCommand(self.getUsageKey(),self.getCLISession,command,outfile)
+
+    def runRawBatch(self,commands):
+        return ulgcli.pool.runBatch(self.getUsageKey(),self.getCLISession,commands)
@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+#
+# ULG - Universal Looking Glass
+# (C) 2012 CZ.NIC, z.s.p.o.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# Imports
+import os
+import time
+import StringIO
+import pexpect
+
+import defaults
+
+import ulgmodel
+
+STRING_EXPECT_SSH_NEWKEY='Are you sure you want to continue connecting'
+STRING_EXPECT_PASSWORD='(P|p)assword:'
+
+
+class CLISession(object):
+    """ Interactive CLI session of a router (ssh to Cisco IOS or IOS XR),
+    logged in, set up and waiting at the prompt between commands. Other
+    connections kept in CLISessionPool (ulgbird.BirdSocketConnection)
+    implement the same methods. """
+
+    def __init__(self,command,password,prompt_regexp,setup_commands=[],logout_command='exit',logfile=None):
+        self.command = command
+        self.password = password
+        self.prompt_regexp = prompt_regexp
+        self.setup_commands = setup_commands
+        self.logout_command = logout_command
+        self.logfile = logfile
+        self.s = None
+        self.slots = None
+        self.last_use = time.time()
+        self.commands = 0
+        self.retry = False
+
+    def login(self):
+        s=pexpect.spawn(self.command,timeout=defaults.timeout)
+        self.s = s
+        if(self.logfile):
+            s.logfile = open(self.logfile,'w')
+
+        y=0
+        p=0
+        # handle ssh
+        while True:
+            i=s.expect([STRING_EXPECT_SSH_NEWKEY,STRING_EXPECT_PASSWORD,
+                        self.prompt_regexp,pexpect.EOF,pexpect.TIMEOUT])
+            if(i==0):
+                if(y>1):
+                    raise Exception("pexpect session failed: Can not save SSH key.")
+
+                s.sendline('yes')
+                y+=1
+            elif(i==1):
+                if(p>1):
+                    raise Exception("pexpect session failed: Password not accepted.")
+
+                s.sendline(self.password)
+                p+=1
+            elif(i==2): # prompt
+                break
+            elif(i==3):
+                raise Exception("pexpect session failed: Remote server disconnected.")
+            elif(i==4):
+                raise Exception("pexpect session failed: Connection timeout.")
+            else:
+                raise Exception("pexpect session failed: Unknown error. last output: "+s.before)
+
+        for c in self.setup_commands:
+            s.sendline(c)
+            if(s.expect([self.prompt_regexp,pexpect.EOF,pexpect.TIMEOUT]) != 0):
+                raise Exception("pexpect session failed: Setup command "+c+" did not return to the prompt.")
+
+    def check(self):
+        """ Health check of an idle session: the router answers an empty line
+        with the prompt. """
+        if((not self.s) or (not self.s.isalive())):
+            return False
+
+        try:
+            self.s.sendline('')
+            return (self.s.expect([self.prompt_regexp,pexpect.EOF,pexpect.TIMEOUT],
+                                  timeout=defaults.cli_session_check_timeout) == 0)
+        except (OSError,pexpect.ExceptionPexpect):
+            return False
+
+    def runCommand(self,command,outfile,skiplines=1):
+        """ Run command and write its output to outfile. The session is left
+        at the prompt, an exception is raised when it is not usable anymore. """
+        s = self.s
+        l=0
+        self.retry = False
+        s.sendline(command)
+        while True:
+            i=s.expect([self.prompt_regexp,'\n',pexpect.EOF,pexpect.TIMEOUT])
+            if(i==0): # prompt
+                break
+            elif(i==1): # anything to capture
+                if(l>=skiplines):
+                    outfile.write(s.before + "\n")
+                l+=1
+            elif(i==2):
+                # a reused session closed by the router before any output
+                self.retry = ((self.commands > 0) and (l <= skiplines))
+                raise Exception("pexpect session failed: Remote server disconnected.")
+            elif(i==3):
+                raise Exception("pexpect session failed: Connection timeout.")
+            else:
+                raise Exception("pexpect session failed: Unknown error. last output: "+s.before)
+
+        self.commands += 1
+        self.last_use = time.time()
+
+    def canRetry(self):
+        """ The last command failed because the router closed the reused
+        session before the command produced any output. """
+        return self.retry
+
+    def getLastUse(self):
+        return self.last_use
+
+    def setSlots(self,slots):
+        self.slots = slots
+
+    def isPooled(self):
+        return (self.slots != None)
+
+    def close(self):
+        if(self.s):
+            try:
+                if(self.s.isalive()):
+                    self.s.sendline(self.logout_command)
+                    self.s.expect(['\n',pexpect.EOF,pexpect.TIMEOUT],timeout=defaults.cli_session_check_timeout)
+                self.s.close(force=True)
+            except (OSError,pexpect.ExceptionPexpect):
+                pass
+            if(self.s.logfile):
+                self.s.logfile.close()
+            self.s = None
+
+        if(self.slots):
+            self.slots.release()
+            self.slots = None
+
+
+class CLISessionPool(object):
+    """ Logged-in CLI sessions kept open by the process for the next commands
+    on the same router. A pooled session holds one of defaults.cli_session_max
+    usage slots of the router, sessions beyond the cap are closed after the
+    command as before. A command that fails because the router closed the
+    reused session is run once more over a new session. Sessions are kept
+    only in the processes that enable pooling (setPooling()), elsewhere they
+    are closed after the command or the batch. """
+
+    def __init__(self,pooling=False):
+        self.pooling = pooling
+        self.idle = {}
+        self.pid = os.getpid()
+        self.inherited = []
+
+    def _checkPid(self):
+        if(self.pid != os.getpid()):
+            # sessions and slots of the parent process, keep them referenced
+            # so that the garbage collector does not terminate the parent's ssh
+            for sessions in self.idle.values():
+                for s in sessions:
+                    if(s.slots):
+                        s.slots.detach()
+                        s.slots = None
+                    self.inherited.append(s)
+            self.idle = {}
+            self.pid = os.getpid()
+
+    def expireIdle(self):
+        """ Close the sessions unused for defaults.cli_session_idle_timeout seconds,
+        called before each command and periodically by idle workers. """
+        self._checkPid()
+        now = time.time()
+        for key in self.idle.keys():
+            keep = []
+            for s in self.idle[key]:
+                if(now - s.getLastUse() > defaults.cli_session_idle_timeout):
+                    ulgmodel.debug("Closing idle CLI session of router "+key+".")
+                    s.close()
+                else:
+                    keep.append(s)
+            self.idle[key] = keep
+
+    def acquire(self,key,factory):
+        """ Get a healthy idle session of router key or log in a new one
+        created by factory. """
+        self.expireIdle()
+
+        sessions = self.idle.get(key,[])
+        while sessions:
+            s = sessions.pop()
+            if(s.check()):
+                ulgmodel.debug("Reusing CLI session of router "+key+".")
+                return s
+            ulgmodel.debug("Dropping broken CLI session of router "+key+".")
+            s.close()
+
+        s = factory()
+        if(self.pooling and defaults.cli_session_pool):
+            slots = ulgmodel.UsageSlots(limit=defaults.cli_session_max,prefix='ulg-cli-'+key)
+            if(slots.acquire()):
+                s.setSlots(slots)
+        try:
+            s.login()
+        except:
+            s.close()
+            raise
+        return s
+
+    def release(self,key,session):
+        """ Return a session that finished its command at the prompt. """
+        if(session.isPooled() and (self.pid == os.getpid())):
+            self.idle.setdefault(key,[]).append(session)
+        else:
+            session.close()
+
+    def _runCommand(self,key,factory,s,command,outfile):
+        """ Run command over session s, return the session to be used next. """
+        try:
+            s.runCommand(command,outfile)
+            return s
+        except:
+            s.close()
+            if(not s.canRetry()):
+                raise
+
+        ulgmodel.debug("Reconnecting closed session of router "+key+".")
+        s = self.acquire(key,factory)
+        try:
+            s.runCommand(command,outfile)
+        except:
+            s.close()
+            raise
+        return s
+
+    def runCommand(self,key,factory,command,outfile):
+        s = self.acquire(key,factory)
+        s = self._runCommand(key,factory,s,command,outfile)
+        self.release(key,s)
+
+    def runBatch(self,key,factory,commands):
+        """ Run commands one after another in one session, the outputs are
+        split at the prompt (the end of the reply), return the list of them. """
+        outputs = []
+        s = self.acquire(key,factory)
+        for c in commands:
+            out = StringIO.StringIO()
+            s = self._runCommand(key,factory,s,c,out)
+            outputs.append(out.getvalue())
+        self.release(key,s)
+        return outputs
+
+    def setPooling(self,pooling):
+        self.pooling = pooling
+
+    def closeAll(self):
+        self._checkPid()
+        for sessions in self.idle.values():
+            for s in sessions:
+                s.close()
+        self.idle = {}
+
+
+def runBatch(factory,commands):
+    """ Run commands in a new session created by factory, the session is
+    closed afterwards and it is never pooled. """
+    s = factory()
+    try:
+        s.login()
+        outputs = []
+        for c in commands:
+            out = StringIO.StringIO()
+            s.runCommand(c,out)
+            outputs.append(out.getvalue())
+        return outputs
+    finally:
+        s.close()
+
+
+# one pool per process, the sessions are kept for the following commands
+# only in the long-lived ulg-worker.py workers that enable pooling, a CGI
+# or ulgwsgi.py command runs in a forked process that exits after it
+pool = CLISessionPool()
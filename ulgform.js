@@ -0,0 +1,123 @@
+// ULG - Universal Looking Glass
+// (C) 2012 CZ.NIC, z.s.p.o.
+//
+// This program is free software: you can redistribute it and/or modify
+// it under the terms of the GNU General Public License as published by
+// the Free Software Foundation, either version 3 of the License, or
+// (at your option) any later version.
+//
+// Command form built from the command catalog (action=catalog) and
+// the streamed display of a running command (action=stream).
+// The page defines ulg_catalog_url and ulg_form_defaults before loading
+// the catalog and ulg_stream_url and ulg_refresh for a running command.
+
+var ulg_catalog = null;
+
+function escapeHTML(s)
+{
+  return String(s).replace(/&/g,'&amp;').replace(/</g,'&lt;').replace(/>/g,'&gt;').replace(/"/g,'&quot;').replace(/'/g,'&#39;');
+}
+
+function loadCatalog()
+{
+  var req = new XMLHttpRequest();
+  req.onreadystatechange = function() {
+    if((req.readyState == 4) && (req.status == 200)) {
+      ulg_catalog = JSON.parse(req.responseText);
+      updateFormCommands();
+    }
+  };
+  req.open("GET", ulg_catalog_url, true);
+  req.send(null);
+}
+
+function getSelectedValue(id)
+{
+  var s=document.getElementById(id);
+  if(s.selectedIndex < 0) {
+    return null;
+  }
+  return parseInt(s.options[s.selectedIndex].value);
+}
+
+function updateFormParams()
+{
+  var ridx=getSelectedValue("routerselect");
+  var cidx=getSelectedValue("commandselect");
+  if((ulg_catalog == null) || (ridx == null) || (cidx == null)) {
+    return;
+  }
+
+  var params=ulg_catalog.routers[ridx].commands[cidx].params;
+  var usedefaults=((ridx == ulg_form_defaults.routerid) && (cidx == ulg_form_defaults.commandid));
+  var html='';
+
+  for(var pidx=0; pidx < params.length; pidx++) {
+    var p=params[pidx];
+    var value=p['default'];
+    if(usedefaults && (pidx < ulg_form_defaults.params.length)) {
+      value=ulg_form_defaults.params[pidx];
+    }
+
+    html+='<fieldset><label for="param'+pidx+'">'+(pidx+3)+'. '+escapeHTML(p.name)+':</label>';
+    if((p.type == 'select') || (p.type == 'commonselect')) {
+      var options=(p.type == 'commonselect') ? ulg_catalog.common[p.ref] : p.options;
+      html+='<select name="param'+pidx+'" id="param'+pidx+'">';
+      for(var oidx=0; oidx < options.length; oidx++) {
+        html+='<option value="'+escapeHTML(options[oidx][0])+'"';
+        if(options[oidx][0] == value) {
+          html+=' selected="selected"';
+        }
+        html+='>'+escapeHTML(options[oidx][1])+'</option>';
+      }
+      html+='</select>';
+    }
+    else {
+      html+='<input type="text" name="param'+pidx+'" id="param'+pidx+'" value="'+escapeHTML(value)+'" onfocus="this.className=\'hover\'" onblur="this.className=\'out\'" />';
+    }
+    html+='</fieldset>';
+  }
+
+  document.getElementById("paramsect").innerHTML=html;
+}
+
+function updateFormCommands()
+{
+  var ridx=getSelectedValue("routerselect");
+  if((ulg_catalog == null) || (ridx == null)) {
+    return;
+  }
+
+  var commands=ulg_catalog.routers[ridx].commands;
+  var cs=document.getElementById("commandselect");
+  cs.options.length=0;
+  for(var cidx=0; cidx < commands.length; cidx++) {
+    var selected=((ridx == ulg_form_defaults.routerid) && (cidx == ulg_form_defaults.commandid));
+    cs.options[cidx]=new Option(commands[cidx].name, cidx, selected, selected);
+  }
+
+  updateFormParams();
+}
+
+function followResult()
+{
+  if(typeof(ulg_stream_url) == 'undefined') {
+    return;
+  }
+
+  if(!window.EventSource) {
+    // fall back to the periodic reload
+    setTimeout(function() { window.location.reload(); }, ulg_refresh*1000);
+    return;
+  }
+
+  var out=document.getElementById("resultstream");
+  var es=new EventSource(ulg_stream_url);
+  es.onmessage=function(e) {
+    out.appendChild(document.createTextNode(e.data+"\n"));
+  };
+  es.addEventListener("finished", function(e) {
+    es.close();
+    window.location.reload();
+  }, false);
+}
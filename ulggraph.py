@@ -18,6 +18,9 @@
 
 
 # Imports
+import sys
+import tempfile
+
 import defaults
 
 import gv
@@ -107,4 +110,10 @@ def bgp_graph_gen(graphdata,start=None,end=None):
 	dot = write(gr)
 	gvv = gv.readstring(dot)
 	gv.layout(gvv,'dot')
-	gv.render(gvv,'png')
+
+	# render through a temporary file and write the image to sys.stdout
+	# so that the output can be captured when running in the application server
+	tmp = tempfile.NamedTemporaryFile(suffix='.png')
+	gv.render(gvv,'png',tmp.name)
+	sys.stdout.write(tmp.read())
+	tmp.close()
@@ -118,6 +118,18 @@ def juniper_reduce_paths(paths):
 
     return sorted(paths,key=assign_value)
 
+class JuniperShowBgpSum(ulgmodel.TextCommand):
+    COMMAND_TEXT = 'show bgp summary'
+
+    def __init__(self,name=None):
+        ulgmodel.TextCommand.__init__(self,self.COMMAND_TEXT,name=name)
+
+    def parseResult(self,session):
+        if(session.getResult() == None):
+            return None
+
+        return {'peers':jun_parse_show_bgp_sum(session.getResult())}
+
 class JuniperShowBgpNeigh(ulgmodel.TextCommand):
     COMMAND_TEXT='show bgp neighbor %s'
 
@@ -158,6 +170,9 @@ class JuniperGraphShowRoute(ulgmodel.TextCommand):
     def finishHook(self,session):
         session.setData(juniper_parse_sh_route(session.getResult(),str(session.getRouter().getASN())))
 
+    def parseResult(self,session):
+        return {'paths':session.getData()}
+
     def decorateResult(self,session,decorator_helper=None):
         if(session.isFinished()):
             if(session.getData() != None) and (session.getData() != []):
@@ -216,7 +231,7 @@ class JuniperRouter(ulgmodel.RemoteRouter):
 
     def _getDefaultCommands(self):
         return [ulgmodel.TextCommand('show version'),
-                ulgmodel.TextCommand('show bgp summary'),
+                JuniperShowBgpSum(),
                 JuniperShowRoute(),
                 JuniperShowBgpNeigh(self),
                 JuniperShowRouteBgpRecv(self),
@@ -268,6 +283,8 @@ class JuniperRouter(ulgmodel.RemoteRouter):
 
 
 class JuniperRouterRemoteTelnet(JuniperRouter):
+    TRANSPORT = 'telnet'
+
     def __init__(self,host,user,password='',port=23,commands=None,asn='My ASN',name=None):
         JuniperRouter.__init__(self,host=host,user=user,password=password,port=port,commands=commands,asn=asn,name=name)
 
@@ -340,7 +357,7 @@ class JuniperRouterRemoteSSH(JuniperRouter):
 
 
     def runRawCommand(self,command,outfile):
-        c = defaults.bin_ssh+' -p'+str(self.getPort())+' '+str(self.getUser())+'@'+self.getHost()
+        c = self.getSSHCommand()
         s=pexpect.spawn(c,timeout=defaults.timeout)
 
 #        s.logfile = open('/tmp/ulgjuni.log', 'w')
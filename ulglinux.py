@@ -60,7 +60,7 @@ class LinuxRouterLocal(ulgmodel.LocalRouter,LinuxRouter):
         while True:
             i=s.expect(['\n',pexpect.EOF,pexpect.TIMEOUT])
             if (i==0):
-                outfile.write(s.before)
+                outfile.write(s.before+"\n")
             elif (i==1):
                 break
             elif (i==2):
@@ -102,7 +102,7 @@ class LinuxRouterRemote(ulgmodel.RemoteRouter,LinuxRouter):
         return True
 
     def runRawCommand(self,command,outfile):
-        c = '/bin/bash -c \''+self.bin_ssh+' -p'+str(self.getPort())+' '+str(self.getUser())+'@'+self.getHost()+' "'+command+'"\''
+        c = '/bin/bash -c \''+self.getSSHCommand(self.bin_ssh)+' "'+command+'"\''
         s=pexpect.spawn(c,timeout=defaults.timeout)
 
         # handle ssh
@@ -125,7 +125,7 @@ class LinuxRouterRemote(ulgmodel.RemoteRouter,LinuxRouter):
                 s.sendline(self.password)
                 p+=1
             elif(i==2):
-                outfile.write(s.before)
+                outfile.write(s.before+"\n")
             elif(i==3): # EOF -> process output
                 break
             elif(i==4):
@@ -20,6 +20,8 @@
 # Imports
 import os
 import re
+import errno
+import inspect
 import sys
 from time import localtime, strftime
 from genshi.template import TemplateLoader
@@ -28,6 +30,8 @@ import pickle
 import fcntl
 import StringIO
 import socket
+import json
+import hashlib
 
 import whois
 import defaults
@@ -37,6 +41,7 @@ IPV4_SUBNET_REGEXP = '^[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}(/[0-9]{1,2
 IPV4_ADDRESS_REGEXP = '^[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}$'
 IPV6_SUBNET_REGEXP = '^[0-9a-fA-F:]+(/[0-9]{1,2}){0,1}$'
 IPV6_ADDRESS_REGEXP = '^[0-9a-fA-F:]+$'
+SSH_CONTROL_FILE_REGEXP = '^ulg-ssh-[0-9a-f]+\.sock$'
 
 def log(*messages):
     try:
@@ -59,6 +64,19 @@ def import_config():
     del sys.path[-1]
     return module
 
+# process-wide template loader, keeps the compiled templates cached
+template_loader = None
+
+def getTemplateLoader():
+    global template_loader
+    if(template_loader == None):
+        template_loader = TemplateLoader(
+            os.path.join(os.path.dirname(__file__), defaults.template_dir),
+            auto_reload=(not defaults.production)
+            )
+
+    return template_loader
+
 def annotateAS(asn):
     return asn+' | '+whois.lookup_as_name(asn)
 
@@ -98,6 +116,158 @@ def loadPersistentStorage(filename=defaults.persistent_storage_file):
         return PersistentStorage()
 
 
+class UsageSlots(object):
+    """ Admission control for concurrently running commands. Each running
+    command holds an exclusive flock on one of limit slot files. The kernel
+    drops the lock when the holding process exits, so a crashed or killed
+    command can not leak its slot. """
+
+    def __init__(self,slot_dir=defaults.usage_slot_dir,limit=defaults.usage_limit,prefix='ulg'):
+        self.slot_dir = slot_dir
+        self.limit = limit
+        self.prefix = prefix
+        self.held = []
+
+        if(not os.path.isdir(self.slot_dir)):
+            try:
+                os.makedirs(self.slot_dir)
+            except OSError:
+                # created by another process in the meantime
+                pass
+
+    def _getSlotFileName(self,idx):
+        return os.path.join(self.slot_dir,self.prefix+'-'+str(idx)+'.slot')
+
+    def _tryLock(self,idx):
+        f = open(self._getSlotFileName(idx),'a')
+        try:
+            fcntl.flock(f,fcntl.LOCK_EX|fcntl.LOCK_NB)
+            return f
+        except IOError:
+            f.close()
+            return None
+
+    def acquire(self):
+        """ Take a free slot, return False when all slots are taken. """
+        for idx in range(0,self.limit):
+            try:
+                f = self._tryLock(idx)
+            except IOError as e:
+                log("Locking mechanism failure: "+str(e))
+                return False
+            if(f):
+                self.held.append(f)
+                return True
+        return False
+
+    def release(self):
+        """ Free the last slot taken by this process. """
+        if(self.held):
+            f = self.held.pop()
+            fcntl.flock(f,fcntl.LOCK_UN)
+            f.close()
+
+    def detach(self):
+        """ Forget slots handed over to a forked child without unlocking them,
+        the child keeps the slots until it exits. """
+        for f in self.held:
+            f.close()
+        self.held = []
+
+    def getOccupancy(self):
+        """ Number of slots currently taken by any process. """
+        occupied = 0
+        for idx in range(0,self.limit):
+            f = self._tryLock(idx)
+            if(f):
+                fcntl.flock(f,fcntl.LOCK_UN)
+                f.close()
+            else:
+                occupied += 1
+        return occupied
+
+    def getLimit(self):
+        return self.limit
+
+
+def buildCatalog(routers):
+    """ Compile routers, commands and parameter specifications into a dict
+    that is served to the web form as JSON document. """
+    def paramDefault(ps):
+        d = ps.getDefault()
+        if(isinstance(d,tuple)):
+            return d[0]
+        return d
+
+    common = {}
+    catalog_routers = []
+    for ridx,r in enumerate(routers):
+        commands = []
+        for cidx,c in enumerate(r.listCommands()):
+            params = []
+            for ps in c.getParamSpecs():
+                p = {'type':ps.getType(),'name':ps.getName(),'default':paramDefault(ps)}
+                if(ps.getType() == 'commonselect'):
+                    p['ref'] = ps.getID()
+                    common[ps.getID()] = [list(o) for o in ps.getOptions()]
+                elif(ps.getType() == 'select'):
+                    p['options'] = [list(o) for o in ps.getOptions()]
+                params.append(p)
+            commands.append({'id':cidx,'name':c.getName(),'params':params})
+        catalog_routers.append({'id':ridx,'name':r.getName(),'commands':commands})
+
+    return {'routers':catalog_routers,'common':common}
+
+def saveCatalog(routers,filename=defaults.catalog_file):
+    text = json.dumps(buildCatalog(routers),sort_keys=True)
+
+    tmpfn = filename+'.'+str(os.getpid())
+    f = open(tmpfn,'w')
+    f.write(text)
+    f.close()
+    os.rename(tmpfn,filename)
+
+    return text
+
+# cached catalog (text,version,mtime)
+catalog_cache = None
+
+def loadCatalog(routers,filename=defaults.catalog_file):
+    """ Return (text,version,mtime) of the catalog. The file is read again
+    only when its mtime differs from the cached one, then the catalog is
+    rebuilt when the file is missing or older than the config file. """
+    global catalog_cache
+
+    try:
+        mtime = os.path.getmtime(filename)
+    except OSError as e:
+        if(e.errno != errno.ENOENT):
+            raise
+        mtime = None
+
+    if(catalog_cache and catalog_cache[2] == mtime):
+        return catalog_cache
+
+    try:
+        if(mtime != None and mtime < os.path.getmtime(defaults.config_file)):
+            mtime = None
+    except OSError:
+        # the routers are already loaded, the catalog file is still usable
+        pass
+
+    if(mtime == None):
+        debug("Rebuilding command catalog "+filename)
+        saveCatalog(routers,filename)
+        mtime = os.path.getmtime(filename)
+
+    f = open(filename,'r')
+    text = f.read()
+    f.close()
+
+    catalog_cache = (text,hashlib.md5(text).hexdigest(),mtime)
+    return catalog_cache
+
+
 class TableDecorator(object):
     WHITE = 'white'
     RED = 'red'
@@ -113,10 +283,7 @@ class TableDecorator(object):
         self.before = before
         self.after = after
 
-        self.loader=TemplateLoader(
-            os.path.join(os.path.dirname(__file__), defaults.template_dir),
-            auto_reload=True
-            )
+        self.loader=getTemplateLoader()
 
     def decorate(self):
         def preprocessTableCell(td):
@@ -373,19 +540,26 @@ class TextCommand(object):
         pass
 
     def decorateResult(self,session,decorator_helper=None):
-        if(session.getResult() == None):
+        if(not session.hasResult()):
             return (decorator_helper.pre(defaults.STRING_EMPTY), 1)
         if(session.getRange() != None and self.showRange()):
-            s = str.splitlines(session.getResult())
+            # read only the requested page using the line index of the result
             r=''
-            for sl in s[session.getRange():session.getRange()+defaults.range_step+1]:
+            for sl in session.getResultLines(session.getRange(),defaults.range_step+1):
                 r += sl + "\n"
                 r = r.replace('<','&lt;').replace('>','&gt;')
-            return ("<pre>\n%s\n</pre>" % r, len(s))
+            return ("<pre>\n%s\n</pre>" % r, session.getResultLineCount())
         else:
             return ("<pre>\n%s\n</pre>" % session.getResult().replace('<','&lt;').replace('>','&gt;'),
                     len(str.splitlines(session.getResult())))
 
+    def parseResult(self,session):
+        """ Return structured (JSON serializable) representation of the result
+        for machine clients. Commands with parsers override this method. """
+        if(session.getResult() == None):
+            return None
+        return {'lines':str.splitlines(session.getResult())}
+
     def getSpecialContent(self,session,**params):
         raise Exception("getSpecialContet() is not implemented in ulgmodel.TextCommand.")
 
@@ -394,6 +568,21 @@ class TextCommand(object):
 
     def finishHook(self,session):
         pass
+
+    def _getClassSetting(self,settings,default):
+        """ Return the setting for the command class or its nearest base class. """
+        for c in type(self).__mro__:
+            if(c.__name__ in settings):
+                return settings[c.__name__]
+        return default
+
+    def getCacheTTL(self):
+        """ Seconds the result can be served from the result cache. """
+        return self._getClassSetting(defaults.result_cache_ttls,defaults.result_cache_ttl)
+
+    def getSessionTTL(self):
+        """ Seconds after the last change the session is removed. """
+        return self._getClassSetting(defaults.session_ttls,defaults.session_max_age)
     
 class AnyCommand(TextCommand):
     def __init__(self):
@@ -415,6 +604,8 @@ class AnyCommand(TextCommand):
         return c
 
 class Router(object):
+    TRANSPORT = 'local'
+
     def __init__(self,acl=None):
         self.setCommands([])
         self.setName('')
@@ -479,6 +670,12 @@ class Router(object):
         self.runRawCommand(command,cr)
         return cr.getvalue()
 
+    def runRawBatch(self,commands):
+        """ Run the list of commands and return the list of their outputs.
+        Routers that keep a session (ulgcli.pool) override it to run all the
+        commands in one session. """
+        return [self.runRawSyncCommand(c) for c in commands]
+
     def runRawCommand(self,command,outfile):
         """ Abstract method. """
         raise Exception("runRawCommand() method not supported for the abstract class Router. Inherit from the class and implement the method.")
@@ -486,13 +683,90 @@ class Router(object):
     def getForkNeeded(self):
         return False
 
+    def getTransport(self):
+        return self.TRANSPORT
+
+    def getUsageLimit(self):
+        """ Maximum of concurrently running commands on the router. """
+        if(self.getName() in defaults.router_usage_limits):
+            return defaults.router_usage_limits[self.getName()]
+        return defaults.transport_usage_limits.get(self.getTransport(),defaults.router_usage_limit)
+
+    def getUsageKey(self):
+        """ Key of the router usage slots and wait queue. """
+        return hashlib.md5(self.getName()).hexdigest()
+
+    def getUsageSlots(self):
+        return UsageSlots(limit=self.getUsageLimit(),prefix='ulg-router-'+self.getUsageKey())
+
     def setASN(self,asn):
         self.asn = asn
 
     def getASN(self):
         return self.asn
 
+class LazyRouter(object):
+    """ Router specification to be used in config.routers instead of the router
+    object itself. The router is constructed (and rescanned when needed) only
+    on the first access to a method not answered from the specification. """
+
+    def __init__(self,router_class,*args,**kwargs):
+        self.router_class = router_class
+        self.args = args
+        self.kwargs = kwargs
+        self.router = None
+
+    def getRouter(self):
+        if(self.router == None):
+            debug("Constructing router "+self.router_class.__name__+" "+str(self.kwargs.get('name',''))+".")
+            self.router = self.router_class(*self.args,**self.kwargs)
+
+        return self.router
+
+    def isConstructed(self):
+        return (self.router != None)
+
+    def getSpecName(self):
+        """ Name given explicitly in the specification (keyword or positional), None
+        when the router class derives it (from the host or its default name). """
+        if(self.kwargs.get('name')):
+            return self.kwargs['name']
+
+        try:
+            argnames = inspect.getargspec(self.router_class.__init__)[0][1:]
+        except TypeError:
+            return None
+        if(('name' in argnames) and (argnames.index('name') < len(self.args))):
+            return self.args[argnames.index('name')]
+        return None
+
+    def getName(self):
+        if(self.router == None):
+            name = self.getSpecName()
+            if(name):
+                return name
+
+        return self.getRouter().getName()
+
+    def checkACL(self,user):
+        if(self.router == None):
+            acl = self.kwargs.get('acl',None)
+            if acl:
+                if not user in acl:
+                    return False
+            return True
+
+        return self.getRouter().checkACL(user)
+
+    def __getattr__(self,name):
+        if(name.startswith('__')):
+            raise AttributeError(name)
+
+        return getattr(self.getRouter(),name)
+
 class RemoteRouter(Router):
+    TRANSPORT = 'ssh'
+
     def getHost(self):
         return self.host
 
@@ -514,6 +788,19 @@ class RemoteRouter(Router):
     def setPassword(self, password):
         self.password = password
 
+    def getSSHControlPath(self):
+        """ Control socket of the shared OpenSSH master connection to the router. """
+        return os.path.join(defaults.session_dir,'ulg-ssh-'+hashlib.md5(str(self.getUser())+'@'+self.getHost()+':'+str(self.getPort())).hexdigest()+'.sock')
+
+    def getSSHCommand(self,bin_ssh=None):
+        """ ssh command line to log in to the router. With defaults.ssh_multiplexing
+        the first connection becomes the master (kept for defaults.ssh_control_persist
+        seconds after its last use) and the following ones reuse its channel. """
+        c = (bin_ssh or defaults.bin_ssh)+' -p'+str(self.getPort())
+        if(defaults.ssh_multiplexing):
+            c += ' -o ControlMaster=auto -o ControlPath='+self.getSSHControlPath()+' -o ControlPersist='+str(defaults.ssh_control_persist)
+        return c+' '+str(self.getUser())+'@'+self.getHost()
+
 class LocalRouter(Router):
     pass
 
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+#
+# ULG - Universal Looking Glass
+# (C) 2012 CZ.NIC, z.s.p.o.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# Imports
+import os
+import re
+import time
+import fcntl
+
+import defaults
+
+import ulgmodel
+
+### Command job queue and router wait queues
+
+JOB_FILE_SUFFIX = '.job'
+CLAIMED_INFIX = '.claimed.'
+CLAIMED_FILE_REGEXP = '^(.*)\.job\.claimed\.([0-9]+)$'
+claimed_file_regexp = re.compile(CLAIMED_FILE_REGEXP)
+
+TICKET_FILE_SUFFIX = '.ticket'
+
+def _makeDir(d):
+    if(not os.path.isdir(d)):
+        try:
+            os.makedirs(d)
+        except OSError:
+            # created by another process in the meantime
+            pass
+
+def _parseName(filename):
+    """ Return (key,sessionid) from the job or ticket file name. """
+    parts = filename.split('.',2)[1].split('-')
+    return (parts[1],parts[2])
+
+def _genName(key,sessionid,suffix):
+    return '%017.6f-%s-%s%s' % (time.time(),key,sessionid,suffix)
+
+
+class JobQueue(object):
+    """ Spool directory shared by the front-end and the command workers.
+    One job is one file named by the enqueue time, the queue key (router)
+    and the session ID, the session file carries router, command and
+    parameters of the job. A worker claims a job by renaming the file,
+    that is atomic, so each job is executed exactly once. """
+
+    def __init__(self,queue_dir=defaults.queue_dir,limit=defaults.queue_limit):
+        self.queue_dir = queue_dir
+        self.limit = limit
+        _makeDir(self.queue_dir)
+
+    def _listJobs(self):
+        return sorted([f for f in os.listdir(self.queue_dir) if f.endswith(JOB_FILE_SUFFIX)])
+
+    def _listClaimed(self):
+        return [f for f in os.listdir(self.queue_dir) if claimed_file_regexp.match(f)]
+
+    def enqueue(self,sessionid,key='default'):
+        """ Add job for the session. Returns False when the queue of the key is full. """
+        if(self.getDepth(key) >= self.limit):
+            return False
+
+        jobname = _genName(key,sessionid,JOB_FILE_SUFFIX)
+        tmpname = os.path.join(self.queue_dir,jobname+'.tmp')
+        f = open(tmpname,'w')
+        f.write(sessionid+'\n')
+        f.close()
+        os.rename(tmpname,os.path.join(self.queue_dir,jobname))
+        return True
+
+    def claim(self,admit=None):
+        """ Claim the oldest admitted job for this process. admit(key) returns
+        an admission token (an object with release() method, e.g. usage slots)
+        or None when the jobs of the key have to wait, those jobs are skipped
+        and stay in the queue in their order. Returns (job,sessionid,token) or None. """
+        refused = []
+        for j in self._listJobs():
+            key,sessionid = _parseName(j)
+            if(key in refused):
+                continue
+
+            token = None
+            if(admit):
+                token = admit(key)
+                if(token == None):
+                    refused.append(key)
+                    continue
+
+            claimed = j+CLAIMED_INFIX+str(os.getpid())
+            try:
+                os.rename(os.path.join(self.queue_dir,j),os.path.join(self.queue_dir,claimed))
+            except OSError:
+                # claimed by another worker
+                if(token):
+                    token.release()
+                continue
+            return (claimed,sessionid,token)
+
+        return None
+
+    def done(self,job):
+        try:
+            os.unlink(os.path.join(self.queue_dir,job))
+        except OSError as e:
+            ulgmodel.log('Error while removing job file '+job+' '+str(e))
+
+    def releaseClaimed(self,pid=None):
+        """ Remove jobs claimed by the (dead) process pid or by any process
+        when pid is None, returns their session IDs. """
+        sessionids = []
+        for c in self._listClaimed():
+            if((pid == None) or (claimed_file_regexp.match(c).group(2) == str(pid))):
+                sessionids.append(_parseName(c)[1])
+                self.done(c)
+        return sessionids
+
+    def getDepth(self,key=None):
+        """ Number of jobs (of the key) waiting for a worker. """
+        return len([j for j in self._listJobs() if (key == None) or (_parseName(j)[0] == key)])
+
+    def getPosition(self,sessionid):
+        """ Position of the waiting session in the queue of its key, None if not waiting. """
+        jobs = [_parseName(j) for j in self._listJobs()]
+        for idx,(key,sid) in enumerate(jobs):
+            if(sid == sessionid):
+                return len([k for (k,s) in jobs[:idx] if k == key])+1
+        return None
+
+    def getRunning(self):
+        """ Number of jobs claimed by workers. """
+        return len(self._listClaimed())
+
+
+class WaitQueue(object):
+    """ FIFO of forked command processes waiting for a slot of one router.
+    Each waiting process holds a flock on its ticket file, tickets of dead
+    processes are not locked and they are removed by the other waiters. """
+
+    def __init__(self,key,queue_dir=defaults.queue_dir,limit=defaults.queue_limit):
+        self.key = key
+        self.queue_dir = os.path.join(queue_dir,'wait-'+key)
+        self.limit = limit
+        _makeDir(self.queue_dir)
+
+    def _isStale(self,ticket):
+        try:
+            f = open(os.path.join(self.queue_dir,ticket),'r')
+        except IOError:
+            # removed in the meantime
+            return True
+        try:
+            fcntl.flock(f,fcntl.LOCK_EX|fcntl.LOCK_NB)
+            fcntl.flock(f,fcntl.LOCK_UN)
+            return True
+        except IOError:
+            return False
+        finally:
+            f.close()
+
+    def _listTickets(self):
+        tickets = []
+        for t in sorted([f for f in os.listdir(self.queue_dir) if f.endswith(TICKET_FILE_SUFFIX)]):
+            if(self._isStale(t)):
+                # the waiting process died
+                try:
+                    os.unlink(os.path.join(self.queue_dir,t))
+                except OSError:
+                    pass
+            else:
+                tickets.append(t)
+        return tickets
+
+    def enter(self,sessionid):
+        """ Enter the queue, returns the ticket to be held while waiting. """
+        name = _genName(self.key,sessionid,TICKET_FILE_SUFFIX)
+        tmpname = os.path.join(self.queue_dir,name+'.tmp')
+        f = open(tmpname,'w')
+        fcntl.flock(f,fcntl.LOCK_EX)
+        os.rename(tmpname,os.path.join(self.queue_dir,name))
+        return (name,f)
+
+    def isFirst(self,ticket):
+        tickets = self._listTickets()
+        return (len(tickets) > 0 and tickets[0] == ticket[0])
+
+    def leave(self,ticket):
+        try:
+            os.unlink(os.path.join(self.queue_dir,ticket[0]))
+        except OSError as e:
+            ulgmodel.log('Error while removing ticket file '+ticket[0]+' '+str(e))
+        ticket[1].close()
+
+    def getDepth(self):
+        return len(self._listTickets())
+
+    def isFull(self):
+        return (self.getDepth() >= self.limit)
+
+    def getPosition(self,sessionid):
+        """ Position of the waiting session, None if not waiting. """
+        for idx,t in enumerate(self._listTickets()):
+            if(_parseName(t)[1] == sessionid):
+                return idx+1
+        return None
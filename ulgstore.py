@@ -0,0 +1,830 @@
+#!/usr/bin/env python
+#
+# ULG - Universal Looking Glass
+# (C) 2012 CZ.NIC, z.s.p.o.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# Imports
+import os
+import re
+import time
+import struct
+import bisect
+import zlib
+import fcntl
+import sqlite3
+import threading
+
+import defaults
+
+import ulgmodel
+
+### Session and result storage
+
+SESSION_ID_REGEXP = '^[a-zA-Z0-9]{10,128}$'
+session_id_regexp = re.compile(SESSION_ID_REGEXP)
+
+SESSION_FILE_REGEXP = '^ulg-([a-zA-Z0-9]+)\.session$'
+session_file_regexp = re.compile(SESSION_FILE_REGEXP)
+
+# temp files of the session and tail files replaced by rename
+TEMP_FILE_REGEXP = '^ulg-[a-zA-Z0-9]+\.([a-z]+\.)?session\.[0-9]+\.tmp$'
+temp_file_regexp = re.compile(TEMP_FILE_REGEXP)
+
+def getSessionFileName(sessionid):
+    if(session_id_regexp.match(sessionid)):
+        return defaults.session_dir+'/'+'ulg-'+sessionid+'.session'
+    else:
+        raise Exception('Invalid session id passed. Value was: '+sessionid)
+
+def getSessionOutputFileName(sessionid):
+    if(session_id_regexp.match(sessionid)):
+        return defaults.session_dir+'/'+'ulg-'+sessionid+'.out.session'
+    else:
+        raise Exception('Invalid session id passed. Value was: '+sessionid)
+
+def getSessionOutputPartFileName(sessionid,part):
+    if(session_id_regexp.match(sessionid)):
+        return defaults.session_dir+'/'+'ulg-'+sessionid+'.'+part+'.session'
+    else:
+        raise Exception('Invalid session id passed. Value was: '+sessionid)
+
+def getSessionOutputIndexFileName(sessionid):
+    return getSessionOutputPartFileName(sessionid,'idx')
+
+# line index entry: offset of the end of the line (after '\n') in the output
+LINE_INDEX_ENTRY = '<Q'
+LINE_INDEX_ENTRY_SIZE = struct.calcsize(LINE_INDEX_ENTRY)
+
+# frame index entry: offset and length of the uncompressed data, offset and length of the frame
+FRAME_INDEX_ENTRY = '<QQQQ'
+FRAME_INDEX_ENTRY_SIZE = struct.calcsize(FRAME_INDEX_ENTRY)
+# tail file header: offset of the tail in the output
+TAIL_HEADER = '<Q'
+TAIL_HEADER_SIZE = struct.calcsize(TAIL_HEADER)
+
+def indexLines(offset,data):
+    """ Return offsets of the ends of the lines in data appended at offset. """
+    result = []
+    p = data.find('\n')
+    while(p >= 0):
+        result.append(offset+p+1)
+        p = data.find('\n',p+1)
+    return result
+
+def upgradeExpiry(conn):
+    """ Add the output column to an expiry index created without it. """
+    if(not [r for r in conn.execute('PRAGMA table_info(expiry)').fetchall() if r[1] == 'output']):
+        conn.execute('ALTER TABLE expiry ADD COLUMN output TEXT')
+        conn.execute('UPDATE expiry SET output=id')
+
+# expiry index of the sessions: the expiry time, the finished flag, the output
+# the session shows, the size of the output on the disk (recorded by the session
+# that produces the output) and the time of the last change
+EXPIRY_SCHEMA = ['CREATE TABLE IF NOT EXISTS expiry (id TEXT PRIMARY KEY, expires REAL, finished INTEGER, size INTEGER, updated REAL, output TEXT)',
+                 upgradeExpiry,
+                 'CREATE INDEX IF NOT EXISTS expiry_expires ON expiry (expires)',
+                 'CREATE INDEX IF NOT EXISTS expiry_finished ON expiry (finished,updated)',
+                 'CREATE INDEX IF NOT EXISTS expiry_output ON expiry (output)',
+                 ]
+
+def updateExpiry(c,sessionid,expires,finished,size,outputid=None):
+    if(expires == None):
+        expires = time.time() + defaults.session_max_age
+    c.execute('INSERT OR REPLACE INTO expiry (id,expires,finished,size,updated,output) VALUES (?,?,?,?,?,?)',
+              (sessionid,expires,int(finished),size,time.time(),outputid or sessionid))
+
+def unregisterSessions(c,sessionids):
+    """ Remove the sessions from the expiry index within the transaction open on c.
+    Return the IDs of the outputs that no remaining session shows, the size of an
+    output still shown by a coalesced session is moved to that session. """
+    outputs = {}
+    for sessionid in sessionids:
+        r = c.execute('SELECT output,size FROM expiry WHERE id=?',(sessionid,)).fetchone()
+        if(r):
+            outputs[r[0]] = outputs.get(r[0],0) + (r[1] or 0)
+            c.execute('DELETE FROM expiry WHERE id=?',(sessionid,))
+        else:
+            outputs.setdefault(sessionid,0)
+
+    orphans = []
+    for outputid,size in outputs.items():
+        r = c.execute('SELECT id FROM expiry WHERE output=? LIMIT 1',(outputid,)).fetchone()
+        if(r):
+            c.execute('UPDATE expiry SET size=size+? WHERE id=?',(size,r[0]))
+        else:
+            orphans.append(outputid)
+    return orphans
+
+def splitOutputLines(data):
+    lines = data.split('\n')
+    if(data.endswith('\n')):
+        lines.pop()
+    return [(l[:-1] if l.endswith('\r') else l) for l in lines]
+
+
+class SQLiteDatabase(object):
+    """ SQLite database in WAL mode, connections are opened per thread and process. """
+
+    def __init__(self,filename,schema):
+        self.filename = filename
+        self.schema = schema
+        self.local = threading.local()
+        self.inherited = []
+
+    def getConnection(self):
+        # connections must not be shared by threads and forked processes
+        if(getattr(self.local,'pid',None) != os.getpid()):
+            if(getattr(self.local,'conn',None)):
+                # a connection of the parent process must not be closed by the
+                # child, keep it referenced
+                self.inherited.append(self.local.conn)
+            conn = sqlite3.connect(self.filename,timeout=defaults.session_db_timeout,isolation_level=None)
+            conn.text_factory = str
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            for s in self.schema:
+                if(callable(s)):
+                    s(conn)
+                else:
+                    conn.execute(s)
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+
+        return self.local.conn
+
+
+class SessionStore(object):
+    """ Abstract storage of the (pickled) sessions and the command outputs.
+    Outputs are identified by the ID of the session that produces them.
+    Sessions are registered in the expiry index (EXPIRY_SCHEMA) when saved. """
+
+    def saveSession(self,sessionid,data,expires=None,finished=False,outputid=None):
+        """ Save the session data, the session expires at the time expires
+        (defaults.session_max_age from now when None). The session shows
+        the output outputid (its own output when None), the output is removed
+        with the last session showing it. """
+        raise Exception("saveSession() method not supported for the abstract class SessionStore.")
+
+    def loadSession(self,sessionid):
+        """ Return the saved data or None. """
+        raise Exception("loadSession() method not supported for the abstract class SessionStore.")
+
+    def getOutput(self,outputid):
+        """ Return the whole output or None if there is no output. """
+        raise Exception("getOutput() method not supported for the abstract class SessionStore.")
+
+    def setOutput(self,outputid,data):
+        raise Exception("setOutput() method not supported for the abstract class SessionStore.")
+
+    def appendOutput(self,outputid,data):
+        raise Exception("appendOutput() method not supported for the abstract class SessionStore.")
+
+    def readOutput(self,outputid,offset=0,length=-1):
+        raise Exception("readOutput() method not supported for the abstract class SessionStore.")
+
+    def getOutputSize(self,outputid):
+        raise Exception("getOutputSize() method not supported for the abstract class SessionStore.")
+
+    def clearOutput(self,outputid):
+        """ Truncate the output if it exists. """
+        raise Exception("clearOutput() method not supported for the abstract class SessionStore.")
+
+    def hasOutput(self,outputid):
+        raise Exception("hasOutput() method not supported for the abstract class SessionStore.")
+
+    def getIndexedLineCount(self,outputid):
+        """ Number of complete (newline terminated) lines in the output. """
+        raise Exception("getIndexedLineCount() method not supported for the abstract class SessionStore.")
+
+    def getLineEnd(self,outputid,line):
+        """ Offset of the end of the complete line in the output. """
+        raise Exception("getLineEnd() method not supported for the abstract class SessionStore.")
+
+    def getOutputLineCount(self,outputid):
+        """ Number of lines in the output including the unterminated last line. """
+        n = self.getIndexedLineCount(outputid)
+        last = self.getLineEnd(outputid,n-1) if(n > 0) else 0
+        if(self.getOutputSize(outputid) > last):
+            n += 1
+        return n
+
+    def readOutputLines(self,outputid,start=0,count=-1):
+        """ Read count lines (all lines when count is negative) from the line start
+        of the output using the line index, line separators are removed. """
+        indexed = self.getIndexedLineCount(outputid)
+        total = self.getOutputLineCount(outputid)
+        end = total if(count < 0) else min(total,start+count)
+        if(start >= end):
+            return []
+
+        begin = self.getLineEnd(outputid,start-1) if(start > 0) else 0
+        if(end <= indexed):
+            return splitOutputLines(self.readOutput(outputid,begin,self.getLineEnd(outputid,end-1)-begin))
+        else:
+            return splitOutputLines(self.readOutput(outputid,begin))
+
+    def readOutputTail(self,outputid,count):
+        """ Return (the last count complete lines,offset of the end of the last complete line),
+        only the tail of the output is read. """
+        indexed = self.getIndexedLineCount(outputid)
+        if(indexed == 0):
+            return ([],0)
+
+        end = self.getLineEnd(outputid,indexed-1)
+        begin = self.getLineEnd(outputid,indexed-count-1) if(indexed > count) else 0
+        return (splitOutputLines(self.readOutput(outputid,begin,end-begin)),end)
+
+    def getOutputDiskSize(self,outputid):
+        """ Space taken by the output (including its indexes) in bytes. """
+        raise Exception("getOutputDiskSize() method not supported for the abstract class SessionStore.")
+
+    def getExpiryIndex(self):
+        """ Return the connection to the database with the expiry index. """
+        raise Exception("getExpiryIndex() method not supported for the abstract class SessionStore.")
+
+    def removeSessions(self,sessionids):
+        """ Remove the sessions, their expiry index entries and the outputs
+        that no other session shows. """
+        raise Exception("removeSessions() method not supported for the abstract class SessionStore.")
+
+    def expire(self):
+        """ Remove the expired sessions and their outputs. Only the expired sessions
+        are looked up in the expiry index, the live sessions are not checked. """
+        c = self.getExpiryIndex()
+        ids = [r[0] for r in c.execute('SELECT id FROM expiry WHERE expires<?',(time.time(),)).fetchall()]
+        if(ids):
+            self.removeSessions(ids)
+
+        ulgmodel.log('Removed '+str(len(ids))+' expired sessions.')
+        return len(ids)
+
+    def evict(self,quota):
+        """ Remove the oldest finished sessions until the outputs fit to quota bytes. """
+        c = self.getExpiryIndex()
+        total = c.execute('SELECT COALESCE(SUM(size),0) FROM expiry').fetchone()[0]
+        if(total <= quota):
+            return 0
+
+        ids = []
+        for (sessionid,size) in c.execute('SELECT id,size FROM expiry WHERE finished=1 ORDER BY updated').fetchall():
+            if(total <= quota):
+                break
+            ids.append(sessionid)
+            total -= size
+
+        if(ids):
+            self.removeSessions(ids)
+        ulgmodel.log('Evicted '+str(len(ids))+' finished sessions over the quota of '+str(quota)+' bytes.')
+        return len(ids)
+
+
+class FileSessionStore(SessionStore):
+    """ Session pickles ulg-<id>.session and outputs ulg-<id>.out.session
+    in defaults.session_dir, the expiry index is kept in defaults.session_index_file.
+    The writer holds an exclusive flock on the output file while it appends the data
+    and the line index, the line readers hold a shared one. """
+
+    def __init__(self):
+        self.index = None
+
+    def saveSession(self,sessionid,data,expires=None,finished=False,outputid=None):
+        # write a new file and replace the old one atomically,
+        # readers never see a partially written session
+        fn = getSessionFileName(sessionid)
+        tmpfn = fn+'.'+str(os.getpid())+'.tmp'
+        f = open(tmpfn,'wb')
+        f.write(data)
+        f.close()
+        os.rename(tmpfn,fn)
+
+        # the size of a shared output is recorded by the session producing it
+        size = self.getOutputDiskSize(sessionid) if(outputid in (None,sessionid)) else 0
+        updateExpiry(self.getExpiryIndex(),sessionid,expires,finished,size,outputid)
+
+    def loadSession(self,sessionid):
+        fn = getSessionFileName(sessionid)
+        try:
+            f = open(fn,'rb')
+            data = f.read()
+            f.close()
+            return data
+        except IOError:
+            return None
+
+    def getOutput(self,outputid):
+        try:
+            f = open(getSessionOutputFileName(outputid),'r')
+            result = f.read()
+            f.close()
+            return result
+        except IOError:
+            return None
+
+    def _writeIndex(self,outputid,offset,data,mode):
+        f = open(getSessionOutputIndexFileName(outputid),mode)
+        f.write(''.join([struct.pack(LINE_INDEX_ENTRY,o) for o in indexLines(offset,data)]))
+        f.close()
+
+    def _lockShared(self,outputid):
+        """ Open the output file and lock it for reading, None when there is no output. """
+        try:
+            f = open(getSessionOutputFileName(outputid),'r')
+        except IOError:
+            return None
+        fcntl.flock(f,fcntl.LOCK_SH)
+        return f
+
+    def setOutput(self,outputid,data):
+        f = open(getSessionOutputFileName(outputid),'a')
+        try:
+            fcntl.flock(f,fcntl.LOCK_EX)
+            f.truncate(0)
+            f.write(data)
+            f.flush()
+            self._writeIndex(outputid,0,data,'wb')
+        finally:
+            f.close()
+
+    def appendOutput(self,outputid,data):
+        f = open(getSessionOutputFileName(outputid),'a')
+        try:
+            fcntl.flock(f,fcntl.LOCK_EX)
+            f.seek(0,os.SEEK_END)
+            offset = f.tell()
+            f.write(data)
+            f.flush()
+            self._writeIndex(outputid,offset,data,'ab')
+        finally:
+            f.close()
+
+    def readOutput(self,outputid,offset=0,length=-1):
+        try:
+            f = open(getSessionOutputFileName(outputid),'r')
+            f.seek(offset)
+            result = f.read(length)
+            f.close()
+            return result
+        except IOError:
+            return ''
+
+    def getOutputSize(self,outputid):
+        try:
+            return os.path.getsize(getSessionOutputFileName(outputid))
+        except OSError:
+            return 0
+
+    def clearOutput(self,outputid):
+        if(self.hasOutput(outputid)):
+            self.setOutput(outputid,'')
+
+    def hasOutput(self,outputid):
+        return os.path.isfile(getSessionOutputFileName(outputid))
+
+    def getOutputLineCount(self,outputid):
+        f = self._lockShared(outputid)
+        try:
+            return SessionStore.getOutputLineCount(self,outputid)
+        finally:
+            if(f):
+                f.close()
+
+    def readOutputLines(self,outputid,start=0,count=-1):
+        f = self._lockShared(outputid)
+        try:
+            return SessionStore.readOutputLines(self,outputid,start,count)
+        finally:
+            if(f):
+                f.close()
+
+    def readOutputTail(self,outputid,count):
+        f = self._lockShared(outputid)
+        try:
+            return SessionStore.readOutputTail(self,outputid,count)
+        finally:
+            if(f):
+                f.close()
+
+    def getIndexedLineCount(self,outputid):
+        idxfn = getSessionOutputIndexFileName(outputid)
+        if((not os.path.isfile(idxfn)) and self.hasOutput(outputid)):
+            # output written before the line index was introduced
+            self._writeIndex(outputid,0,self.getOutput(outputid),'wb')
+
+        try:
+            return os.path.getsize(idxfn) / LINE_INDEX_ENTRY_SIZE
+        except OSError:
+            return 0
+
+    def getLineEnd(self,outputid,line):
+        f = open(getSessionOutputIndexFileName(outputid),'rb')
+        f.seek(line*LINE_INDEX_ENTRY_SIZE)
+        e = f.read(LINE_INDEX_ENTRY_SIZE)
+        f.close()
+        return struct.unpack(LINE_INDEX_ENTRY,e)[0]
+
+    def getOutputFileNames(self,outputid):
+        return [getSessionOutputFileName(outputid)]+[getSessionOutputPartFileName(outputid,p) for p in ['idx','frm','tail']]
+
+    def getOutputDiskSize(self,outputid):
+        size = 0
+        for fn in self.getOutputFileNames(outputid):
+            try:
+                size += os.path.getsize(fn)
+            except OSError:
+                pass
+        return size
+
+    def getExpiryIndex(self):
+        if(not self.index):
+            created = not os.path.exists(defaults.session_index_file)
+            self.index = SQLiteDatabase(defaults.session_index_file,EXPIRY_SCHEMA)
+            if(created):
+                self._indexSessionFiles()
+
+        return self.index.getConnection()
+
+    def _indexSessionFiles(self):
+        """ Register sessions saved before the expiry index has been created. """
+        c = self.index.getConnection()
+        for file in os.listdir(defaults.session_dir):
+            m = session_file_regexp.match(file)
+            if(m):
+                try:
+                    mtime = os.path.getmtime(defaults.session_dir+'/'+file)
+                except OSError:
+                    continue
+                updateExpiry(c,m.group(1),mtime+defaults.session_max_age,True,self.getOutputDiskSize(m.group(1)))
+
+    def expire(self):
+        removed = SessionStore.expire(self)
+        self._removeTempFiles()
+        return removed
+
+    def _removeTempFiles(self):
+        """ Remove temp files left by processes that died while saving, they
+        are not in the expiry index. """
+        limit = time.time() - defaults.session_max_age
+        for file in os.listdir(defaults.session_dir):
+            if(temp_file_regexp.match(file)):
+                fn = defaults.session_dir+'/'+file
+                try:
+                    if(os.path.getmtime(fn) < limit):
+                        ulgmodel.log('Removing file '+fn)
+                        os.unlink(fn)
+                except OSError as e:
+                    ulgmodel.log('Error while removing file '+fn+' '+str(e))
+
+    def removeSessions(self,sessionids):
+        c = self.getExpiryIndex()
+        c.execute('BEGIN IMMEDIATE')
+        try:
+            outputids = unregisterSessions(c,sessionids)
+            c.execute('COMMIT')
+        except:
+            c.execute('ROLLBACK')
+            raise
+
+        fns = []
+        for sessionid in sessionids:
+            ulgmodel.debug('Removing session '+sessionid)
+            fns.append(getSessionFileName(sessionid))
+        for outputid in outputids:
+            fns.extend(self.getOutputFileNames(outputid))
+
+        for fn in fns:
+            try:
+                if(os.path.exists(fn)):
+                    os.unlink(fn)
+            except OSError as e:
+                ulgmodel.log('Error while removing file '+fn+' '+str(e))
+
+
+class CompressedFileSessionStore(FileSessionStore):
+    """ FileSessionStore keeping the output in zlib frames. Each frame holds whole lines
+    (about defaults.session_output_frame_size bytes) and it is compressed independently,
+    so a page is read by decompressing only the frames holding its lines. The output
+    after the last frame is kept uncompressed in the tail file until it fills a frame.
+    The writer holds an exclusive flock on the frame index file while it changes the
+    frames and the tail, the readers hold a shared one while they read them. """
+
+    def _readFrames(self,frmf):
+        frmf.seek(0)
+        data = frmf.read()
+
+        return [struct.unpack_from(FRAME_INDEX_ENTRY,data,i*FRAME_INDEX_ENTRY_SIZE)
+                for i in range(0,len(data) / FRAME_INDEX_ENTRY_SIZE)]
+
+    def _readTail(self,outputid):
+        """ Return (offset of the tail in the output,tail data). """
+        try:
+            f = open(getSessionOutputPartFileName(outputid,'tail'),'rb')
+            data = f.read()
+            f.close()
+        except IOError:
+            return (0,'')
+
+        if(len(data) < TAIL_HEADER_SIZE):
+            return (0,'')
+        return (struct.unpack_from(TAIL_HEADER,data)[0],data[TAIL_HEADER_SIZE:])
+
+    def _readLockedState(self,outputid,frmf):
+        """ Return (frame index,tail) read under the lock of frmf. """
+        frames = self._readFrames(frmf)
+        start,tail = self._readTail(outputid)
+        end = (frames[-1][0]+frames[-1][1]) if(frames) else 0
+        if(start != end):
+            raise Exception('Inconsistent compressed output '+outputid+'.')
+        return (frames,tail)
+
+    def _lockShared(self,outputid):
+        try:
+            f = open(getSessionOutputPartFileName(outputid,'frm'),'rb')
+        except IOError:
+            return None
+        fcntl.flock(f,fcntl.LOCK_SH)
+        return f
+
+    def _readState(self,outputid):
+        """ Return (frame index,tail). """
+        f = self._lockShared(outputid)
+        if(not f):
+            return ([],self._readTail(outputid)[1])
+
+        try:
+            return self._readLockedState(outputid,f)
+        finally:
+            f.close()
+
+    def _lockFrames(self,outputid):
+        """ Open the frame index file for the writer and lock it exclusively. """
+        f = open(getSessionOutputPartFileName(outputid,'frm'),'a+b')
+        fcntl.flock(f,fcntl.LOCK_EX)
+        return f
+
+    def _writeTail(self,outputid,start,data):
+        fn = getSessionOutputPartFileName(outputid,'tail')
+        tmpfn = fn+'.'+str(os.getpid())+'.tmp'
+        f = open(tmpfn,'wb')
+        f.write(struct.pack(TAIL_HEADER,start)+data)
+        f.close()
+        os.rename(tmpfn,fn)
+
+    def _appendData(self,outputid,frmf,frames,tail,data):
+        start = (frames[-1][0]+frames[-1][1]) if(frames) else 0
+        if(len(tail)+len(data) < defaults.session_output_frame_size):
+            f = open(getSessionOutputPartFileName(outputid,'tail'),'ab')
+            f.write(data)
+            f.close()
+            return
+
+        # compress the whole lines to frames
+        tail = tail+data
+        pos = 0
+        outf = open(getSessionOutputFileName(outputid),'ab')
+        outf.seek(0,os.SEEK_END)
+        frmf.seek(0,os.SEEK_END)
+        while((len(tail)-pos) >= defaults.session_output_frame_size):
+            e = tail.rfind('\n',pos,pos+defaults.session_output_frame_size)+1
+            if(e == 0):
+                # line longer than a frame
+                e = tail.find('\n',pos+defaults.session_output_frame_size)+1
+                if(e == 0):
+                    break
+
+            z = zlib.compress(tail[pos:e],defaults.session_output_compress_level)
+            coffset = outf.tell()
+            outf.write(z)
+            outf.flush()
+            frmf.write(struct.pack(FRAME_INDEX_ENTRY,start+pos,e-pos,coffset,len(z)))
+            frmf.flush()
+            pos = e
+        outf.close()
+
+        self._writeTail(outputid,start+pos,tail[pos:])
+
+    def getOutput(self,outputid):
+        if(not self.hasOutput(outputid)):
+            return None
+        return self.readOutput(outputid)
+
+    def setOutput(self,outputid,data):
+        frmf = self._lockFrames(outputid)
+        try:
+            frmf.truncate(0)
+            f = open(getSessionOutputFileName(outputid),'wb')
+            f.close()
+            self._writeTail(outputid,0,'')
+            self._appendData(outputid,frmf,[],'',data)
+            self._writeIndex(outputid,0,data,'wb')
+        finally:
+            frmf.close()
+
+    def appendOutput(self,outputid,data):
+        if(not self.hasOutput(outputid)):
+            self.setOutput(outputid,data)
+            return
+
+        frmf = self._lockFrames(outputid)
+        try:
+            frames,tail = self._readLockedState(outputid,frmf)
+            offset = ((frames[-1][0]+frames[-1][1]) if(frames) else 0)+len(tail)
+            self._appendData(outputid,frmf,frames,tail,data)
+            self._writeIndex(outputid,offset,data,'ab')
+        finally:
+            frmf.close()
+
+    def readOutput(self,outputid,offset=0,length=-1):
+        frames,tail = self._readState(outputid)
+        tstart = (frames[-1][0]+frames[-1][1]) if(frames) else 0
+        stop = tstart+len(tail)
+        if(length >= 0):
+            stop = min(stop,offset+length)
+
+        result = []
+        i = max(0,bisect.bisect_right([fr[0] for fr in frames],offset)-1)
+        if(i < len(frames) and frames[i][0] < stop):
+            f = open(getSessionOutputFileName(outputid),'rb')
+            while(i < len(frames) and frames[i][0] < stop):
+                uoffset,ulen,coffset,clen = frames[i]
+                f.seek(coffset)
+                data = zlib.decompress(f.read(clen))
+                result.append(data[max(0,offset-uoffset):stop-uoffset])
+                i += 1
+            f.close()
+
+        if(stop > tstart):
+            result.append(tail[max(0,offset-tstart):stop-tstart])
+
+        return ''.join(result)
+
+    def getOutputSize(self,outputid):
+        frames,tail = self._readState(outputid)
+        return ((frames[-1][0]+frames[-1][1]) if(frames) else 0)+len(tail)
+
+
+class SQLiteSessionStore(SessionStore):
+    """ Sessions and output chunks in one SQLite database in WAL mode.
+    Lookups and expiry use indexes instead of directory scans. """
+
+    SCHEMA = ['CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, data BLOB)',
+              'CREATE TABLE IF NOT EXISTS outputs (id TEXT, offset INTEGER, data BLOB, PRIMARY KEY (id,offset))',
+              'CREATE TABLE IF NOT EXISTS lines (id TEXT, line INTEGER, end INTEGER, PRIMARY KEY (id,line))',
+              ] + EXPIRY_SCHEMA
+
+    def __init__(self,filename=defaults.session_db_file):
+        self.filename = filename
+        self.db = SQLiteDatabase(filename,self.SCHEMA)
+
+    def getConnection(self):
+        return self.db.getConnection()
+
+    def saveSession(self,sessionid,data,expires=None,finished=False,outputid=None):
+        c = self.getConnection()
+        c.execute('BEGIN IMMEDIATE')
+        try:
+            c.execute('INSERT OR REPLACE INTO sessions (id,data) VALUES (?,?)',(sessionid,sqlite3.Binary(data)))
+            # the size of a shared output is recorded by the session producing it
+            size = self.getOutputDiskSize(sessionid) if(outputid in (None,sessionid)) else 0
+            updateExpiry(c,sessionid,expires,finished,size,outputid)
+            c.execute('COMMIT')
+        except:
+            c.execute('ROLLBACK')
+            raise
+
+    def loadSession(self,sessionid):
+        r = self.getConnection().execute('SELECT data FROM sessions WHERE id=?',(sessionid,)).fetchone()
+        if(r):
+            return str(r[0])
+        return None
+
+    def getOutput(self,outputid):
+        rows = self.getConnection().execute('SELECT data FROM outputs WHERE id=? ORDER BY offset',(outputid,)).fetchall()
+        if(not rows):
+            return None
+        return ''.join([str(r[0]) for r in rows])
+
+    def setOutput(self,outputid,data):
+        c = self.getConnection()
+        c.execute('BEGIN IMMEDIATE')
+        try:
+            c.execute('DELETE FROM outputs WHERE id=?',(outputid,))
+            c.execute('DELETE FROM lines WHERE id=?',(outputid,))
+            c.execute('INSERT INTO outputs (id,offset,data) VALUES (?,0,?)',(outputid,sqlite3.Binary(data)))
+            self._insertLines(c,outputid,0,0,data)
+            c.execute('COMMIT')
+        except:
+            c.execute('ROLLBACK')
+            raise
+
+    def appendOutput(self,outputid,data):
+        c = self.getConnection()
+        c.execute('BEGIN IMMEDIATE')
+        try:
+            offset = self.getOutputSize(outputid)
+            # replace the empty chunk created by setOutput('')
+            c.execute('DELETE FROM outputs WHERE id=? AND offset=? AND length(data)=0',(outputid,offset))
+            c.execute('INSERT INTO outputs (id,offset,data) VALUES (?,?,?)',
+                      (outputid,offset,sqlite3.Binary(data)))
+            self._insertLines(c,outputid,self.getIndexedLineCount(outputid),offset,data)
+            c.execute('COMMIT')
+        except:
+            c.execute('ROLLBACK')
+            raise
+
+    def readOutput(self,outputid,offset=0,length=-1):
+        if(length < 0):
+            rows = self.getConnection().execute('SELECT offset,data FROM outputs WHERE id=? AND offset+length(data)>? ORDER BY offset',
+                                                (outputid,offset)).fetchall()
+        else:
+            rows = self.getConnection().execute('SELECT offset,data FROM outputs WHERE id=? AND offset+length(data)>? AND offset<? ORDER BY offset',
+                                                (outputid,offset,offset+length)).fetchall()
+        if(not rows):
+            return ''
+
+        result = ''.join([str(r[1]) for r in rows])[offset-rows[0][0]:]
+        if(length >= 0):
+            result = result[:length]
+        return result
+
+    def getOutputSize(self,outputid):
+        r = self.getConnection().execute('SELECT offset+length(data) FROM outputs WHERE id=? ORDER BY offset DESC LIMIT 1',(outputid,)).fetchone()
+        if(r):
+            return r[0]
+        return 0
+
+    def clearOutput(self,outputid):
+        c = self.getConnection()
+        c.execute('BEGIN IMMEDIATE')
+        try:
+            if(c.execute('SELECT 1 FROM outputs WHERE id=? LIMIT 1',(outputid,)).fetchone()):
+                c.execute('DELETE FROM outputs WHERE id=?',(outputid,))
+                c.execute('DELETE FROM lines WHERE id=?',(outputid,))
+                c.execute('INSERT INTO outputs (id,offset,data) VALUES (?,0,?)',(outputid,sqlite3.Binary('')))
+            c.execute('COMMIT')
+        except:
+            c.execute('ROLLBACK')
+            raise
+
+    def _insertLines(self,c,outputid,first,offset,data):
+        c.executemany('INSERT INTO lines (id,line,end) VALUES (?,?,?)',
+                      [(outputid,first+i,e) for i,e in enumerate(indexLines(offset,data))])
+
+    def hasOutput(self,outputid):
+        return self.getConnection().execute('SELECT 1 FROM outputs WHERE id=? LIMIT 1',(outputid,)).fetchone() != None
+
+    def getIndexedLineCount(self,outputid):
+        r = self.getConnection().execute('SELECT line FROM lines WHERE id=? ORDER BY line DESC LIMIT 1',(outputid,)).fetchone()
+        if(r):
+            return r[0]+1
+        return 0
+
+    def getLineEnd(self,outputid,line):
+        return self.getConnection().execute('SELECT end FROM lines WHERE id=? AND line=?',(outputid,line)).fetchone()[0]
+
+    def getOutputDiskSize(self,outputid):
+        return self.getConnection().execute('SELECT COALESCE(SUM(length(data)),0) FROM outputs WHERE id=?',(outputid,)).fetchone()[0]
+
+    def getExpiryIndex(self):
+        return self.getConnection()
+
+    def removeSessions(self,sessionids):
+        c = self.getConnection()
+        c.execute('BEGIN IMMEDIATE')
+        try:
+            outputids = unregisterSessions(c,sessionids)
+            c.executemany('DELETE FROM sessions WHERE id=?',[(sessionid,) for sessionid in sessionids])
+            for t in ['outputs','lines']:
+                c.executemany('DELETE FROM '+t+' WHERE id=?',[(outputid,) for outputid in outputids])
+            c.execute('COMMIT')
+        except:
+            c.execute('ROLLBACK')
+            raise
+
+
+SESSION_BACKENDS = {'file':FileSessionStore,
+                    'compressed':CompressedFileSessionStore,
+                    'sqlite':SQLiteSessionStore,
+                    }
+
+session_store = None
+
+def getSessionStore():
+    """ Return the session store selected by defaults.session_backend. """
+    global session_store
+    if(session_store == None):
+        session_store = SESSION_BACKENDS[defaults.session_backend]()
+    return session_store
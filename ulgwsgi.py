@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+#
+# ULG - Universal Looking Glass
+# (C) 2012 CZ.NIC, z.s.p.o.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# Imports
+import os, sys
+import re
+import cgi
+import signal
+import time
+import mimetypes
+import StringIO
+import traceback
+import threading
+from SocketServer import ThreadingMixIn
+from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
+
+import defaults
+
+import ulgmodel
+import ulgcli
+import ulg
+
+### WSGI application and pre-forked application server
+
+STATIC_FILE_REGEXP = '^/?((style\.css)|(tinybox\.js)|(ulgform\.js)|(images/[a-zA-Z0-9\._-]+\.(png|gif)))$'
+static_file_regexp = re.compile(STATIC_FILE_REGEXP)
+
+# one warm handler per process, routers in ulg.config are constructed only once
+handler = ulg.ULGCgi()
+
+# the handler prints its output to the (captured) sys.stdout, serialize
+# all actions but the streamed ones that run concurrently in their threads
+handler_lock = threading.Lock()
+
+
+def parseCGIOutput(output):
+    """ Split CGI-style output (headers, empty line, body) to WSGI status, headers and body. """
+    status = '200 OK'
+    headers = []
+
+    head,sep,body = output.partition('\n\n')
+    if(not sep):
+        return ('500 Internal Server Error',[('Content-Type','text/plain')],defaults.STRING_ARBITRARY_ERROR)
+
+    for l in str.splitlines(head):
+        if(not ':' in l):
+            continue
+        k,v = l.split(':',1)
+        if(k.strip().lower() == 'status'):
+            status = v.strip()
+        else:
+            headers.append((k.strip(),v.strip()))
+
+    return (status,headers,body)
+
+
+def serveStatic(path,start_response):
+    fn = os.path.join(os.path.dirname(os.path.abspath(__file__)),path.lstrip('/'))
+    try:
+        f = open(fn,'rb')
+        data = f.read()
+        f.close()
+    except IOError:
+        start_response('404 Not Found',[('Content-Type','text/plain')])
+        return ['Not found.']
+
+    ctype = mimetypes.guess_type(fn)[0] or 'application/octet-stream'
+    start_response('200 OK',[('Content-Type',ctype),('Content-Length',str(len(data)))])
+    return [data]
+
+
+def application(environ,start_response):
+    if(static_file_regexp.match(environ.get('PATH_INFO',''))):
+        return serveStatic(environ['PATH_INFO'],start_response)
+
+    form = cgi.FieldStorage(fp=environ['wsgi.input'],environ=environ)
+    action = form.getvalue('action',None)
+    params = dict([(k,form.getvalue(k)) for k in form.keys() if k != 'action'])
+
+    ulgmodel.log("Request from "+environ.get('REMOTE_ADDR','(unknown)')+" with action="+str(action)+" params="+str(params)+'.')
+
+    response = handler.getStreamResponse(action,params,environ)
+    if(response):
+        start_response(response[0],response[1])
+        return response[2]
+
+    # the handler prints CGI output, capture it
+    out = StringIO.StringIO()
+    handler_lock.acquire()
+    stdout = sys.stdout
+    sys.stdout = out
+    try:
+        try:
+            handler.user = environ.get('REMOTE_USER',None)
+            handler.environ = environ
+            handler.handleAction(action,params)
+        except Exception as e:
+            ulgmodel.log("ERROR in WSGI: "+traceback.format_exc())
+    finally:
+        sys.stdout = stdout
+        handler_lock.release()
+
+    status,headers,body = parseCGIOutput(out.getvalue())
+    start_response(status,headers+[('Content-Length',str(len(body)))])
+    return [body]
+
+
+class ULGWSGIServer(ThreadingMixIn,WSGIServer):
+    daemon_threads = True
+
+
+class ULGRequestHandler(WSGIRequestHandler):
+    def log_message(self,format,*args):
+        ulgmodel.debug("WSGI: "+(format % args))
+
+
+class ULGServer:
+    def __init__(self,host=defaults.wsgi_host,port=defaults.wsgi_port,workers=defaults.wsgi_workers):
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.children = []
+
+    def spawnWorker(self,server):
+        pid = os.fork()
+        if(pid == 0):
+            signal.signal(signal.SIGTERM,signal.SIG_DFL)
+            signal.signal(signal.SIGINT,signal.SIG_DFL)
+            try:
+                server.serve_forever()
+            except Exception as e:
+                ulgmodel.log("ERROR in WSGI worker: "+traceback.format_exc())
+            os._exit(0)
+
+        self.children.append(pid)
+        ulgmodel.debug("WSGI worker started PID: "+str(pid))
+
+    def stop(self,signum=None,frame=None):
+        for pid in self.children:
+            try:
+                os.kill(pid,signal.SIGTERM)
+            except OSError:
+                pass
+        ulgmodel.log('ULG application server stopped.')
+        os._exit(0)
+
+    def run(self):
+        server = make_server(self.host,self.port,application,server_class=ULGWSGIServer,handler_class=ULGRequestHandler)
+        ulgmodel.log('ULG application server listening on '+self.host+':'+str(self.port)+' with '+str(self.workers)+' workers.')
+
+        signal.signal(signal.SIGTERM,self.stop)
+        signal.signal(signal.SIGINT,self.stop)
+
+        # sessions opened by the rescans while constructing the routers,
+        # the parent does not run commands and would hold their slots
+        ulgcli.pool.closeAll()
+
+        for i in range(0,self.workers):
+            self.spawnWorker(server)
+
+        # respawn workers that died
+        while True:
+            try:
+                pid,status = os.wait()
+            except OSError:
+                time.sleep(1)
+                continue
+            if(pid in self.children):
+                self.children.remove(pid)
+                ulgmodel.log('WSGI worker PID '+str(pid)+' exited with status '+str(status)+', respawning.')
+                self.spawnWorker(server)
+
+
+# main
+
+if __name__=="__main__":
+    sys.exit(ULGServer().run())